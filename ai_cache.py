@@ -0,0 +1,229 @@
+"""
+AI 调用结果的持久化缓存。
+
+同一张图片重复上传、以图搜图时再次用到同一张图片、或者数据没有变化时重新生成总结，
+都会向模型发出完全相同的请求。结果按 (调用类型, 输入内容的哈希, 提示词版本, 模型名) 缓存在
+一个独立的 SQLite 文件中（所有用户共用，键只与内容有关），命中时直接返回，不再请求 AI。
+
+- 条目超过 AI_CACHE_TTL_HOURS 视为过期；
+- 总大小超过 AI_CACHE_MAX_MB 时按最近使用时间淘汰 (LRU)；
+- "重新生成"类操作传入 bypass_cache=True：跳过查找，但新结果仍会写回缓存覆盖旧值。
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import Counter
+
+# 缓存文件路径，设为空字符串可关闭缓存
+AI_CACHE_PATH = os.getenv("AI_CACHE_PATH", "ai_cache.db")
+# 条目的有效期（小时），0 表示永不过期
+AI_CACHE_TTL_HOURS = float(os.getenv("AI_CACHE_TTL_HOURS", str(24 * 30)))
+# 缓存内容的总大小上限 (MB)
+AI_CACHE_MAX_MB = float(os.getenv("AI_CACHE_MAX_MB", "64"))
+# 最近使用时间不需要精确到每次读取，间隔超过这么多秒才写回，减少读路径上的写入
+_TOUCH_INTERVAL_SECONDS = 60
+# 过期条目不必每次写入都清理，间隔超过这么多秒才清理一次
+_SWEEP_INTERVAL_SECONDS = 600
+
+_conn = None
+_conn_path = None
+_conn_pid = None
+_last_sweep = 0.0
+_lock = threading.Lock()
+_hits = Counter()
+_misses = Counter()
+
+
+def make_key(kind: str, content_hash: str, prompt_version: str, model: str) -> str:
+    """组合缓存键：调用类型 + 输入内容的哈希 + 提示词版本 + 模型名。"""
+    return f"{kind}:{prompt_version}:{model}:{content_hash}"
+
+
+def hash_text(*parts) -> str:
+    """对若干文本输入计算 SHA-256（各部分之间用 NUL 分隔，避免拼接产生歧义）。"""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update((part or "").encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+def _get_connection():
+    """懒加载缓存连接（按进程、按路径），调用方需要持有 _lock。缓存关闭时返回 None。"""
+    global _conn, _conn_path, _conn_pid
+    if not AI_CACHE_PATH:
+        return None
+    # fork 出的子进程不能沿用父进程的连接
+    if _conn is None or _conn_path != AI_CACHE_PATH or _conn_pid != os.getpid():
+        conn = sqlite3.connect(AI_CACHE_PATH, check_same_thread=False, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS ai_cache (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_accessed ON ai_cache (accessed_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_cache_created ON ai_cache (created_at)")
+        _create_stats_table(conn)
+        conn.commit()
+        _conn, _conn_path, _conn_pid = conn, AI_CACHE_PATH, os.getpid()
+    return _conn
+
+
+def _create_stats_table(conn):
+    """
+    只有一行的 ai_cache_stats 表记录条目数和总大小，由触发器随 ai_cache 的写入维护，
+    写入时不必每次 SUM 整张表（多个进程共用缓存文件，计数放在数据库里才一致）。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ai_cache_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            entries INTEGER NOT NULL,
+            bytes INTEGER NOT NULL
+        )
+    """)
+    # 旧的缓存文件第一次打开时按现有内容初始化
+    conn.execute("""
+        INSERT OR IGNORE INTO ai_cache_stats (id, entries, bytes)
+        SELECT 1, COUNT(*), COALESCE(SUM(size), 0) FROM ai_cache
+    """)
+    conn.executescript("""
+        CREATE TRIGGER IF NOT EXISTS ai_cache_stats_insert AFTER INSERT ON ai_cache BEGIN
+            UPDATE ai_cache_stats SET entries = entries + 1, bytes = bytes + new.size WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS ai_cache_stats_update AFTER UPDATE OF size ON ai_cache BEGIN
+            UPDATE ai_cache_stats SET bytes = bytes + new.size - old.size WHERE id = 1;
+        END;
+        CREATE TRIGGER IF NOT EXISTS ai_cache_stats_delete AFTER DELETE ON ai_cache BEGIN
+            UPDATE ai_cache_stats SET entries = entries - 1, bytes = bytes - old.size WHERE id = 1;
+        END;
+    """)
+
+
+def get(kind: str, key: str):
+    """查找缓存，命中时返回保存的结果（dict），未命中或已过期时返回 None。"""
+    try:
+        with _lock:
+            conn = _get_connection()
+            if conn is None:
+                return None
+            row = conn.execute(
+                "SELECT value, created_at, accessed_at FROM ai_cache WHERE key = ?", (key,)
+            ).fetchone()
+            now = time.time()
+            if row is None or (AI_CACHE_TTL_HOURS and now - row[1] > AI_CACHE_TTL_HOURS * 3600):
+                _misses[kind] += 1
+                return None
+            if now - row[2] > _TOUCH_INTERVAL_SECONDS:
+                conn.execute("UPDATE ai_cache SET accessed_at = ? WHERE key = ?", (now, key))
+                conn.commit()
+            _hits[kind] += 1
+        print(f"[ai-cache] hit: {kind}")
+        return json.loads(row[0])
+    except (sqlite3.Error, ValueError) as e:
+        # 缓存出错不影响正常调用，当作未命中处理
+        print(f"[ai-cache] lookup failed for {kind}: {e}")
+        return None
+
+
+def put(kind: str, key: str, value: dict):
+    """保存一次调用的结果（覆盖同键的旧值），然后按需淘汰最久未使用的条目。"""
+    try:
+        text = json.dumps(value, ensure_ascii=False)
+        with _lock:
+            conn = _get_connection()
+            if conn is None:
+                return
+            now = time.time()
+            # 用 UPSERT 而不是 INSERT OR REPLACE：REPLACE 删除旧行时不会触发 DELETE 触发器，统计会出错
+            conn.execute(
+                "INSERT INTO ai_cache (key, kind, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET kind = excluded.kind, value = excluded.value, "
+                "size = excluded.size, created_at = excluded.created_at, accessed_at = excluded.accessed_at",
+                (key, kind, text, len(text.encode("utf-8")), now, now),
+            )
+            _evict(conn, now)
+            conn.commit()
+    except (sqlite3.Error, TypeError, ValueError) as e:
+        print(f"[ai-cache] store failed for {kind}: {e}")
+
+
+def _evict(conn, now: float):
+    """定期删除过期条目；总大小超过上限时，从最久未使用的开始删除。"""
+    global _last_sweep
+    if AI_CACHE_TTL_HOURS and now - _last_sweep >= _SWEEP_INTERVAL_SECONDS:
+        conn.execute("DELETE FROM ai_cache WHERE created_at < ?", (now - AI_CACHE_TTL_HOURS * 3600,))
+        _last_sweep = now
+    max_bytes = int(AI_CACHE_MAX_MB * 1024 * 1024)
+    total = conn.execute("SELECT bytes FROM ai_cache_stats WHERE id = 1").fetchone()[0]
+    if total <= max_bytes:
+        return
+    excess = total - max_bytes
+    freed = 0
+    stale_keys = []
+    for key, size in conn.execute("SELECT key, size FROM ai_cache ORDER BY accessed_at"):
+        stale_keys.append((key,))
+        freed += size
+        if freed >= excess:
+            break
+    conn.executemany("DELETE FROM ai_cache WHERE key = ?", stale_keys)
+    print(f"[ai-cache] evicted {len(stale_keys)} entries ({freed} bytes)")
+
+
+def cached_call(kind: str, key: str, compute, bypass_cache: bool = False) -> dict:
+    """
+    带缓存地执行一次 AI 调用：先查缓存，未命中（或 bypass_cache）时调用 compute()。
+    只缓存成功的结果，返回 {"error": ...} 的调用不会写入缓存。
+    """
+    if not bypass_cache:
+        cached = get(kind, key)
+        if cached is not None:
+            return cached
+    result = compute()
+    if isinstance(result, dict) and "error" not in result:
+        put(kind, key, result)
+    return result
+
+
+def get_cache_stats() -> dict:
+    """返回缓存的命中/未命中计数（进程启动以来，按调用类型）以及当前条目数和总大小。"""
+    stats = {
+        "enabled": bool(AI_CACHE_PATH),
+        "hits": dict(_hits),
+        "misses": dict(_misses),
+        "entries": 0,
+        "bytes": 0,
+    }
+    lookups = sum(_hits.values()) + sum(_misses.values())
+    stats["hit_rate"] = round(sum(_hits.values()) / lookups, 3) if lookups else None
+    try:
+        with _lock:
+            conn = _get_connection()
+            if conn is not None:
+                stats["entries"], stats["bytes"] = conn.execute(
+                    "SELECT entries, bytes FROM ai_cache_stats WHERE id = 1"
+                ).fetchone()
+    except sqlite3.Error as e:
+        print(f"[ai-cache] failed to read cache size: {e}")
+    return stats
+
+
+def clear():
+    """清空缓存和计数。"""
+    with _lock:
+        conn = _get_connection()
+        if conn is not None:
+            conn.execute("DELETE FROM ai_cache")
+            conn.commit()
+        _hits.clear()
+        _misses.clear()
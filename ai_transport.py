@@ -0,0 +1,179 @@
+"""
+AI 接口的 HTTP 传输层。
+
+所有对模型服务商的请求都经过这里创建的客户端（同步的 OpenAI 和异步的 AsyncOpenAI 共用同一套配置）：
+- 连接池：限制最大连接数，保持长连接，避免每次请求重新握手；
+- 超时：连接超时较短；普通请求的读取超时要覆盖整个生成过程，流式请求的读取超时只是两个数据块之间的间隔；
+- HTTP/2：安装了 h2 (pip install "httpx[http2]") 时自动启用；
+- 重试：遇到 429 / 5xx 或连接失败时按带随机抖动的指数退避重试，服务商给出 Retry-After 时按它等待。
+  重试在传输层完成，SDK 自带的重试关闭，避免两层重试叠加。
+"""
+import os
+import time
+import random
+import asyncio
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import httpx
+from openai import OpenAI, AsyncOpenAI
+
+try:
+    import h2  # noqa: F401  # HTTP/2 是可选依赖
+    _HAS_HTTP2 = True
+except ImportError:
+    _HAS_HTTP2 = False
+
+# 连接池大小：同时打开的连接数上限，以及空闲时保留的长连接数
+AI_HTTP_MAX_CONNECTIONS = int(os.getenv("AI_HTTP_MAX_CONNECTIONS", "20"))
+AI_HTTP_MAX_KEEPALIVE = int(os.getenv("AI_HTTP_MAX_KEEPALIVE", "10"))
+AI_HTTP_KEEPALIVE_EXPIRY = float(os.getenv("AI_HTTP_KEEPALIVE_EXPIRY", "60"))
+# 超时（秒）：建立连接、普通请求等待完整响应、流式请求两个数据块之间的最长间隔、从连接池取连接
+AI_CONNECT_TIMEOUT = float(os.getenv("AI_CONNECT_TIMEOUT", "10"))
+AI_READ_TIMEOUT = float(os.getenv("AI_READ_TIMEOUT", "180"))
+AI_STREAM_READ_TIMEOUT = float(os.getenv("AI_STREAM_READ_TIMEOUT", "60"))
+AI_POOL_TIMEOUT = float(os.getenv("AI_POOL_TIMEOUT", "10"))
+# 是否使用 HTTP/2（需要安装 h2，未安装时自动使用 HTTP/1.1）
+AI_HTTP2 = os.getenv("AI_HTTP2", "true").lower() in ("1", "true", "yes")
+# 重试次数（不含第一次请求）、第一次重试前的基础等待秒数、单次等待的上限
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+AI_RETRY_BASE_DELAY = float(os.getenv("AI_RETRY_BASE_DELAY", "0.5"))
+AI_RETRY_MAX_DELAY = float(os.getenv("AI_RETRY_MAX_DELAY", "20"))
+
+RETRY_STATUS_CODES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+# 普通请求：读取超时要覆盖整个生成过程
+REQUEST_TIMEOUT = httpx.Timeout(AI_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT, pool=AI_POOL_TIMEOUT)
+# 流式请求：数据是陆续到达的，读取超时只需覆盖两个数据块之间的间隔，服务商卡住时能更快失败
+STREAM_TIMEOUT = httpx.Timeout(AI_STREAM_READ_TIMEOUT, connect=AI_CONNECT_TIMEOUT, pool=AI_POOL_TIMEOUT)
+
+
+def retry_delay(attempt: int, retry_after=None) -> float:
+    """
+    第 attempt 次重试（从 1 开始）前等待的秒数。
+    服务商给出了 Retry-After 时按它等待，否则使用 "full jitter" 指数退避：在 [0, base * 2^(attempt-1)] 中随机取值，
+    避免多个请求在同一时刻一起重试。结果不超过 AI_RETRY_MAX_DELAY。
+    """
+    if retry_after is not None:
+        return min(max(retry_after, 0.0), AI_RETRY_MAX_DELAY)
+    return random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def parse_retry_after(response: httpx.Response):
+    """解析响应中的 Retry-After（秒数或 HTTP 日期），没有或无法解析时返回 None。"""
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+    except (TypeError, ValueError):
+        return None
+
+
+def _should_retry(response: httpx.Response) -> bool:
+    # 服务商可以用 x-should-retry 明确表示是否值得重试（OpenAI 的约定）
+    should_retry = response.headers.get("x-should-retry")
+    if should_retry in ("true", "false"):
+        return should_retry == "true"
+    return response.status_code in RETRY_STATUS_CODES
+
+
+def _log_retry(request: httpx.Request, attempt: int, reason: str, delay: float):
+    print(f"[ai-transport] {request.method} {request.url.path} {reason}; "
+          f"retry {attempt}/{AI_MAX_RETRIES} in {delay:.2f}s")
+
+
+class RetryTransport(httpx.HTTPTransport):
+    """遇到可重试的状态码或连接错误时按退避策略重试的同步传输。"""
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = super().handle_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                # 没有收到任何响应（连接失败，或长连接在响应前被服务商关闭），重新发送请求
+                if attempt >= AI_MAX_RETRIES:
+                    raise
+                attempt += 1
+                delay = retry_delay(attempt)
+                _log_retry(request, attempt, type(e).__name__, delay)
+                time.sleep(delay)
+                continue
+            if attempt >= AI_MAX_RETRIES or not _should_retry(response):
+                return response
+            attempt += 1
+            delay = retry_delay(attempt, parse_retry_after(response))
+            response.close()
+            _log_retry(request, attempt, f"got HTTP {response.status_code}", delay)
+            time.sleep(delay)
+
+
+class AsyncRetryTransport(httpx.AsyncHTTPTransport):
+    """RetryTransport 的异步版本。"""
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            try:
+                response = await super().handle_async_request(request)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) as e:
+                if attempt >= AI_MAX_RETRIES:
+                    raise
+                attempt += 1
+                delay = retry_delay(attempt)
+                _log_retry(request, attempt, type(e).__name__, delay)
+                await asyncio.sleep(delay)
+                continue
+            if attempt >= AI_MAX_RETRIES or not _should_retry(response):
+                return response
+            attempt += 1
+            delay = retry_delay(attempt, parse_retry_after(response))
+            await response.aclose()
+            _log_retry(request, attempt, f"got HTTP {response.status_code}", delay)
+            await asyncio.sleep(delay)
+
+
+def _transport_options(proxy_url) -> dict:
+    return {
+        "http2": AI_HTTP2 and _HAS_HTTP2,
+        "limits": httpx.Limits(
+            max_connections=AI_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=AI_HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=AI_HTTP_KEEPALIVE_EXPIRY,
+        ),
+        "proxy": proxy_url or None,
+    }
+
+
+def create_client(api_key, base_url, proxy_url=None) -> OpenAI:
+    """创建使用共享传输配置的同步 OpenAI 客户端。"""
+    http_client = httpx.Client(
+        transport=RetryTransport(**_transport_options(proxy_url)),
+        timeout=REQUEST_TIMEOUT,
+        follow_redirects=True,
+    )
+    return OpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                  timeout=REQUEST_TIMEOUT, max_retries=0)
+
+
+def create_async_client(api_key, base_url, proxy_url=None) -> AsyncOpenAI:
+    """创建使用共享传输配置的异步 AsyncOpenAI 客户端（需要在事件循环中使用）。"""
+    http_client = httpx.AsyncClient(
+        transport=AsyncRetryTransport(**_transport_options(proxy_url)),
+        timeout=REQUEST_TIMEOUT,
+        follow_redirects=True,
+    )
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client,
+                       timeout=REQUEST_TIMEOUT, max_retries=0)
+
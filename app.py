@@ -1,38 +1,152 @@
+import os
+import hmac
 import json
+import time
 import base64
+import multiprocessing
 from datetime import date, timedelta,datetime
-from collections import Counter
 from whitenoise import WhiteNoise
-from flask import Flask, render_template, request, jsonify
-from markdown_it import MarkdownIt
+from flask import Flask, render_template, request, jsonify, send_file, url_for, abort
 from flask import Response, stream_with_context
 # 从我们自己的模块中导入所需函数
 import core
+import ai_cache
 import database
+import image_store
+import backup
+import jobs
+import summary_scheduler
+import fast_json
+import markdown_render
 
 # --- 1. 初始化 Flask 应用和扩展 ---
 app = Flask(__name__)
 app.wsgi_app = WhiteNoise(app.wsgi_app, root='static/')
+# jsonify 优先使用 orjson，并支持直接拼接数据库中保存的 JSON 片段
+app.json = fast_json.FastJSONProvider(app)
 app.config['SECRET_KEY'] = 'your-super-secret-key-for-wrong-answer-book'
-
-# 初始化 Markdown 转换器
-md = MarkdownIt()
+# 无限滚动每页加载的条数（前端可以通过 limit 参数覆盖，但不超过 MAX_PAGE_SIZE）
+app.config['QUESTIONS_PAGE_SIZE'] = int(os.getenv('QUESTIONS_PAGE_SIZE', '3'))
+app.config['CARELESS_PAGE_SIZE'] = int(os.getenv('CARELESS_PAGE_SIZE', '5'))
+app.config['MAX_PAGE_SIZE'] = int(os.getenv('MAX_PAGE_SIZE', '50'))
+# 多用户部署：由前置的认证代理在这个请求头中传入用户 ID，每个用户使用自己的数据库文件。
+# 留空则所有请求共用默认的 database.db（单用户模式）。
+app.config['USER_ID_HEADER'] = os.getenv('USER_ID_HEADER', '')
+# 分析任务状态推送 (SSE) 的轮询间隔，以及一个连接最长保持的时间
+app.config['JOB_EVENTS_POLL_SECONDS'] = float(os.getenv('JOB_EVENTS_POLL_SECONDS', '1'))
+app.config['JOB_EVENTS_TIMEOUT_SECONDS'] = int(os.getenv('JOB_EVENTS_TIMEOUT_SECONDS', '600'))
+# 维护接口（如在线备份）的访问令牌；未设置时维护接口一律返回 403
+app.config['MAINTENANCE_TOKEN'] = os.getenv('MAINTENANCE_TOKEN', '')
 
 # 定义并注册一个自定义的 Markdown 过滤器，以便在模板中使用
 def markdown_filter(text):
-    """将Markdown文本转换为HTML"""
-    if not text:
-        return ""
-    return md.render(text)
+    """将Markdown文本转换为HTML（按内容哈希缓存渲染结果）"""
+    return markdown_render.render_markdown(text)
 
 app.jinja_env.filters['markdown'] = markdown_filter
 
 
+def attach_image_url(item: dict) -> dict:
+    """
+    用图片地址替换记录中的内联图片数据。
+    新记录通过 /image/<hash> 引用图片仓库，并附带列表视图使用的缩略图/预览图地址；
+    尚未迁移的旧记录回退为 data URI。
+    """
+    legacy_b64 = item.pop('original_image_b64', None)
+    image_hash = item.get('image_hash')
+    if image_hash:
+        item['image_url'] = url_for('serve_image', image_hash=image_hash)
+        item['thumb_url'] = url_for('serve_image_variant', image_hash=image_hash, variant='thumb')
+        item['preview_url'] = url_for('serve_image_variant', image_hash=image_hash, variant='medium')
+    elif legacy_b64:
+        item['image_url'] = f"data:image/jpeg;base64,{legacy_b64}"
+        item['thumb_url'] = item['preview_url'] = item['image_url']
+    else:
+        item['image_url'] = item['thumb_url'] = item['preview_url'] = ''
+    return item
+
+
+def attach_json_fields(item: dict) -> dict:
+    """
+    把错题中以 JSON 文本保存的字段包装为 JSONFragment，响应时原样拼接进输出，
+    省去每行 json.loads 再重新编码的开销。这些字段在写入数据库时已经校验过
+    （见 database.normalize_json_text），这里只需处理空值。
+    """
+    for field in database.QUESTION_JSON_COLUMNS:
+        value = item.get(field)
+        item[field] = fast_json.JSONFragment(value) if value else []
+    return item
+
+
+def attach_analysis_html(item: dict) -> dict:
+    """
+    附上渲染好的解析 HTML (problem_analysis_html)，前端不必再自己解析 Markdown。
+    优先使用数据库中预渲染的结果，没有时（旧数据或关闭了预渲染）当场渲染。
+    """
+    if not item.get('problem_analysis_html'):
+        item['problem_analysis_html'] = markdown_render.render_markdown(item.get('problem_analysis'))
+    return item
+
+
+def wants_rendered_html() -> bool:
+    """请求参数 render=html 表示需要在响应中附带渲染好的解析 HTML。"""
+    return request.values.get('render') == 'html'
+
+
+def get_page_size(config_key: str) -> int:
+    """读取请求中的 limit 参数，缺省时使用配置的每页条数，并限制在合理范围内。"""
+    limit = request.args.get('limit', app.config[config_key], type=int)
+    return max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+
+def load_question_image_bytes(question) -> bytes:
+    """读取一条错题记录对应的原始图片字节（兼容旧的内联 base64 记录）。"""
+    if question['image_hash']:
+        return image_store.load_image(question['image_hash'])
+    return base64.b64decode(question['original_image_b64'])
+
+
 # --- 2. 数据库初始化 ---
 # 在应用启动时，确保数据库和表已经创建好
-with app.app_context():
-    database.init_db()
-    database.migrate_db()
+# 缩略图进程池以 spawn 方式启动，子进程会重新导入主模块（直接运行 app.py 时），这些初始化只在主进程中执行
+if multiprocessing.parent_process() is None:
+    with app.app_context():
+        database.init_db()
+        database.release_db_connection()
+        backup.start_backup_scheduler()
+        jobs.start_job_recovery()
+        summary_scheduler.start_scheduler()
+
+
+# 不读写用户数据的路由：多用户模式下也不要求用户 ID（维护接口用自己的令牌鉴权）
+USER_INDEPENDENT_ENDPOINTS = {'static', 'maintenance_backup', 'maintenance_backup_status'}
+
+
+@app.before_request
+def route_user_database():
+    """
+    根据请求头把本次请求的数据库操作路由到对应用户的数据库文件。
+    只有没有配置 USER_ID_HEADER（单用户模式）时才使用共用的 database.db；
+    配置了请求头但请求中没有时直接拒绝，不能让不同用户的请求落进同一个错题本。
+    """
+    summary_scheduler.note_activity()
+    header = app.config['USER_ID_HEADER']
+    if not header or request.endpoint in USER_INDEPENDENT_ENDPOINTS:
+        database.use_database(None)
+        return None
+    user_id = request.headers.get(header)
+    if not user_id:
+        return jsonify({"error": "缺少用户 ID"}), 401
+    if not database.is_valid_user_id(user_id):
+        return jsonify({"error": "无效的用户 ID"}), 400
+    database.use_user_database(user_id)
+    return None
+
+
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """每个请求结束时把数据库连接还给连接池，同一请求内的查询共用一个连接。"""
+    database.release_db_connection()
 
 # --- 3. 路由和API端点 ---
 
@@ -50,7 +164,8 @@ def index():
     latest_date = database.get_latest_question_date() # 获取最新记录的日期
     if latest_date:
         print(f"Latest question date is {latest_date}. Fetching initial summary...")
-        initial_summary_data = get_or_generate_summary_for_date(latest_date)
+        # 只读取已经保存的总结；还没有时显示"正在准备"，由后台生成，页面不等待AI
+        initial_summary_data = get_summary_for_date(latest_date)
     # --- 总结逻辑结束 ---
 
     # --- 周度图表逻辑 (保持不变) ---
@@ -79,33 +194,31 @@ def index():
 def get_questions():
     """
     【核心API】提供分页错题数据的API端点。
-    前端通过此接口实现按需加载和无限滚动。
+    前端通过此接口实现按需加载和无限滚动：
+    响应中的 next_cursor 原样作为下一次请求的 cursor 参数，为 null 时表示没有更多数据。
+    传入 render=html 时每条错题附带渲染好的 problem_analysis_html。
     """
     try:
         subject = request.args.get('subject', type=str)
-        page = request.args.get('page', 1, type=int)
+        cursor = request.args.get('cursor', None, type=str)
         start_date = request.args.get('start_date', None, type=str)
         
         if not subject:
             return jsonify({"error": "Subject is required"}), 400
 
-        limit = 3 # 每次加载3条
-        offset = (page - 1) * limit
-        
-        raw_questions = database.get_questions_by_subject(subject, limit, offset, start_date)
+        limit = get_page_size('QUESTIONS_PAGE_SIZE')
+        render_html = wants_rendered_html()
+        columns = database.QUESTION_HTML_COLUMNS if render_html else database.QUESTION_LIST_COLUMNS
+        try:
+            raw_questions, next_cursor = database.get_questions_by_subject(subject, limit, cursor, start_date, columns)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        questions_list = []
-        for q_row in raw_questions:
-            q_dict = dict(q_row)
-            try:
-                q_dict['knowledge_points'] = json.loads(q_dict['knowledge_points'])
-                q_dict['ai_analysis'] = json.loads(q_dict['ai_analysis'])
-                q_dict['similar_examples'] = json.loads(q_dict['similar_examples'])
-            except (json.JSONDecodeError, TypeError):
-                q_dict['knowledge_points'], q_dict['ai_analysis'], q_dict['similar_examples'] = [], [], []
-            questions_list.append(q_dict)
+        questions_list = [attach_json_fields(attach_image_url(dict(q_row))) for q_row in raw_questions]
+        if render_html:
+            questions_list = [attach_analysis_html(item) for item in questions_list]
             
-        return jsonify(questions_list)
+        return jsonify({"items": questions_list, "next_cursor": next_cursor})
     except Exception as e:
         print(f"Error in /get-questions: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -113,7 +226,11 @@ def get_questions():
 
 @app.route('/upload', methods=['POST'])
 def upload_question():
-    """处理错题上传的API端点。"""
+    """
+    处理错题上传的API端点。
+    【已修改】只保存图片并创建后台分析任务，立即返回任务 ID（202）；
+    前端通过 /jobs/<job_id>/events 跟踪分析进度。
+    """
     print("Received an upload request...")
     try:
         subject = request.form.get('subject')
@@ -123,29 +240,104 @@ def upload_question():
         if not subject or not file or file.filename == '':
             return jsonify({'status': 'failed', 'message': '必须填写科目并选择图片！'}), 400
 
-        image_bytes = file.read()
-        
-        print(f"Processing image for subject: {subject}...")
-        processed_data = core.process_new_question(
-            image_bytes=image_bytes,
-            subject=subject,
-            user_question=user_question
-        )
-
-        if 'error' in processed_data:
-            print(f"AI analysis failed: {processed_data['error']}")
-            return jsonify({'status': 'failed', 'message': f"AI分析失败: {processed_data['error']}"}), 500
+        image_hash = image_store.save_image(file.read())
+        image_store.enqueue_variants(image_hash)
+        job_id = jobs.submit_analysis_job(subject, user_question, image_hash)
 
-        database.add_question(processed_data)
-        
-        print("Question processed and saved successfully.")
-        return jsonify({'status': 'success', 'message': '错题上传并分析成功！'})
+        return jsonify({
+            'status': 'queued',
+            'message': '图片已上传，正在排队分析...',
+            'job_id': job_id,
+            'status_url': url_for('get_job', job_id=job_id),
+            'events_url': url_for('job_events', job_id=job_id),
+        }), 202
 
     except Exception as e:
         print(f"An unexpected error occurred in /upload: {e}")
         return jsonify({'status': 'failed', 'message': f'服务器内部错误: {e}'}), 500
 
 
+@app.route('/jobs/<string:job_id>')
+def get_job(job_id):
+    """查询一个分析任务的状态：queued / running / succeeded / failed。"""
+    job = jobs.get_job_status(job_id)
+    if not job:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<string:job_id>/events')
+def job_events(job_id):
+    """
+    以服务器发送事件 (SSE) 推送任务状态：状态变化时发送一条 status 事件，
+    任务结束（succeeded / failed）后关闭连接。状态从数据库读取，任务由哪个进程执行都可以跟踪。
+    分析过程中还会推送已经生成的内容：
+    - field：一个字段完整生成，data 为 {field, value}，problem_analysis 另附渲染好的 html；
+    - partial：正在生成的文本，data 为 {field, text}。
+    """
+    if not jobs.get_job_status(job_id):
+        return jsonify({'error': '任务不存在'}), 404
+    database.release_db_connection()
+
+    def generate():
+        last_sent = None
+        last_streaming = None
+        sent_fields = set()
+        deadline = time.monotonic() + app.config['JOB_EVENTS_TIMEOUT_SECONDS']
+        while time.monotonic() < deadline:
+            job = jobs.get_job_status(job_id, include_partial=True)
+            # 等待期间不占用连接池中的连接
+            database.release_db_connection()
+            if job is None:
+                break
+            partial = job.pop('partial') or {}
+            if last_sent and job['attempts'] != last_sent['attempts']:
+                # 新的一次尝试会重新生成全部内容
+                sent_fields.clear()
+                last_streaming = None
+            for field, value in partial.get('fields', {}).items():
+                if field not in sent_fields:
+                    event = {'field': field, 'value': value}
+                    if field == 'problem_analysis':
+                        event['html'] = markdown_render.render_markdown(value)
+                    yield f"event: field\ndata: {app.json.dumps(event)}\n\n"
+                    sent_fields.add(field)
+            streaming = partial.get('streaming')
+            if streaming and streaming != last_streaming and streaming[0] not in sent_fields:
+                yield f"event: partial\ndata: {app.json.dumps({'field': streaming[0], 'text': streaming[1]})}\n\n"
+                last_streaming = streaming
+            # 流式写入中间结果时 updated_at 会不断变化，只有状态本身变化时才推送
+            if last_sent is None or any(job[k] != last_sent[k] for k in job if k != 'updated_at'):
+                yield f"event: status\ndata: {app.json.dumps(job)}\n\n"
+                last_sent = job
+            if job['status'] in ('succeeded', 'failed'):
+                return
+            time.sleep(app.config['JOB_EVENTS_POLL_SECONDS'])
+        yield "event: timeout\ndata: {}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/jobs/<string:job_id>/retry', methods=['POST'])
+def retry_job(job_id):
+    """重新执行一个失败的分析任务（使用已经保存的图片，不需要重新上传）。"""
+    try:
+        if not jobs.retry_analysis_job(job_id):
+            return jsonify({'status': 'failed', 'message': '任务不存在或不是失败状态'}), 409
+        return jsonify({
+            'status': 'queued',
+            'message': '已重新开始分析',
+            'job_id': job_id,
+            'events_url': url_for('job_events', job_id=job_id),
+        }), 202
+    except Exception as e:
+        print(f"Error retrying job {job_id}: {e}")
+        return jsonify({'status': 'failed', 'message': f'重试失败: {e}'}), 500
+
+
 @app.route('/delete/<int:question_id>', methods=['DELETE'])
 def delete_question(question_id):
     """处理删除错题的API端点。"""
@@ -163,17 +355,18 @@ def regenerate_analysis(question_id):
     """处理重新生成错题解析的API端点。"""
     try:
         print(f"Received request to regenerate analysis for question ID: {question_id}")
-        question_data = database.get_question_by_id(question_id)
+        question_data = database.get_question_by_id(
+            question_id, columns=('id', 'subject', 'image_hash', 'original_image_b64')
+        )
         if not question_data:
             return jsonify({'status': 'failed', 'message': '未找到该错题'}), 404
 
-        image_b64 = question_data['original_image_b64']
-        
         # 重新调用核心AI逻辑
         processed_data = core.process_new_question(
-            image_bytes=base64.b64decode(image_b64),
+            image_bytes=load_question_image_bytes(question_data),
             subject=question_data['subject'],
-            user_question="" # 重新生成时不一定需要用户疑问，可根据需求修改
+            user_question="", # 重新生成时不一定需要用户疑问，可根据需求修改
+            bypass_cache=True # 用户明确要求重新生成，跳过AI结果缓存
         )
 
         if 'error' in processed_data:
@@ -216,10 +409,11 @@ def get_summary(date_str):
     """
     print(f"Request received for summary of date: {date_str}")
     
-    summary_data = get_or_generate_summary_for_date(date_str)
+    summary_data = get_summary_for_date(date_str)
     
     if summary_data:
-        return jsonify(summary_data)
+        # 总结还在后台生成时返回 202 和占位数据
+        return jsonify(summary_data), 202 if summary_data.get('pending') else 200
     else:
         return jsonify({"message": f"日期 {date_str} 没有错题记录，无法生成总结。"}), 404
     
@@ -234,51 +428,20 @@ def regenerate_summary(date_str):
     print(f"Received FORCE regeneration request for date: {date_str}")
     
     try:
-        # 1. 获取当天的所有错题
-        questions_for_date = database.get_questions_by_date(date_str)
-        if not questions_for_date:
+        # 强制调用 AI 生成新总结（跳过AI结果缓存）
+        new_summary_data = summary_scheduler.build_daily_summary(date_str, bypass_cache=True)
+        if new_summary_data is None:
             return jsonify({"error": f"日期 {date_str} 没有错题记录，无法重新生成总结。"}), 404
 
-        # 2. 强制调用 AI 生成新总结
-        print(f"Found {len(questions_for_date)} questions. Forcing AI regeneration...")
-        summary_text_list = [q['problem_analysis'] for q in questions_for_date]
-        subjects_list = [q['subject'] for q in questions_for_date]
-        
-        ai_summary_content = core.generate_daily_summary_with_ai("\n".join(summary_text_list))
-        
-        if 'error' in ai_summary_content:
+        if 'error' in new_summary_data['ai_summary']:
             # 即使AI返回错误，我们也将其视为一种“成功”的生成结果（生成了错误提示）
             # 所以我们继续流程，将其存入数据库
-            print(f"AI generation failed with message: {ai_summary_content['error']}")
+            print(f"AI generation failed with message: {new_summary_data['ai_summary']['error']}")
 
-        # 3. 准备新的数据结构，并把当天的粗心错误计入统计
-        subject_counts = Counter(subjects_list)
-        careless_count = 0
-        try:
-            if hasattr(database, 'get_careless_count_by_date'):
-                careless_count = int(database.get_careless_count_by_date(date_str) or 0)
-        except Exception as e:
-            print(f"Failed to get careless count for {date_str}: {e}")
-
-        if careless_count and careless_count > 0:
-            subject_counts['计算错误'] = subject_counts.get('计算错误', 0) + careless_count
-
-        total_questions = len(questions_for_date) + (careless_count or 0)
-
-        new_summary_data = {
-            "date": date_str,
-            "ai_summary": ai_summary_content,
-            "question_count": total_questions,
-            "subject_chart_data": {
-                "labels": list(subject_counts.keys()),
-                "data": list(subject_counts.values())
-            }
-        }
+        # 保存到数据库，并清除这一天等待中的后台任务
+        database.save_summary_and_finish_job(new_summary_data)
         
-        # 4. 使用新函数更新或保存到数据库
-        database.update_or_add_summary(new_summary_data)
-        
-        # 5. 将新生成的总结返回给前端
+        # 将新生成的总结返回给前端
         return jsonify(new_summary_data)
 
     except Exception as e:
@@ -300,11 +463,12 @@ def upload_careless_mistake():
             return jsonify({'status': 'failed', 'message': '必须上传图片并填写反思内容！'}), 400
 
         image_bytes = file.read()
-        image_b64 = base64.b64encode(image_bytes).decode('utf-8')
+        image_hash = image_store.save_image(image_bytes)
+        image_store.enqueue_variants(image_hash)
         
         mistake_data = {
             "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "original_image_b64": image_b64,
+            "image_hash": image_hash,
             "user_reflection": user_reflection
         }
 
@@ -320,18 +484,19 @@ def upload_careless_mistake():
 
 @app.route('/get-careless-mistakes')
 def get_careless_mistakes():
-    """提供分页粗心错误数据的API端点。"""
+    """提供分页粗心错误数据的API端点（游标分页，用法同 /get-questions）。"""
     try:
-        page = request.args.get('page', 1, type=int)
-        limit = 5 # 每次加载5条
-        offset = (page - 1) * limit
-        
-        raw_mistakes = database.get_careless_mistakes(limit, offset)
+        cursor = request.args.get('cursor', None, type=str)
+        limit = get_page_size('CARELESS_PAGE_SIZE')
+        try:
+            raw_mistakes, next_cursor = database.get_careless_mistakes(limit, cursor)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
         # 将数据库行对象转换为字典列表
-        mistakes_list = [dict(row) for row in raw_mistakes]
+        mistakes_list = [attach_image_url(dict(row)) for row in raw_mistakes]
             
-        return jsonify(mistakes_list)
+        return jsonify({"items": mistakes_list, "next_cursor": next_cursor})
     except Exception as e:
         print(f"Error in /get-careless-mistakes: {e}")
         return jsonify({"error": "Internal server error"}), 500
@@ -377,13 +542,13 @@ def chat_page(question_id):
         return "Question not found", 404
     
     # 将数据库行对象转换为可序列化的字典
-    q_dict = dict(question_data)
+    q_dict = attach_analysis_html(attach_image_url(dict(question_data)))
     try:
         # 反序列化JSON字符串字段以便在模板中使用
-        q_dict['knowledge_points'] = json.loads(q_dict['knowledge_points'])
-        q_dict['ai_analysis'] = json.loads(q_dict['ai_analysis'])
-        q_dict['similar_examples'] = json.loads(q_dict['similar_examples'])
-    except (json.JSONDecodeError, TypeError):
+        q_dict['knowledge_points'] = fast_json.loads(q_dict['knowledge_points'])
+        q_dict['ai_analysis'] = fast_json.loads(q_dict['ai_analysis'])
+        q_dict['similar_examples'] = fast_json.loads(q_dict['similar_examples'])
+    except (ValueError, TypeError):
         # 如果解析失败，提供默认空值
         q_dict['knowledge_points'], q_dict['ai_analysis'], q_dict['similar_examples'] = [], [], []
 
@@ -421,10 +586,11 @@ def chat_stream():
     return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
 
-def get_or_generate_summary_for_date(date_str):
+def get_summary_for_date(date_str):
     """
-    一个可复用的辅助函数，用于获取或生成指定日期的总结。
-    返回一个包含总结数据的字典，或在没有数据时返回 None。
+    一个可复用的辅助函数，用于获取指定日期的总结，从不在请求中调用AI。
+    已经保存时直接返回；还没有时安排后台生成（见 summary_scheduler），返回带 pending 标记的占位数据，
+    其中的题目数和科目分布来自汇总表。这一天没有记录时返回 None。
     """
     # 1. 尝试从数据库读取（若存在则直接返回，saved_summary 中可能已包含粗心错误统计）
     saved_summary = database.get_summary_by_date(date_str)
@@ -440,49 +606,31 @@ def get_or_generate_summary_for_date(date_str):
             "subject_chart_data": json.loads(saved_summary['subject_chart_data'])
         }
 
-    # 2. 如果没有，则尝试生成
-    questions_for_date = database.get_questions_by_date(date_str)
-    if not questions_for_date:
+    # 2. 如果没有，先返回统计数据，总结交给后台生成
+    stats = summary_scheduler.get_summary_stats(date_str)
+    if stats is None:
         print(f"No questions found for {date_str}. Cannot generate summary.")
         return None
 
-    # 3. 如果当天有错题，则生成、保存并返回
-    print(f"Found {len(questions_for_date)} questions for {date_str}. Generating new summary...")
-    summary_text_list = [q['problem_analysis'] for q in questions_for_date]
-    subjects_list = [q['subject'] for q in questions_for_date]
-    
-    ai_summary_content = core.generate_daily_summary_with_ai("\n".join(summary_text_list))
-    subject_counts = Counter(subjects_list)
-
-    # 统计当天的粗心错误数量（如果表中有该函数）
-    careless_count = 0
-    try:
-        if hasattr(database, 'get_careless_count_by_date'):
-            careless_count = int(database.get_careless_count_by_date(date_str) or 0)
-    except Exception as e:
-        print(f"Failed to get careless count for {date_str}: {e}")
-
-    # 如果存在粗心错误，则把它作为单独一类加入科目分布（标签为“计算错误”），并计入总数
-    if careless_count and careless_count > 0:
-        subject_counts['计算错误'] = subject_counts.get('计算错误', 0) + careless_count
-
-    total_questions = len(questions_for_date) + (careless_count or 0)
-
-    daily_summary = {
-        "date": date_str,
-        "ai_summary": ai_summary_content,
-        "question_count": total_questions,
-        "subject_chart_data": {
-            "labels": list(subject_counts.keys()),
-            "data": list(subject_counts.values())
-        }
-    }
-    
-    if 'error' not in ai_summary_content:
-        # database.add_daily_summary(daily_summary)
-        database.update_or_add_summary(daily_summary)
-    
-    return daily_summary
+    job = database.get_summary_job(date_str)
+    closed = summary_scheduler.is_closed_day(date_str)
+    if job and job['status'] == 'failed':
+        message = f"总结生成失败（{job['error']}），将在下次定时任务中重试，也可以点击“重新生成”。"
+    elif closed:
+        message = "总结正在准备中，稍后会自动显示。"
+    else:
+        message = "今天的学习还在进行中，总结会在今天结束后生成；也可以点击“重新生成”立即生成。"
+    if job is None:
+        summary_scheduler.request_summary(date_str)
+
+    return dict(
+        stats,
+        ai_summary=None,
+        pending=True,
+        message=message,
+        # 已经结束的日子正在后台生成，前端可以在几秒后重新请求
+        retry_after=5 if closed and not (job and job['status'] == 'failed') else None,
+    )
 
 # 【新增】获取搜索筛选器数据的API
 @app.route('/get-search-filters')
@@ -497,6 +645,11 @@ def api_get_search_filters():
 # 【新增】处理搜索请求的API
 @app.route('/search', methods=['POST'])
 def search():
+    """
+    搜索错题。返回 {"questions": [...], "careless_mistakes": [...]}：
+    文本查询同时检索粗心错误的反思内容；命中全文索引的结果带有高亮摘要 snippet。
+    传入 render=html 时每条错题附带渲染好的 problem_analysis_html。
+    """
     try:
         query_text = request.form.get('query', '')
         filters_json = request.form.get('filters', '{}')
@@ -507,33 +660,120 @@ def search():
         if image_file:
             print("Image file detected in search request.")
             image_bytes = image_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode('utf-8')
             
             # 调用 core 函数为图片生成关键词
-            result = core.generate_keywords_for_image(image_b64)
+            result = core.generate_keywords_for_image(image_bytes)
             if 'error' in result:
                 return jsonify({"error": f"AI keyword generation failed: {result['error']}"}), 500
             image_keywords = result.get('keywords', '')
             print(f"Generated keywords from image: {image_keywords}")
 
         # 调用数据库搜索函数
-        results = database.search_questions(query_text, filters, image_keywords)
+        render_html = wants_rendered_html()
+        columns = database.QUESTION_HTML_COLUMNS if render_html else database.QUESTION_LIST_COLUMNS
+        results = database.search_questions(query_text, filters, image_keywords, columns)
         
-        # 将结果中的JSON字符串字段转换为Python对象
+        # 结果中的JSON字符串字段原样拼接进响应
         for item in results:
-            try:
-                item['knowledge_points'] = json.loads(item['knowledge_points'])
-                item['ai_analysis'] = json.loads(item['ai_analysis'])
-                item['similar_examples'] = json.loads(item['similar_examples'])
-            except (json.JSONDecodeError, TypeError):
-                continue # 忽略解析失败的字段
+            attach_json_fields(attach_image_url(item))
+            if render_html:
+                attach_analysis_html(item)
+
+        # 科目/知识面筛选和图片搜索只针对错题，纯文本搜索时才一并检索粗心错误
+        careless_results = []
+        has_filters = any(filters.get(key) for key in ('subjects', 'areas'))
+        if query_text and not image_keywords and not has_filters:
+            careless_results = [attach_image_url(item) for item in database.search_careless_mistakes(query_text)]
 
-        return jsonify(results)
+        return jsonify({"questions": results, "careless_mistakes": careless_results})
 
     except Exception as e:
         print(f"An unexpected error occurred in /search: {e}")
         return jsonify({"error": "Internal server error"}), 500
 
+@app.route('/ai-stats')
+def api_get_ai_stats():
+    """返回最近的AI调用统计（图片压缩前后体积、请求耗时），用于调优预处理参数。"""
+    return jsonify(core.get_ai_call_stats())
+
+
+@app.route('/ai-stats/cache')
+def api_get_ai_cache_stats():
+    """返回AI结果缓存的命中/未命中计数（按调用类型）以及缓存的条目数和大小。"""
+    return jsonify(ai_cache.get_cache_stats())
+
+
+@app.route('/image/<string:image_hash>')
+def serve_image(image_hash):
+    """
+    按内容哈希提供原始图片。
+    同一哈希的内容永远不会变化，因此可以让浏览器永久缓存。
+    """
+    if not image_store.image_exists(image_hash):
+        abort(404)
+
+    response = send_file(
+        image_store.get_image_path(image_hash),
+        mimetype=image_store.get_image_mime(image_hash),
+        etag=image_hash,
+        conditional=True,
+    )
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/image/<string:image_hash>/<string:variant>')
+def serve_image_variant(image_hash, variant):
+    """
+    提供图片的缩略图 (thumb) 或预览图 (medium)。
+    变体尚未生成时（例如旧图片或后台任务还没跑完）先返回原图并提交生成任务，
+    此时只允许短暂缓存，以便浏览器稍后拿到真正的缩略图。
+    """
+    if variant not in image_store.VARIANTS or not image_store.image_exists(image_hash):
+        abort(404)
+
+    variant_path = image_store.get_variant_path(image_hash, variant)
+    if variant_path is None:
+        image_store.enqueue_variants(image_hash)
+        response = send_file(
+            image_store.get_image_path(image_hash),
+            mimetype=image_store.get_image_mime(image_hash),
+        )
+        response.headers['Cache-Control'] = 'public, max-age=60'
+        return response
+
+    response = send_file(variant_path, etag=f"{image_hash}-{variant}", conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+def is_maintenance_request_allowed() -> bool:
+    """
+    维护接口的访问控制：必须配置 MAINTENANCE_TOKEN，并在 X-Maintenance-Token 请求头中带上它。
+    未配置令牌时一律拒绝（经反向代理转发的请求都来自 127.0.0.1，不能按来源地址放行）。
+    """
+    token = app.config['MAINTENANCE_TOKEN']
+    if not token:
+        return False
+    return hmac.compare_digest(request.headers.get('X-Maintenance-Token', ''), token)
+
+
+@app.route('/maintenance/backup', methods=['POST'])
+def maintenance_backup():
+    """在后台开始一次在线备份（数据库快照 + 图片增量备份）。只接受 POST，避免被爬虫或跨站的图片链接触发。"""
+    if not is_maintenance_request_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+    if not backup.start_backup_in_background():
+        return jsonify({"status": "busy", **backup.get_backup_status()}), 409
+    return jsonify({"status": "started"}), 202
+
+
+@app.route('/maintenance/backup/status')
+def maintenance_backup_status():
+    """查看备份是否在进行，以及上一次备份的报告（耗时、字节数、速度）。"""
+    if not is_maintenance_request_allowed():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(backup.get_backup_status())
+
 # --- 4. 启动应用 ---
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
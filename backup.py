@@ -0,0 +1,267 @@
+"""
+错题本数据库的在线备份。
+
+- 数据库：使用 SQLite 在线备份 API，每一步只复制少量页面并在步骤之间短暂休眠，
+  备份过程中读写请求几乎不受影响；每次生成一个时间点快照，按数量轮换旧快照。
+- 图片仓库：按内容哈希增量备份，只复制备份目录中还没有的图片（缩略图可以重新生成，不备份）。
+
+可以通过维护路由 POST /maintenance/backup 触发（需要配置 MAINTENANCE_TOKEN），也可以设置 BACKUP_INTERVAL_HOURS 定时执行，
+或者直接运行：
+    python backup.py
+"""
+import os
+import re
+import glob
+import time
+import shutil
+import sqlite3
+import threading
+from datetime import datetime
+
+import database
+import image_store
+
+BACKUP_DIR = os.path.abspath(os.getenv("BACKUP_DIR", "backups"))
+# 每个数据库保留的快照数量
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+# 每一步复制的页数，以及两步之间的休眠时间
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_SLEEP_MS = int(os.getenv("BACKUP_STEP_SLEEP_MS", "5"))
+# 分步备份期间源数据库被其它连接写入时，SQLite 会从头重新复制；重新开始超过这么多次后，
+# 改为一步完成的备份（复制期间短暂阻塞写入），避免持续的写入让快照永远完不成
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "3"))
+# 定时备份的间隔（小时），0 表示不定时备份
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", "0"))
+# 锁文件超过这么多秒仍未释放，认为上一次备份的进程已经异常退出
+_LOCK_STALE_SECONDS = 6 * 3600
+
+_SNAPSHOT_PATTERN = re.compile(r"^(?P<stem>.+)-\d{8}-\d{6}\.db$")
+
+_last_report = None
+_running = threading.Lock()
+
+
+def _format_rate(num_bytes: int, seconds: float) -> float:
+    return round(num_bytes / seconds, 1) if seconds > 0 else float(num_bytes)
+
+
+# --- 数据库快照 ---
+
+class _BackupRestarted(Exception):
+    """分步备份因为并发写入重新开始的次数超过了 BACKUP_MAX_RESTARTS。"""
+
+
+def backup_database(db_path: str, target_dir: str = None) -> dict:
+    """
+    为一个数据库文件生成时间点快照，返回 {snapshot, bytes, seconds, bytes_per_sec, pages, restarts}。
+    快照先写到临时文件，完成并校验后再改名，目录中不会出现半个快照。
+    """
+    target_dir = target_dir or os.path.join(BACKUP_DIR, "databases")
+    os.makedirs(target_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(db_path))[0]
+    snapshot = os.path.join(target_dir, f"{stem}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+    tmp_path = f"{snapshot}.tmp"
+
+    pages = {"total": 0, "remaining": None, "restarts": 0}
+
+    def progress(status, remaining, total):
+        # 剩余页数变多说明源数据库被写入，备份从头重新开始了
+        if pages["remaining"] is not None and remaining > pages["remaining"]:
+            pages["restarts"] += 1
+            if pages["restarts"] > BACKUP_MAX_RESTARTS:
+                raise _BackupRestarted()
+        pages["total"], pages["remaining"] = total, remaining
+        # 让出数据库，给正在排队的读写请求留出时间
+        if remaining and BACKUP_STEP_SLEEP_MS:
+            time.sleep(BACKUP_STEP_SLEEP_MS / 1000)
+
+    started = time.perf_counter()
+    source = sqlite3.connect(db_path, timeout=database.DB_BUSY_TIMEOUT_MS / 1000)
+    target = sqlite3.connect(tmp_path)
+    try:
+        try:
+            source.backup(target, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+        except _BackupRestarted:
+            print(f"Backup of {db_path} restarted {pages['restarts']} times because of concurrent writes; "
+                  f"copying it in a single step.")
+            source.backup(target, pages=-1)
+            pages["total"] = target.execute("PRAGMA page_count").fetchone()[0]
+        result = target.execute("PRAGMA quick_check").fetchone()[0]
+        if result != "ok":
+            raise sqlite3.DatabaseError(f"Backup of {db_path} failed integrity check: {result}")
+        # 快照使用回滚日志模式，拷贝走单个文件即可
+        target.execute("PRAGMA journal_mode = DELETE")
+    except Exception:
+        target.close()
+        os.remove(tmp_path)
+        raise
+    finally:
+        source.close()
+    target.close()
+    os.replace(tmp_path, snapshot)
+
+    seconds = time.perf_counter() - started
+    size = os.path.getsize(snapshot)
+    return {
+        "snapshot": snapshot,
+        "bytes": size,
+        "pages": pages["total"],
+        "restarts": pages["restarts"],
+        "seconds": round(seconds, 3),
+        "bytes_per_sec": _format_rate(size, seconds),
+    }
+
+
+def rotate_snapshots(target_dir: str, stem: str, keep: int = BACKUP_KEEP) -> list:
+    """只保留某个数据库最新的 keep 个快照，返回被删除的文件列表。"""
+    snapshots = sorted(
+        path for path in glob.glob(os.path.join(target_dir, f"{glob.escape(stem)}-*.db"))
+        if (match := _SNAPSHOT_PATTERN.match(os.path.basename(path))) and match.group("stem") == stem
+    )
+    removed = snapshots[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def list_databases() -> list:
+    """需要备份的数据库：默认数据库，以及多用户部署下每个用户的数据库。"""
+    return database.list_database_files()
+
+
+# --- 图片仓库增量备份 ---
+
+def backup_images(target_dir: str = None) -> dict:
+    """把 image_store 中备份目录里还没有的原始图片复制过去（按哈希判断，已有的直接跳过）。"""
+    target_dir = target_dir or os.path.join(BACKUP_DIR, "image_store")
+    started = time.perf_counter()
+    copied = skipped = copied_bytes = 0
+    if os.path.isdir(image_store.IMAGE_STORE_DIR):
+        for prefix in sorted(os.listdir(image_store.IMAGE_STORE_DIR)):
+            source_dir = os.path.join(image_store.IMAGE_STORE_DIR, prefix)
+            if not os.path.isdir(source_dir):
+                continue
+            for name in os.listdir(source_dir):
+                # 只备份原图，缩略图/预览图和临时文件都可以重新生成
+                if not image_store.is_valid_hash(name):
+                    continue
+                target = os.path.join(target_dir, prefix, name)
+                if os.path.exists(target):
+                    skipped += 1
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                tmp_path = f"{target}.tmp"
+                shutil.copy2(os.path.join(source_dir, name), tmp_path)
+                os.replace(tmp_path, target)
+                copied += 1
+                copied_bytes += os.path.getsize(target)
+
+    seconds = time.perf_counter() - started
+    return {
+        "copied": copied,
+        "skipped": skipped,
+        "bytes": copied_bytes,
+        "seconds": round(seconds, 3),
+        "bytes_per_sec": _format_rate(copied_bytes, seconds),
+    }
+
+
+# --- 完整备份 ---
+
+def _acquire_lock_file(path: str) -> bool:
+    """跨进程的备份锁（gunicorn 的多个 worker 可能同时触发定时备份）。"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if time.time() - os.path.getmtime(path) < _LOCK_STALE_SECONDS:
+            return False
+        os.remove(path)
+        return _acquire_lock_file(path)
+    os.write(fd, str(os.getpid()).encode())
+    os.close(fd)
+    return True
+
+
+def run_backup() -> dict:
+    """
+    备份所有数据库并增量备份图片仓库，返回备份报告。
+    同一时间只会有一个备份在执行，已有备份在进行时返回 {"status": "busy"}。
+    """
+    global _last_report
+    lock_path = os.path.join(BACKUP_DIR, ".backup.lock")
+    if not _running.acquire(blocking=False):
+        return {"status": "busy"}
+    try:
+        if not _acquire_lock_file(lock_path):
+            return {"status": "busy"}
+        try:
+            started = time.perf_counter()
+            report = {
+                "status": "success",
+                "started_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "databases": [],
+            }
+            target_dir = os.path.join(BACKUP_DIR, "databases")
+            for db_path in list_databases():
+                try:
+                    result = backup_database(db_path, target_dir)
+                    stem = os.path.splitext(os.path.basename(db_path))[0]
+                    result["rotated"] = len(rotate_snapshots(target_dir, stem))
+                except Exception as e:
+                    print(f"Backup of {db_path} failed: {e}")
+                    report["status"] = "partial"
+                    result = {"error": str(e)}
+                result["database"] = db_path
+                report["databases"].append(result)
+                print(f"Backed up {db_path}: {result}")
+
+            report["images"] = backup_images()
+            print(f"Backed up images: {report['images']}")
+
+            report["seconds"] = round(time.perf_counter() - started, 3)
+            total_bytes = sum(item.get("bytes", 0) for item in report["databases"]) + report["images"]["bytes"]
+            report["bytes"] = total_bytes
+            report["bytes_per_sec"] = _format_rate(total_bytes, report["seconds"])
+            _last_report = report
+            return report
+        finally:
+            os.remove(lock_path)
+    finally:
+        _running.release()
+
+
+def start_backup_in_background() -> bool:
+    """在后台线程中执行一次备份；已有备份在进行时返回 False。"""
+    if _running.locked():
+        return False
+    threading.Thread(target=run_backup, name="backup", daemon=True).start()
+    return True
+
+
+def get_backup_status() -> dict:
+    """返回当前是否正在备份，以及上一次备份的报告。"""
+    return {"running": _running.locked(), "last_report": _last_report}
+
+
+def start_backup_scheduler(interval_hours: float = BACKUP_INTERVAL_HOURS):
+    """按固定间隔在后台执行备份（interval_hours <= 0 时不启动）。"""
+    if interval_hours <= 0:
+        return None
+
+    def loop():
+        while True:
+            time.sleep(interval_hours * 3600)
+            try:
+                run_backup()
+            except Exception as e:
+                print(f"Scheduled backup failed: {e}")
+
+    thread = threading.Thread(target=loop, name="backup-scheduler", daemon=True)
+    thread.start()
+    print(f"Scheduled backups every {interval_hours} hours into {BACKUP_DIR}.")
+    return thread
+
+
+if __name__ == "__main__":
+    print(run_backup())
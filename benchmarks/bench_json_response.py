@@ -0,0 +1,119 @@
+"""
+错题列表接口 (/get-questions, /search) 的 JSON 序列化基准测试：每秒能输出多少行。
+
+用法（在项目根目录下运行）:
+    python benchmarks/bench_json_response.py                # 使用合成的样例数据
+    python benchmarks/bench_json_response.py database.db    # 使用已有错题本中的真实文本
+
+对比三种方式处理同一页 50 条错题，分别统计只做行转换和序列化 (serialize)、
+以及再加上数据库查询 (with query) 的吞吐量（都包含生成图片地址）：
+- before：逐行 json.loads 三个 JSON 字段，再用标准库 jsonify 整体编码（原来的实现）；
+- fragments (stdlib)：JSON 字段作为片段原样拼接，没有安装 orjson 时的回退路径；
+- fragments (orjson)：JSON 字段原样拼接，其余部分用 orjson 编码（安装了 orjson 时的默认路径）。
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import contextlib
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import database  # noqa: E402
+import fast_json  # noqa: E402
+from bench_text_codec import synthetic_rows, rows_from_database  # noqa: E402
+from flask.json.provider import DefaultJSONProvider  # noqa: E402
+
+PAGE_SIZE = 50
+SAMPLE_ROWS = 500
+REPEAT = 200
+
+
+def time_rows_per_sec(fn) -> float:
+    fn()  # 预热
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        fn()
+    return PAGE_SIZE * REPEAT / (time.perf_counter() - started)
+
+
+def main():
+    source = os.path.abspath(sys.argv[1]) if len(sys.argv) > 1 else None
+    rows = rows_from_database(source) if source else synthetic_rows(SAMPLE_ROWS)
+    subject = max({row["subject"] for row in rows}, key=lambda s: sum(r["subject"] == s for r in rows))
+    print(f"Benchmarking with {len(rows)} rows from {source or 'synthetic samples'}, "
+          f"page of {PAGE_SIZE} from subject '{subject}'")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # app 在导入时会初始化当前目录下的 database.db，切换到临时目录避免改动真实数据
+        os.chdir(tmp)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            import app as app_module
+            for row in rows:
+                database.add_question(row)
+        app = app_module.app
+        stdlib_provider = DefaultJSONProvider(app)
+
+        def fetch_page():
+            page, _ = database.get_questions_by_subject(subject, PAGE_SIZE)
+            return page
+
+        def before(page):
+            items = []
+            for q_row in page:
+                q_dict = dict(q_row)
+                try:
+                    q_dict['knowledge_points'] = json.loads(q_dict['knowledge_points'])
+                    q_dict['ai_analysis'] = json.loads(q_dict['ai_analysis'])
+                    q_dict['similar_examples'] = json.loads(q_dict['similar_examples'])
+                except (json.JSONDecodeError, TypeError):
+                    q_dict['knowledge_points'], q_dict['ai_analysis'], q_dict['similar_examples'] = [], [], []
+                items.append(app_module.attach_image_url(q_dict))
+            return stdlib_provider.response({"items": items, "next_cursor": None}).get_data()
+
+        def after(page):
+            items = [app_module.attach_json_fields(app_module.attach_image_url(dict(q_row))) for q_row in page]
+            return app.json.response({"items": items, "next_cursor": None}).get_data()
+
+        def measure(label, build):
+            page = fetch_page()
+            serialize = time_rows_per_sec(lambda: build(page))
+            end_to_end = time_rows_per_sec(lambda: build(fetch_page()))
+            results.append((label, serialize, end_to_end))
+
+        results = []
+        with app.test_request_context():
+            page = fetch_page()
+            if len(page) < PAGE_SIZE:
+                print(f"Warning: only {len(page)} rows in the page.")
+            # 两种方式的输出必须解析为相同的数据
+            assert json.loads(before(page)) == json.loads(after(page))
+
+            measure("before (json.loads + stdlib)", before)
+            saved_orjson = fast_json.orjson
+            fast_json.orjson = None
+            try:
+                measure("fragments (stdlib)", after)
+            finally:
+                fast_json.orjson = saved_orjson
+            if saved_orjson is not None:
+                measure("fragments (orjson)", after)
+            else:
+                print("orjson is not installed; skipping the orjson variant.")
+
+        database.close_all_databases()
+        os.chdir(os.path.dirname(BENCH_DIR))
+
+    print(f"\n--- Rows per second (page of {PAGE_SIZE}, average of {REPEAT} pages) ---")
+    print(f"{'':<32}{'serialize':>12}{'':>8}{'with query':>12}{'':>8}")
+    _, base_serialize, base_end_to_end = results[0]
+    for label, serialize, end_to_end in results:
+        print(f"{label:<32}{serialize:>12.0f}{serialize / base_serialize:>7.2f}x"
+              f"{end_to_end:>12.0f}{end_to_end / base_end_to_end:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+长文本字段压缩 (DB_COMPRESS_TEXT) 的基准测试：压缩率与读取延迟。
+
+用法（在项目根目录下运行）:
+    python benchmarks/bench_text_codec.py                # 使用合成的样例数据
+    python benchmarks/bench_text_codec.py database.db    # 使用已有错题本中的真实文本
+
+输出：
+- 各字段压缩前后的总字节数，分别对比普通 zlib 与带预置字典的 zlib；
+- 在两份分别以明文、压缩格式写入相同数据的临时数据库上，
+  列表视图读取全部字段 / 只读取短字段 / 按 ID 读取详情的平均耗时。
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import tempfile
+import zlib
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+SAMPLE_ROWS = 2000
+PAGE_SIZE = 20
+REPEAT = 200
+
+
+def synthetic_rows(count: int) -> list:
+    """生成与 AI 输出结构相近的样例数据（带随机内容，避免重复文本夸大压缩率）。"""
+    rng = random.Random(42)
+    topics = ["能斯特方程", "吉布斯自由能", "洛必达法则", "泰勒展开", "布拉格方程", "菲克定律", "相律", "定积分换元"]
+    steps = ["列出已知条件", "写出公式", "代入数据", "注意单位换算", "检查符号", "化简结果", "讨论边界情况"]
+    rows = []
+    for i in range(count):
+        topic = rng.choice(topics)
+        body = "\n".join(
+            f"{n}. **{rng.choice(steps)}**：根据{topic}，$x_{n} = {rng.randint(1, 999)} \\times 10^{{{rng.randint(-9, 9)}}}$，"
+            f"因此可以得到第 {n} 步的结论。"
+            for n in range(1, rng.randint(4, 9))
+        )
+        rows.append({
+            "subject": rng.choice(["物理化学", "高等数学", "材料科学基础"]),
+            "upload_date": f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:{i % 60:02d}",
+            "image_hash": "",
+            "user_question": "",
+            "problem_analysis": f"### 解题思路\n\n这道题考察{topic}。\n\n### 解题步骤\n\n{body}\n\n**结论**：答案是 {rng.randint(1, 100)}。",
+            "knowledge_points": json.dumps([topic, rng.choice(steps)], ensure_ascii=False),
+            "ai_analysis": json.dumps([f"{rng.choice(steps)}时出错", "单位换算错误", "概念混淆"], ensure_ascii=False),
+            "similar_examples": json.dumps([
+                {"question": f"已知{topic}中参数为 {rng.randint(1, 50)}，求结果。", "answer": body[:rng.randint(80, 300)]}
+                for _ in range(rng.randint(1, 3))
+            ], ensure_ascii=False),
+            "keywords": f"[物理化学]-[电化学]-[{topic}]",
+        })
+    return rows
+
+
+def rows_from_database(path: str) -> list:
+    conn = sqlite3.connect(path)
+    conn.row_factory = database._LazyRow
+    conn.create_function("text_value", 1, database.decode_text)
+    columns = ", ".join(c for c in database.QUESTION_LIST_COLUMNS if c != "id")
+    rows = [dict(row) for row in conn.execute(f"SELECT {columns} FROM questions")]
+    conn.close()
+    return rows
+
+
+def report_ratios(rows: list):
+    print("\n--- Compression ratio (questions) ---")
+    print(f"{'column':<20}{'raw bytes':>12}{'zlib':>12}{'zlib+dict':>12}{'ratio':>8}")
+    for column in database.COMPRESSED_COLUMNS["questions"]:
+        raw = plain = with_dict = 0
+        for row in rows:
+            text = row[column] or ""
+            encoded = text.encode("utf-8")
+            raw += len(encoded)
+            plain += len(zlib.compress(encoded, database.DB_COMPRESS_LEVEL)) if len(encoded) >= database.DB_COMPRESS_MIN_BYTES else len(encoded)
+            stored = database.encode_text(text, compress=True)
+            with_dict += len(stored.encode("utf-8") if isinstance(stored, str) else stored)
+        print(f"{column:<20}{raw:>12}{plain:>12}{with_dict:>12}{raw / max(with_dict, 1):>8.2f}")
+
+
+def build_database(path: str, rows: list, compress: bool):
+    database.DB_COMPRESS_TEXT = compress
+    database.DATABASE_NAME = path
+    database.use_database(None)
+    with contextlib.redirect_stdout(open(os.devnull, "w")):
+        database.init_db()
+        for row in rows:
+            database.add_question(row)
+    database.close_all_databases()
+
+
+def time_it(fn) -> float:
+    started = time.perf_counter()
+    for _ in range(REPEAT):
+        fn()
+    return (time.perf_counter() - started) / REPEAT * 1000
+
+
+def report_latency(path: str, label: str, count: int):
+    database.DATABASE_NAME = path
+    database.use_database(None)
+    ids = [random.randint(1, count) for _ in range(REPEAT)]
+    short_columns = ("id", "subject", "upload_date", "keywords")
+
+    def list_all_fields():
+        page, _ = database.get_questions_by_subject("物理化学", PAGE_SIZE)
+        return [dict(row) for row in page]
+
+    def list_short_fields():
+        page, _ = database.get_questions_by_subject("物理化学", PAGE_SIZE, columns=short_columns)
+        return [dict(row) for row in page]
+
+    detail_ids = iter(ids * 2)
+
+    def detail():
+        return dict(database.get_question_by_id(next(detail_ids), columns=database.QUESTION_LIST_COLUMNS))
+
+    size = os.path.getsize(path)
+    print(f"{label:<12}{size:>12}{time_it(list_all_fields):>14.3f}{time_it(list_short_fields):>14.3f}{time_it(detail):>12.3f}")
+    database.release_db_connection()
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else None
+    rows = rows_from_database(source) if source else synthetic_rows(SAMPLE_ROWS)
+    print(f"Benchmarking with {len(rows)} rows from {source or 'synthetic samples'}")
+    report_ratios(rows)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        plain_db = os.path.join(tmp, "plain.db")
+        compressed_db = os.path.join(tmp, "compressed.db")
+        build_database(plain_db, rows, compress=False)
+        build_database(compressed_db, rows, compress=True)
+        for path in (plain_db, compressed_db):
+            sqlite3.connect(path).execute("VACUUM").connection.close()
+
+        print(f"\n--- Read latency (ms per call, average of {REPEAT}) ---")
+        print(f"{'storage':<12}{'db bytes':>12}{'list (all)':>14}{'list (short)':>14}{'detail':>12}")
+        report_latency(plain_db, "plain", len(rows))
+        report_latency(compressed_db, "compressed", len(rows))
+        database.close_all_databases()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 import os
+import io
+import time
 import base64
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
-import httpx
-# 加载 .env 文件中的环境变量
+
+# 加载 .env 文件中的环境变量（需要在导入下面的模块之前，它们在导入时读取配置）
 load_dotenv()
 
+import image_store
+import ai_cache
+import ai_transport
+from partial_json import StreamingObjectParser
+
 # --- 1. 从环境变量中获取API配置 ---
 # 从.env文件中读取API密钥、基础URL和模型名称
 # 这种方式可以避免将敏感信息硬编码在代码中
@@ -15,34 +23,59 @@ API_KEY = os.getenv("API_KEY")
 API_URL = os.getenv("API_URL")
 AI_MODEL = os.getenv("AI_MODEL")
 PROXY_URL = os.getenv("PROXY_URL")
+
+# --- 发送给AI之前的图片预处理参数 ---
+# 最长边像素上限：视觉模型会把大图切成更多块计费，超过这个尺寸对识别帮助不大
+AI_IMAGE_MAX_EDGE = int(os.getenv("AI_IMAGE_MAX_EDGE", "1600"))
+# 重新压缩时使用的 JPEG 质量
+AI_IMAGE_QUALITY = int(os.getenv("AI_IMAGE_QUALITY", "85"))
+# 是否裁掉图片四周的空白边
+AI_IMAGE_TRIM = os.getenv("AI_IMAGE_TRIM", "true").lower() in ("1", "true", "yes")
+# 是否转为灰度图（大多数题目是黑白的，灰度可以进一步减小体积）
+AI_IMAGE_GRAYSCALE = os.getenv("AI_IMAGE_GRAYSCALE", "false").lower() in ("1", "true", "yes")
+# 裁边时，亮度高于该值的像素视为空白背景
+_TRIM_BACKGROUND_THRESHOLD = 235
+_TRIM_PADDING = 12
+
+# 提示词版本：修改下面各函数中的提示词或结果格式时递增，旧的缓存结果随之失效（见 ai_cache）
+ANALYSIS_PROMPT_VERSION = "1"
+IMAGE_KEYWORDS_PROMPT_VERSION = "1"
+DAILY_SUMMARY_PROMPT_VERSION = "1"
+
+# 每日总结分块时每块摘要的 token 预算，以及并行总结的块数
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_MAP_WORKERS = int(os.getenv("SUMMARY_MAP_WORKERS", "4"))
+
+# 流式分析时逐个推送给前端的字段（按AI输出的顺序）
+STREAMED_ANALYSIS_FIELDS = ("problem_analysis", "knowledge_points", "possible_errors", "similar_examples")
+
+# 最近若干次AI调用的统计数据（图片体积、耗时），用于调优上面的参数
+AI_CALL_STATS = deque(maxlen=200)
 # --- 2. 初始化 OpenAI 客户端 ---
 # 使用获取到的配置来初始化一个可以与API通信的客户端实例
 # 注意：我们使用了 base_url 参数，使其可以与非官方OpenAI的兼容API端点通信
-# --- 2. 初始化 OpenAI 客户端 (已更新为支持代理) ---
+# 连接池、超时、HTTP/2、代理和失败重试由 ai_transport 统一配置
 try:
-    # 3. 如果配置了代理，则创建一个带代理的 httpx 客户端
     if PROXY_URL:
         print(f"Using proxy: {PROXY_URL}")
-        proxies = {
-            "http://": PROXY_URL,
-            "https://": PROXY_URL,
-        }
-        http_client = httpx.Client(proxies=proxies)
-    else:
-        http_client = None
-
-    # 4. 将 http_client 传递给 OpenAI 客户端
-    client = OpenAI(
-        api_key=API_KEY,
-        base_url=API_URL,
-        http_client=http_client  # <-- 关键改动
-    )
+    client = ai_transport.create_client(API_KEY, API_URL, PROXY_URL)
     print("OpenAI client initialized successfully.")
 
 except Exception as e:
     print(f"Error initializing OpenAI client: {e}")
     client = None
 
+_async_client = None
+
+
+def get_async_client():
+    """懒加载与 client 配置相同的异步客户端（供异步代码使用）。"""
+    global _async_client
+    if _async_client is None:
+        _async_client = ai_transport.create_async_client(API_KEY, API_URL, PROXY_URL)
+    return _async_client
+
+
 def encode_image_to_base64(image_bytes: bytes) -> str:
     """
     将图片文件的二进制数据编码为Base64字符串。
@@ -55,13 +88,123 @@ def encode_image_to_base64(image_bytes: bytes) -> str:
     """
     return base64.b64encode(image_bytes).decode('utf-8')
 
-def analyze_question_with_ai(image_base64: str, user_question: str = "") -> dict:
+
+def _flatten_transparency(image):
+    """
+    把带透明通道的图片（RGBA/LA/带透明色的 P 模式等）铺到白色背景上。
+    直接 convert("RGB") 会把透明区域变成黑色，透明背景上的黑字就成了黑底黑字。
+    """
+    from PIL import Image
+
+    if not image.has_transparency_data:
+        return image
+    rgba = image.convert("RGBA")
+    return Image.alpha_composite(Image.new("RGBA", rgba.size, "white"), rgba).convert("RGB")
+
+
+def _trim_blank_margins(image):
+    """裁掉图片四周接近白色的空白边，保留少量留白。"""
+    from PIL import ImageOps
+
+    gray = image.convert("L")
+    # 反相后，背景接近 0，有内容的像素为正值
+    mask = ImageOps.invert(gray).point(lambda p: 255 if p > 255 - _TRIM_BACKGROUND_THRESHOLD else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(left - _TRIM_PADDING, 0),
+        max(top - _TRIM_PADDING, 0),
+        min(right + _TRIM_PADDING, image.width),
+        min(bottom + _TRIM_PADDING, image.height),
+    ))
+
+
+def prepare_image_for_ai(image_bytes: bytes) -> tuple:
+    """
+    在发送给AI之前压缩图片：识别真实格式、摆正方向、透明背景铺白、裁掉空白边、
+    缩放到 AI_IMAGE_MAX_EDGE 以内、可选转灰度，并重新压缩为 JPEG。
+    原始图片不受影响，仍按原样存入图片仓库。
+
+    Returns:
+        (图片的Base64字符串, MIME类型, 统计信息字典)
+    """
+    started = time.perf_counter()
+    original_mime = image_store.detect_image_mime(image_bytes)
+    stats = {
+        "original_mime": original_mime,
+        "bytes_before": len(image_bytes),
+    }
+
+    try:
+        from PIL import Image, ImageOps
+
+        with Image.open(io.BytesIO(image_bytes)) as opened:
+            stats["size_before"] = list(opened.size)
+            image = _flatten_transparency(ImageOps.exif_transpose(opened))
+            if AI_IMAGE_TRIM:
+                image = _trim_blank_margins(image)
+            image.thumbnail((AI_IMAGE_MAX_EDGE, AI_IMAGE_MAX_EDGE), Image.LANCZOS)
+            image = image.convert("L" if AI_IMAGE_GRAYSCALE else "RGB")
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=AI_IMAGE_QUALITY, optimize=True)
+            processed_bytes = buffer.getvalue()
+            stats["size_after"] = list(image.size)
+
+        if len(processed_bytes) < len(image_bytes) or stats["size_after"] != stats["size_before"]:
+            payload, mime = processed_bytes, "image/jpeg"
+        else:
+            # 原图已经足够小，重新压缩反而更大，直接发送原图
+            payload, mime = image_bytes, original_mime
+    except Exception as e:
+        # Pillow 无法处理的格式（例如部分 HEIC）直接发送原图
+        print(f"Image preprocessing skipped: {e}")
+        payload, mime = image_bytes, original_mime
+
+    stats["mime"] = mime
+    stats["bytes_after"] = len(payload)
+    stats["preprocess_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return encode_image_to_base64(payload), mime, stats
+
+
+def _record_ai_call_stats(kind: str, stats: dict, started: float):
+    """记录一次AI调用的统计数据（包含请求耗时），并打印一行摘要。"""
+    stats = dict(stats, kind=kind, latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                 at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    AI_CALL_STATS.append(stats)
+    if "bytes_before" in stats:
+        print(f"[ai-stats] {kind}: image {stats['bytes_before']} -> {stats['bytes_after']} bytes "
+              f"({stats.get('mime')}), preprocess {stats['preprocess_ms']} ms, request {stats['latency_ms']} ms")
+    else:
+        print(f"[ai-stats] {kind}: request {stats['latency_ms']} ms")
+
+
+def get_ai_call_stats() -> list:
+    """返回最近的AI调用统计数据（从旧到新）。"""
+    return list(AI_CALL_STATS)
+
+def analyze_question_with_ai(image_bytes: bytes, user_question: str = "", bypass_cache: bool = False) -> dict:
     """
     【已更新】调用AI模型分析错题图片，并一次性返回包括关键词在内的所有结构化解析结果。
+    相同图片和相同疑问的结果会被缓存；bypass_cache=True 时（重新生成）强制请求AI并刷新缓存。
     """
-    if not client:
-        return {"error": "AI client is not initialized."}
+    return ai_cache.cached_call(
+        "analysis", _analysis_cache_key(image_bytes, user_question),
+        lambda: _request_question_analysis(image_bytes, user_question), bypass_cache
+    )
+
+
+def _analysis_cache_key(image_bytes: bytes, user_question: str) -> str:
+    return ai_cache.make_key(
+        "analysis", ai_cache.hash_text(image_store.compute_image_hash(image_bytes), user_question),
+        ANALYSIS_PROMPT_VERSION, AI_MODEL,
+    )
+
 
+def _build_analysis_messages(image_bytes: bytes, user_question: str) -> tuple:
+    """组装错题分析的请求消息（图片会先经过 prepare_image_for_ai 压缩），返回 (messages, 图片统计)。"""
     prompt_text = """
     你是一个大学老师师，你善于用直观的方法的为学生解释问题。你会的知识包括但不限于高等数学、物理化学、材料分析测试方法、材料科学基础。你喜欢苏格რ底式启发式教育，你觉得这有利于学生理解问题。
 
@@ -90,27 +233,53 @@ def analyze_question_with_ai(image_base64: str, user_question: str = "") -> dict
     if user_question:
         prompt_text += f"\n请特别注意，学生对这道题有以下疑问，请在你的分析中侧重解答：'{user_question}'"
 
+    image_base64, image_mime, image_stats = prepare_image_for_ai(image_bytes)
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": prompt_text},
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{image_mime};base64,{image_base64}"
+                    },
+                },
+            ],
+        }
+    ]
+    return messages, image_stats
+
+
+def _normalize_analysis_result(ai_result_json: dict) -> dict:
+    """从AI返回的JSON中取出错题分析需要的字段，缺失的字段使用默认值。"""
+    # 【修改】返回包含新 keywords 字段的完整解析结果
+    return {
+        "problem_analysis": ai_result_json.get("problem_analysis", "AI未提供题目解析。"),
+        "keywords": ai_result_json.get("keywords"), # 新增
+        "knowledge_points": ai_result_json.get("knowledge_points", []),
+        "possible_errors": ai_result_json.get("possible_errors", []),
+        "similar_examples": ai_result_json.get("similar_examples", [])
+    }
+
+
+def _request_question_analysis(image_bytes: bytes, user_question: str) -> dict:
+    """向AI请求错题分析。"""
+    if not client:
+        return {"error": "AI client is not initialized."}
+
+    messages, image_stats = _build_analysis_messages(image_bytes, user_question)
+
     try:
         print("Sending request to AI API for full analysis...")
+        started = time.perf_counter()
         response = client.chat.completions.create(
             model=AI_MODEL,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt_text},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
-                            },
-                        },
-                    ],
-                }
-            ],
+            messages=messages,
             response_format={"type": "json_object"},
             max_tokens=16384,
         )
+        _record_ai_call_stats("analysis", image_stats, started)
         print("AI full analysis received.")
         
         ai_result_str = response.choices[0].message.content
@@ -126,40 +295,120 @@ def analyze_question_with_ai(image_base64: str, user_question: str = "") -> dict
             print(error_message)
             return {"error": error_message}
         
-        # 【修改】返回包含新 keywords 字段的完整解析结果
-        return {
-            "problem_analysis": ai_result_json.get("problem_analysis", "AI未提供题目解析。"),
-            "keywords": ai_result_json.get("keywords"), # 新增
-            "knowledge_points": ai_result_json.get("knowledge_points", []),
-            "possible_errors": ai_result_json.get("possible_errors", []),
-            "similar_examples": ai_result_json.get("similar_examples", [])
-        }
+        return _normalize_analysis_result(ai_result_json)
 
     except Exception as e:
         print(f"An error occurred during AI analysis: {e}")
         return {"error": str(e)}
 
 
+def stream_question_analysis(image_bytes: bytes, user_question: str = "", on_field=None, on_partial=None,
+                             partial_interval: float = 1.0, bypass_cache: bool = False) -> dict:
+    """
+    analyze_question_with_ai 的流式版本：以 stream=True 请求AI，边接收边增量解析返回的 JSON。
+    - 每当 STREAMED_ANALYSIS_FIELDS 中的某个字段完整到达，调用 on_field(字段名, 值)；
+    - 字符串字段生成过程中，最多每 partial_interval 秒调用一次 on_partial(字段名, 已生成的文本)。
+    返回值与 analyze_question_with_ai 相同（共用同一份缓存，命中时所有字段会立即通过 on_field 送出）。
+    """
+    key = _analysis_cache_key(image_bytes, user_question)
+    if not bypass_cache:
+        cached = ai_cache.get("analysis", key)
+        if cached is not None:
+            if on_field:
+                for field in STREAMED_ANALYSIS_FIELDS:
+                    on_field(field, cached.get(field))
+            return cached
+
+    if not client:
+        return {"error": "AI client is not initialized."}
+
+    messages, image_stats = _build_analysis_messages(image_bytes, user_question)
+    parser = StreamingObjectParser()
+    chunks = []
+
+    try:
+        print("Sending stream request to AI API for full analysis...")
+        started = time.perf_counter()
+        first_content_at = last_partial_at = None
+        response = client.chat.completions.create(
+            model=AI_MODEL,
+            messages=messages,
+            response_format={"type": "json_object"},
+            max_tokens=16384,
+            stream=True,
+            timeout=ai_transport.STREAM_TIMEOUT,
+        )
+        for chunk in response:
+            if not chunk.choices:
+                continue
+            content = chunk.choices[0].delta.content or ""
+            if not content:
+                continue
+            now = time.perf_counter()
+            if first_content_at is None:
+                first_content_at = now
+            chunks.append(content)
+            for field, value in parser.feed(content):
+                if on_field and field in STREAMED_ANALYSIS_FIELDS:
+                    on_field(field, value)
+            if on_partial and (last_partial_at is None or now - last_partial_at >= partial_interval):
+                partial = parser.partial_string()
+                if partial and partial[0] in STREAMED_ANALYSIS_FIELDS:
+                    on_partial(*partial)
+                    last_partial_at = now
+
+        image_stats = dict(image_stats)
+        if first_content_at is not None:
+            image_stats["first_content_ms"] = round((first_content_at - started) * 1000, 1)
+        _record_ai_call_stats("analysis_stream", image_stats, started)
+        print(f"AI streamed analysis received (first content after {image_stats.get('first_content_ms')} ms).")
+    except Exception as e:
+        print(f"An error occurred during streamed AI analysis: {e}")
+        return {"error": str(e)}
+
+    ai_result_str = "".join(chunks)
+    try:
+        ai_result_json = json.loads(ai_result_str)
+    except json.JSONDecodeError:
+        # 模型偶尔会在 JSON 外面包一层代码块标记；增量解析器会跳过这些内容
+        if not parser.done:
+            error_message = f"AI返回的不是有效的JSON格式。原始响应内容: '{ai_result_str[:500]}...'"
+            print(error_message)
+            return {"error": error_message}
+        ai_result_json = parser.fields
+
+    result = _normalize_analysis_result(ai_result_json)
+    ai_cache.put("analysis", key, result)
+    return result
+
+
 
-def process_new_question(image_bytes: bytes, subject: str, user_question: str = "") -> dict:
+def process_new_question(image_bytes: bytes, subject: str, user_question: str = "", bypass_cache: bool = False) -> dict:
     """
     【已更新】处理一个新的错题上传请求的完整流程，现在会包含关键词。
     """
-    # 1. 将图片编码为Base64
-    image_b64 = encode_image_to_base64(image_bytes)
-    
-    # 2. 调用AI进行分析 (新函数会返回包含关键词的结果)
-    ai_analysis_result = analyze_question_with_ai(image_b64, user_question)
+    # 1. 调用AI进行分析 (图片会先压缩，新函数会返回包含关键词的结果)
+    ai_analysis_result = analyze_question_with_ai(image_bytes, user_question, bypass_cache)
 
     if "error" in ai_analysis_result:
         return ai_analysis_result
 
+    # 2. 分析成功后把原图写入图片仓库（相同图片只存一份），数据库中只记录哈希
+    image_hash = image_store.save_image(image_bytes)
+    image_store.enqueue_variants(image_hash)
+
     # 3. 组装最终的数据结构
+    return build_question_data(ai_analysis_result, image_hash, subject, user_question)
+
+
+def build_question_data(ai_analysis_result: dict, image_hash: str, subject: str, user_question: str = "",
+                        upload_date: str = None) -> dict:
+    """把 analyze_question_with_ai 的结果组装为 database.add_question 需要的数据结构。"""
     final_data = {
-        "original_image_b64": image_b64,
+        "image_hash": image_hash,
         "subject": subject,
         "user_question": user_question,
-        "upload_date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "upload_date": upload_date or datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
         "problem_analysis": ai_analysis_result.get("problem_analysis"),
         "keywords": ai_analysis_result.get("keywords"), # 【新增】将关键词添加到数据结构中
         "knowledge_points": json.dumps(ai_analysis_result.get("knowledge_points", []), ensure_ascii=False),
@@ -171,14 +420,35 @@ def process_new_question(image_bytes: bytes, subject: str, user_question: str =
 
 # 在 core.py 文件中
 
-def generate_daily_summary_with_ai(yesterday_questions_text: str) -> dict:
+def generate_daily_summary_with_ai(yesterday_questions_text: str, bypass_cache: bool = False) -> dict:
     """
-    调用AI模型对昨日学习内容进行总结。
-    (增强了JSON解析的健壮性和回退机制)
+    调用AI模型对昨日学习内容进行总结。当天的错题没有变化时直接返回缓存的总结。
     """
-    if not client:
-        return {"error": "AI client is not initialized."}
+    key = ai_cache.make_key(
+        "daily_summary", ai_cache.hash_text(yesterday_questions_text), DAILY_SUMMARY_PROMPT_VERSION, AI_MODEL
+    )
+    return ai_cache.cached_call(
+        "daily_summary", key, lambda: _request_daily_summary(yesterday_questions_text), bypass_cache
+    )
+
+
+# 每日总结和合并总结共用的输出格式
+_SUMMARY_FORMAT_INSTRUCTIONS = """请严格按照以下JSON格式返回你的总结报告，不要添加任何额外的解释或文字包裹。你的回答必须是一个完整的、可以被直接解析的JSON对象。
+    {
+      "general_summary": "在这里用2-3句话对昨日学习的整体内容进行一个高度概括的总结（总纲）。",
+      "knowledge_points_summary": [
+        "在这里列出昨日错题反映出的第一个核心知识点或薄弱环节。",
+        "在这里列出第二个核心知识点或薄弱环节。",
+        "在这里列出第三个核心知识点或薄弱环节。"
+      ]
+    }"""
+
 
+def _request_daily_summary(yesterday_questions_text: str) -> dict:
+    """
+    向AI请求每日总结。
+    (增强了JSON解析的健壮性和回退机制)
+    """
     prompt_text = f"""
     你是一位资深的私人学习导师。你的任务是根据学生昨日的错题记录，为他生成一份简洁、精炼、有洞察力的学习总结报告。
 
@@ -187,26 +457,27 @@ def generate_daily_summary_with_ai(yesterday_questions_text: str) -> dict:
     {yesterday_questions_text}
     ---
 
-    请严格按照以下JSON格式返回你的总结报告，不要添加任何额外的解释或文字包裹。你的回答必须是一个完整的、可以被直接解析的JSON对象。
-    {{
-      "general_summary": "在这里用2-3句话对昨日学习的整体内容进行一个高度概括的总结（总纲）。",
-      "knowledge_points_summary": [
-        "在这里列出昨日错题反映出的第一个核心知识点或薄弱环节。",
-        "在这里列出第二个核心知识点或薄弱环节。",
-        "在这里列出第三个核心知识点或薄弱环节。"
-      ]
-    }}
+    {_SUMMARY_FORMAT_INSTRUCTIONS}
     """
+    return _request_summary_json("daily_summary", prompt_text)
+
+
+def _request_summary_json(kind: str, prompt_text: str) -> dict:
+    """发送总结请求并把结果解析为 {"general_summary", "knowledge_points_summary"}，解析失败时降级为非结构化总结。"""
+    if not client:
+        return {"error": "AI client is not initialized."}
 
     try:
-        print("Sending request to AI API for daily summary...")
+        print(f"Sending request to AI API for {kind}...")
+        started = time.perf_counter()
         response = client.chat.completions.create(
             model=AI_MODEL,
             messages=[{"role": "user", "content": prompt_text}],
             response_format={"type": "json_object"},
             max_tokens=2048,
         )
-        print("AI daily summary received.")
+        _record_ai_call_stats(kind, {}, started)
+        print(f"AI {kind} received.")
         
         ai_result_str = response.choices[0].message.content
         
@@ -246,6 +517,131 @@ def generate_daily_summary_with_ai(yesterday_questions_text: str) -> dict:
         print(f"An error occurred during AI summary generation: {e}")
         return {"error": str(e)}
 
+
+# --- 错题较多的日子：分块总结再合并 ---
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算一段文本的 token 数：中日韩字符约 1 个 token，其它字符约 4 个一个 token。"""
+    cjk = sum(1 for ch in text if ord(ch) >= 0x2E80)
+    return cjk + (len(text) - cjk) // 4
+
+
+def chunk_texts(texts: list, budget: int) -> list:
+    """
+    按顺序把若干段文本贪心地装进若干块，每块的预估 token 数不超过 budget。
+    单独一段就超过 budget 时自成一块。返回 [[文本, ...], ...]。
+    """
+    chunks, current, used = [], [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if current and used + tokens > budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(text)
+        used += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def generate_daily_summary_from_digests(digests: list, bypass_cache: bool = False) -> dict:
+    """
+    根据当天每道错题的摘要生成每日总结。
+    摘要总量在 SUMMARY_CHUNK_TOKENS 以内时一次请求完成；否则把摘要分成若干块并行总结 (map)，
+    再把各块的小结逐层合并为最终的总结 (reduce)。每块的小结和每次合并的结果都单独缓存。
+    """
+    chunks = chunk_texts(digests, SUMMARY_CHUNK_TOKENS)
+    if len(chunks) <= 1:
+        return generate_daily_summary_with_ai("\n\n".join(digests), bypass_cache=bypass_cache)
+
+    print(f"Summarizing {len(digests)} questions in {len(chunks)} chunks...")
+    with ThreadPoolExecutor(max_workers=max(1, min(SUMMARY_MAP_WORKERS, len(chunks))),
+                            thread_name_prefix="summary-map") as executor:
+        partials = list(executor.map(
+            lambda item: _summarize_chunk("\n\n".join(item[1]), item[0], len(chunks), bypass_cache),
+            enumerate(chunks, 1)
+        ))
+        return _reduce_summaries(partials, executor, bypass_cache)
+
+
+def _summarize_chunk(chunk_text: str, index: int, total: int, bypass_cache: bool = False) -> dict:
+    """总结第 index 批（共 total 批）错题摘要（结果按内容和批次缓存，与整天的总结分开存放）。"""
+    key = ai_cache.make_key(
+        "daily_summary_chunk", ai_cache.hash_text(chunk_text, f"{index}/{total}"), DAILY_SUMMARY_PROMPT_VERSION, AI_MODEL
+    )
+    return ai_cache.cached_call(
+        "daily_summary_chunk", key, lambda: _request_chunk_summary(chunk_text, index, total), bypass_cache
+    )
+
+
+def _request_chunk_summary(chunk_text: str, index: int, total: int) -> dict:
+    """向AI请求某一批错题摘要的小结。"""
+    prompt_text = f"""
+    你是一位资深的私人学习导师。学生昨日的错题较多，已经按批次拆分，下面是第 {index} 批（共 {total} 批）错题的摘要。
+    这只是昨日错题的一部分：请只总结这一批错题反映出的知识点和薄弱环节，不要把它当作昨日学习的全部内容，
+    稍后各批次的小结会被合并为一份完整的报告。
+
+    第 {index} 批错题摘要：
+    ---
+    {chunk_text}
+    ---
+
+    {_SUMMARY_FORMAT_INSTRUCTIONS}
+    """
+    return _request_summary_json("daily_summary_chunk", prompt_text)
+
+
+def _format_partial_summary(summary: dict) -> str:
+    points = summary.get("knowledge_points_summary") or []
+    if not isinstance(points, list):
+        points = [str(points)]
+    return "\n".join([f"总纲：{summary.get('general_summary', '')}"] + [f"- {point}" for point in points])
+
+
+def _reduce_summaries(partials: list, executor, bypass_cache: bool = False) -> dict:
+    """把若干份小结逐层合并为一份；任何一步失败时返回第一个错误。"""
+    while True:
+        for partial in partials:
+            if "error" in partial:
+                return partial
+        if len(partials) == 1:
+            return partials[0]
+
+        groups = chunk_texts([_format_partial_summary(p) for p in partials], SUMMARY_CHUNK_TOKENS)
+        if len(groups) == len(partials):
+            # 每份小结都单独超过预算时，两两合并，保证每一轮数量都会减少
+            texts = [text for group in groups for text in group]
+            groups = [texts[i:i + 2] for i in range(0, len(texts), 2)]
+        partials = list(executor.map(lambda group: _merge_summaries(group, bypass_cache), groups))
+
+
+def _merge_summaries(partial_texts: list, bypass_cache: bool = False) -> dict:
+    """把一组小结合并为一份总结（结果按内容缓存）。"""
+    text = "\n\n".join(f"【第{i}部分】\n{partial}" for i, partial in enumerate(partial_texts, 1))
+    key = ai_cache.make_key(
+        "daily_summary_reduce", ai_cache.hash_text(text), DAILY_SUMMARY_PROMPT_VERSION, AI_MODEL
+    )
+    return ai_cache.cached_call(
+        "daily_summary_reduce", key, lambda: _request_summary_merge(text), bypass_cache
+    )
+
+
+def _request_summary_merge(partial_summaries_text: str) -> dict:
+    """向AI请求把按批次生成的若干份小结合并为一份每日总结。"""
+    prompt_text = f"""
+    你是一位资深的私人学习导师。学生昨日的错题较多，已经按批次分别生成了下面几份小结。
+    请把它们合并为一份简洁、精炼、有洞察力的学习总结报告：合并重复的知识点，保留最重要的薄弱环节。
+
+    各批次的小结如下：
+    ---
+    {partial_summaries_text}
+    ---
+
+    {_SUMMARY_FORMAT_INSTRUCTIONS}
+    """
+    return _request_summary_json("daily_summary_reduce", prompt_text)
+
+
 def chat_with_ai_stream(messages: list):
     """
     与AI进行流式聊天。
@@ -279,6 +675,7 @@ def chat_with_ai_stream(messages: list):
             model=AI_MODEL,
             messages=messages_with_system_prompt,
             stream=True,  # <-- 关键：开启流式响应
+            timeout=ai_transport.STREAM_TIMEOUT,
             max_tokens=4096
         )
 
@@ -293,10 +690,21 @@ def chat_with_ai_stream(messages: list):
 
 
 # 【新增】为图片生成关键词
-def generate_keywords_for_image(image_base64: str) -> dict:
+def generate_keywords_for_image(image_bytes: bytes, bypass_cache: bool = False) -> dict:
     """
     调用AI模型分析错题图片，并返回结构化的关键词。
+    以图搜图时同一张图片的关键词直接从缓存返回，不再请求AI。
     """
+    key = ai_cache.make_key(
+        "image_keywords", image_store.compute_image_hash(image_bytes), IMAGE_KEYWORDS_PROMPT_VERSION, AI_MODEL
+    )
+    return ai_cache.cached_call(
+        "image_keywords", key, lambda: _request_image_keywords(image_bytes), bypass_cache
+    )
+
+
+def _request_image_keywords(image_bytes: bytes) -> dict:
+    """向AI请求图片的关键词（图片会先经过 prepare_image_for_ai 压缩）。"""
     if not client:
         return {"error": "AI client is not initialized."}
 
@@ -310,8 +718,11 @@ def generate_keywords_for_image(image_base64: str) -> dict:
     又例如，如果图片内容是关于微积分的，你的输出应该是：[高等数学]-[微积分]-[洛必达法则, 极限求解, 导数应用]
     """
 
+    image_base64, image_mime, image_stats = prepare_image_for_ai(image_bytes)
+
     try:
         print("Sending request to AI API for image keyword generation...")
+        started = time.perf_counter()
         response = client.chat.completions.create(
             model=AI_MODEL, # 使用 .env 中的模型
             messages=[
@@ -322,7 +733,7 @@ def generate_keywords_for_image(image_base64: str) -> dict:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{image_base64}"
+                                "url": f"data:{image_mime};base64,{image_base64}"
                             },
                         },
                     ],
@@ -331,6 +742,7 @@ def generate_keywords_for_image(image_base64: str) -> dict:
             max_tokens=200,
             temperature=0.1,
         )
+        _record_ai_call_stats("image_keywords", image_stats, started)
         print("AI response received for image keywords.")
         
         keywords = response.choices[0].message.content.strip()
@@ -341,6 +753,56 @@ def generate_keywords_for_image(image_base64: str) -> dict:
         return {"error": str(e)}
 
 
+def generate_keywords_for_text(analysis_text: str) -> dict:
+    """
+    调用AI模型为错题的解析文本生成结构化的关键词（用于给旧数据补全 keywords）。
+    返回 {"keywords": 关键词字符串, "tokens": 本次请求消耗的 token 数}，失败时返回 {"error": ...}。
+    """
+    if not client:
+        return {"error": "AI client is not initialized."}
+    if not analysis_text or not analysis_text.strip():
+        return {"error": "Input text is empty."}
+
+    prompt = f"""
+    你是一个信息检索专家。你的任务是根据下面提供的错题解析文本，提取出最核心的关键词。
+    请严格按照以下格式输出，不要有任何多余的解释、前言或结尾。
+
+    格式要求: [主要科目]-[知识面]-[关键词1, 关键词2, 关键词3]
+
+    例如，如果文本是关于电化学的，你的输出应该是：[物理化学]-[电化学]-[能斯特方程的应用, 平均离子活度, 吉布斯自由能]
+    又例如，如果文本是关于微积分的，你的输出应该是：[高等数学]-[微积分]-[洛必达法则, 极限求解, 导数应用]
+
+    现在，请为以下文本生成关键词：
+    ---
+    {analysis_text}
+    ---
+    """
+
+    try:
+        started = time.perf_counter()
+        response = client.chat.completions.create(
+            model=AI_MODEL,
+            messages=[
+                {"role": "system", "content": "你是一个信息检索专家，严格按照指定格式输出。"},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=100,
+            temperature=0.1, # 使用较低的温度以获得更稳定、格式更一致的输出
+        )
+        _record_ai_call_stats("text_keywords", {}, started)
+
+        keywords = response.choices[0].message.content.strip()
+        # 简单的格式验证：格式不对也可能有用，只打印警告
+        if not (keywords.startswith('[') and ']-[' in keywords and keywords.endswith(']')):
+            print(f"Warning: AI returned keywords in an unexpected format: {keywords}")
+        usage = getattr(response, "usage", None)
+        return {"keywords": keywords, "tokens": getattr(usage, "total_tokens", None)}
+
+    except Exception as e:
+        print(f"An error occurred during AI keyword generation: {e}")
+        return {"error": str(e)}
+
+
 # --- 这是一个用于独立测试本模块功能的示例 ---
 if __name__ == '__main__':
     # 使用方法：
@@ -383,8 +845,7 @@ if __name__ == '__main__':
                     print(f"  例题{i}: {ex['question']}")
                     print(f"  答案{i}: {ex['answer']}")
                 
-                # 为了简洁，不打印完整的base64字符串
-                print(f"原图片 (Base64): {processed_data['original_image_b64'][:50]}...")
+                print(f"原图片哈希: {processed_data['image_hash']}")
 
     except FileNotFoundError:
         print("\n测试失败：请在项目根目录下放置一张名为 'test_problem.jpg' 的图片。")
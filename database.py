@@ -1,204 +1,858 @@
+import os
 import sqlite3
 import json
+import queue
+import threading
+import time
+import atexit
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
 import re
-from collections import defaultdict
+import glob
+import base64
+import binascii
+import zlib
+from collections import defaultdict, namedtuple, OrderedDict
+
+import image_store
+import markdown_render
 
 # 定义数据库文件的名称
 DATABASE_NAME = "database.db"
 
+# --- 连接池与 SQLite 调优参数 ---
+# 每个进程最多保留的空闲连接数
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# 遇到写锁时最多等待的毫秒数，超过才会报 "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "10000"))
+# 每个连接的页缓存大小 (KB)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+# 内存映射读取的上限 (字节)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# 每个连接缓存的预编译语句数量
+DB_STATEMENT_CACHE_SIZE = 256
+# 数据迁移每批处理的行数
+DB_MIGRATION_BATCH_SIZE = int(os.getenv("DB_MIGRATION_BATCH_SIZE", "200"))
+
+# --- 多用户：每个用户一个数据库文件 ---
+USER_DB_DIR = os.getenv("USER_DB_DIR", "user_dbs")
+# 每个进程最多同时打开的数据库文件数，超过后关闭最久未使用的
+USER_DB_MAX_OPEN = int(os.getenv("USER_DB_MAX_OPEN", "64"))
+# 每个用户数据库保留的空闲连接数（单个用户的并发很低，不需要 DB_POOL_SIZE 那么多）
+USER_DB_POOL_SIZE = int(os.getenv("USER_DB_POOL_SIZE", "2"))
+# 超过这么多秒未被访问的数据库会被关闭
+USER_DB_IDLE_SECONDS = int(os.getenv("USER_DB_IDLE_SECONDS", "600"))
+
+# --- 单写入线程与组提交 (可选) ---
+# 开启后，所有写操作交给每个数据库文件唯一的写入线程执行，
+# 在 DB_GROUP_COMMIT_MAX_DELAY_MS 内到达的写操作合并为一个事务提交。
+DB_WRITE_QUEUE = os.getenv("DB_WRITE_QUEUE", "false").lower() in ("1", "true", "yes")
+# 一次组提交最多包含的写操作数
+DB_GROUP_COMMIT_MAX_BATCH = int(os.getenv("DB_GROUP_COMMIT_MAX_BATCH", "64"))
+# 收到第一个写操作后最多再等待多少毫秒凑成一批
+DB_GROUP_COMMIT_MAX_DELAY_MS = int(os.getenv("DB_GROUP_COMMIT_MAX_DELAY_MS", "5"))
+# 写入线程空闲这么多秒后退出，下次有写操作时再启动
+DB_WRITER_IDLE_SECONDS = 30
+
+_USER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# --- 查询列投影 ---
+# 不同页面只需要部分字段，显式列出可以避免 SELECT * 把无关的大字段读进内存。
+# 列表视图：错题卡片上展示的字段（不含旧版内联图片 original_image_b64）
+QUESTION_LIST_COLUMNS = (
+    "id", "subject", "upload_date", "image_hash", "user_question", "problem_analysis",
+    "knowledge_points", "ai_analysis", "similar_examples", "my_insight", "keywords",
+)
+# 总结视图：生成每日总结只需要每道题的简短摘要（见 build_question_digest）
+QUESTION_SUMMARY_COLUMNS = ("id", "subject", "digest")
+# 列表视图 + 预渲染的解析 HTML（接口传入 render=html 时使用）
+QUESTION_HTML_COLUMNS = QUESTION_LIST_COLUMNS + ("problem_analysis_html",)
+# 粗心错误列表视图
+CARELESS_LIST_COLUMNS = ("id", "upload_date", "image_hash", "user_reflection")
+
+# --- 长文本字段的透明压缩 (可选) ---
+# AI 生成的解析、例题和每日总结是很长、重复度很高的 Markdown/JSON。
+# 开启 DB_COMPRESS_TEXT 后，这些字段以 "前缀 + zlib 压缩数据" 的 BLOB 形式写入；
+# 读取时由 _LazyRow 在字段真正被访问时才解压，未压缩的旧数据照常读取，两种格式可以共存。
+# 全文索引通过 SQL 函数 text_value() 保存解压后的原文，检索和摘要高亮不受影响。
+DB_COMPRESS_TEXT = os.getenv("DB_COMPRESS_TEXT", "false").lower() in ("1", "true", "yes")
+# 短于这个字节数的文本压缩收益很小，保持原样
+DB_COMPRESS_MIN_BYTES = int(os.getenv("DB_COMPRESS_MIN_BYTES", "200"))
+DB_COMPRESS_LEVEL = 6
+
+COMPRESSED_COLUMNS = {
+    "questions": ("problem_analysis", "ai_analysis", "similar_examples", "problem_analysis_html"),
+    "daily_summaries": ("general_summary", "knowledge_points_summary"),
+}
+
+# --- 预渲染的解析 HTML ---
+# 写入 problem_analysis 时同时把渲染好的 HTML 保存到 problem_analysis_html，
+# 页面和接口直接使用，不必每次浏览都重新解析 Markdown。关闭后该列留空，读取时按需渲染（带进程内缓存）。
+DB_STORE_RENDERED_HTML = os.getenv("DB_STORE_RENDERED_HTML", "true").lower() in ("1", "true", "yes")
+
+
+def render_analysis_html(problem_analysis):
+    """返回要写入 problem_analysis_html 的值：渲染并按需压缩后的 HTML；未开启预渲染时返回 None。"""
+    if not DB_STORE_RENDERED_HTML:
+        return None
+    return encode_text(markdown_render.render_markdown(problem_analysis))
+
+
+# --- JSON 字段 ---
+# 这些字段保存 JSON 数组文本，接口响应时不再解析、原样拼接进输出（见 app.attach_json_fields），
+# 因此写入数据库前（包括迁移旧数据和导入归档时）必须保证内容是合法的 JSON。
+QUESTION_JSON_COLUMNS = ("knowledge_points", "ai_analysis", "similar_examples")
+
+
+def _reject_json_constant(name):
+    # 标准库 json 默认接受 NaN/Infinity，它们不是合法的 JSON
+    raise ValueError(f"Invalid JSON constant: {name}")
+
+
+def normalize_json_text(value) -> str:
+    """内容是合法的 JSON 数组/对象文本时原样返回，否则（空值、截断或损坏的内容）返回 "[]"。"""
+    if not isinstance(value, str):
+        return "[]"
+    try:
+        parsed = json.loads(value, parse_constant=_reject_json_constant)
+    except ValueError:
+        return "[]"
+    return value if isinstance(parsed, (list, dict)) else "[]"
+
+
+# --- 每题摘要 ---
+# 每道错题写入时根据AI已经给出的结构化字段（关键词、知识点、易错点和解析开头）生成一段简短摘要，
+# 保存在 digest 列中。生成每日总结时只把摘要交给AI（见 core.generate_daily_summary_from_digests），
+# 不再把当天所有错题的完整解析拼进一个提示词。
+QUESTION_DIGEST_ANALYSIS_CHARS = int(os.getenv("QUESTION_DIGEST_ANALYSIS_CHARS", "300"))
+
+
+def _digest_list(value) -> str:
+    """把保存为 JSON 字符串（或已经是列表）的字段转换为 "a；b；c"。"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return value.strip()
+    if not isinstance(value, list):
+        return ""
+    return "；".join(str(item).strip() for item in value if item)
+
+
+def build_question_digest(question) -> str:
+    """
+    由一道错题的字段生成简短摘要，不调用AI。
+    question 可以是 add_question 的数据字典，也可以是包含相应列的查询结果。
+    """
+    def field(name):
+        try:
+            return question[name]
+        except (KeyError, IndexError):
+            return None
+
+    lines = [f"科目：{field('subject') or ''}"]
+    if field('keywords'):
+        lines.append(f"关键词：{field('keywords')}")
+    knowledge_points = _digest_list(field('knowledge_points'))
+    if knowledge_points:
+        lines.append(f"知识点：{knowledge_points}")
+    possible_errors = _digest_list(field('ai_analysis'))
+    if possible_errors:
+        lines.append(f"易错点：{possible_errors}")
+    analysis = re.sub(r"\s+", " ", field('problem_analysis') or "").strip()
+    if analysis:
+        if len(analysis) > QUESTION_DIGEST_ANALYSIS_CHARS:
+            analysis = analysis[:QUESTION_DIGEST_ANALYSIS_CHARS] + "…"
+        lines.append(f"解析：{analysis}")
+    return "\n".join(lines)
+
+
+# 压缩数据的前缀，最后一个字节是预置字典的版本号。
+# 预置字典一旦发布就不能再修改（否则旧数据无法解压），需要新字典时增加一个版本。
+_COMPRESSED_PREFIX = b"\x00zt"
+# 预置字典：AI 输出中反复出现的 JSON 结构、Markdown 标记、LaTeX 命令和常用中文措辞。
+# zlib 会优先匹配靠后的内容，所以最常见的片段放在最后。
+_ZLIB_DICTIONARIES = {
+    1: (
+        "\\begin{aligned} \\end{aligned} \\left( \\right) \\sqrt{ \\int_ \\sum_ \\lim_{ \\infty "
+        "\\partial \\Delta \\alpha \\beta \\theta \\lambda \\mu \\cdot \\times \\ln \\mathrm{ "
+        "\\text{ \\frac{ \\quad \\Rightarrow "
+        "物理化学 高等数学 材料科学基础 材料分析测试方法 热力学 电化学 动力学 微积分 "
+        "吉布斯自由能 化学势 平衡常数 反应速率 活化能 导数 积分 极限 级数 "
+        "单位换算错误 符号错误 概念混淆 公式记错 计算错误 审题不清 "
+        "容易犯的错误 考察的核心知识点 相似例题 解题思路 解题步骤 "
+        "首先 其次 然后 最后 因此 所以 根据 由于 可以得到 我们可以 需要注意 也就是说 "
+        "这道题 题目 答案 选项 公式 结论 为什么 "
+        "\n\n### 解题思路\n\n### 解题步骤\n\n### 结论\n\n**结论**：\n\n**为什么**？\n\n"
+        "\n1. **\n2. **\n3. **\n- **\n\n$$\n$$\n\n"
+        '[{"question": "", "answer": ""}, {"question": "'
+        '", "answer": "'
+        '"}, {"question": "'
+    ).encode("utf-8"),
+}
+_CURRENT_DICTIONARY_VERSION = 1
+
+
+def encode_text(value, compress: bool = None):
+    """
+    按需压缩一个文本字段（只在开启 DB_COMPRESS_TEXT 且压缩后确实更小时才压缩）。
+    compress 可以覆盖全局设置。返回 str（原样）或 bytes（前缀 + 压缩数据）。
+    """
+    if compress is None:
+        compress = DB_COMPRESS_TEXT
+    if not compress or not isinstance(value, str):
+        return value
+    raw = value.encode("utf-8")
+    if len(raw) < DB_COMPRESS_MIN_BYTES:
+        return value
+    compressor = zlib.compressobj(
+        DB_COMPRESS_LEVEL, zlib.DEFLATED, -15, zdict=_ZLIB_DICTIONARIES[_CURRENT_DICTIONARY_VERSION]
+    )
+    packed = (_COMPRESSED_PREFIX + bytes([_CURRENT_DICTIONARY_VERSION])
+              + compressor.compress(raw) + compressor.flush())
+    return packed if len(packed) < len(raw) else value
+
+
+def decode_text(value):
+    """把 encode_text 压缩过的字段还原为 str；其它值原样返回。"""
+    if type(value) is not bytes or not value.startswith(_COMPRESSED_PREFIX):
+        return value
+    version = value[len(_COMPRESSED_PREFIX)]
+    decompressor = zlib.decompressobj(-15, zdict=_ZLIB_DICTIONARIES[version])
+    data = value[len(_COMPRESSED_PREFIX) + 1:]
+    return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+
+class _LazyRow(sqlite3.Row):
+    """sqlite3.Row 的子类：压缩存储的字段在被访问时才解压，没有被访问的字段不产生任何开销。"""
+
+    def __getitem__(self, key):
+        return decode_text(super().__getitem__(key))
+
+    def __iter__(self):
+        for value in super().__iter__():
+            yield decode_text(value)
+
+
+def encode_cursor(row) -> str:
+    """把一页最后一条记录的 (upload_date, id) 编码为不透明的分页游标。"""
+    raw = json.dumps([row['upload_date'], row['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """解析 encode_cursor 生成的游标，格式不正确时抛出 ValueError。"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        upload_date, row_id = json.loads(raw)
+    except (binascii.Error, ValueError, TypeError) as e:
+        raise ValueError(f"Invalid pagination cursor: {cursor!r}") from e
+    if not isinstance(upload_date, str) or not isinstance(row_id, int):
+        raise ValueError(f"Invalid pagination cursor: {cursor!r}")
+    return upload_date, row_id
+
+
+def _fetch_page(cursor, query: str, params: list, limit: int) -> tuple:
+    """多取一条判断是否还有下一页，返回 (本页记录, 下一页游标或 None)。"""
+    cursor.execute(query, tuple(params) + (limit + 1,))
+    rows = cursor.fetchall()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def _column_list(columns, table_alias: str = "") -> str:
+    """把列名元组转换为 SELECT 子句；columns 为 None 时表示详情视图（全部列）。"""
+    if columns is None:
+        return f"{table_alias}*"
+    return ", ".join(f"{table_alias}{column}" for column in columns)
+
+class _PooledConnection(sqlite3.Connection):
+    """
+    连接池中的连接。
+    处于 transaction() 内部时，`with conn:` 退出不再提交，由外层事务统一提交或回滚。
+    """
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if getattr(_local, 'depth', 0) > 0:
+            return False
+        return super().__exit__(exc_type, exc_value, traceback)
+
+
+class _ConnectionPool:
+    """
+    一个简单的 SQLite 连接池（每个数据库文件一个）。
+    连接在创建时统一设置 WAL、同步级别、忙等待等参数，用完后放回池中复用，
+    避免每次调用都重新打开文件和执行 PRAGMA。
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.pid = os.getpid()
+        self.last_used = time.monotonic()
+        self.closed = False
+        # 每个数据库文件在本进程中第一次被访问时执行一次迁移
+        self.migrated = False
+        self.migrate_lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=_PooledConnection,
+        )
+        # 使用 sqlite3.Row（的子类）作为 row_factory，这样查询结果可以像字典一样通过列名访问，
+        # 压缩存储的字段在访问时自动解压
+        conn.row_factory = _LazyRow
+        # 供触发器使用：把可能被压缩的字段还原为原文（例如写入全文索引时）
+        conn.create_function("text_value", 1, decode_text, deterministic=True)
+        # WAL 模式下读写互不阻塞；NORMAL 同步级别在 WAL 下依然保证数据库一致性
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE_KB}")
+        conn.execute(f"PRAGMA mmap_size = {DB_MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        # 归还前回滚未提交的事务，保证下一个使用者拿到的是干净的连接
+        if conn.in_transaction:
+            conn.rollback()
+        # 连接池已被淘汰时，借出的连接在归还时直接关闭
+        if not self.closed and self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    def close_all(self):
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# 按数据库文件路径索引的连接池，按最近使用顺序排列（LRU）
+_pools = OrderedDict()
+_pools_pid = None
+_pool_lock = threading.Lock()
+_last_idle_check = 0.0
+# 每个线程当前租用的连接，同一请求内的多次调用复用同一个连接
+_local = threading.local()
+
+
+def is_valid_user_id(user_id: str) -> bool:
+    """用户 ID 只允许字母、数字、下划线和短横线，防止拼出任意文件路径。"""
+    return bool(user_id) and bool(_USER_ID_PATTERN.match(user_id))
+
+
+def get_user_database_path(user_id: str) -> str:
+    """返回某个用户的数据库文件路径，例如 user_dbs/user_demo.db。"""
+    if not is_valid_user_id(user_id):
+        raise ValueError(f"Invalid user id: {user_id!r}")
+    return os.path.join(USER_DB_DIR, f"user_{user_id}.db")
+
+
+def use_database(path: str = None):
+    """
+    把当前线程后续的数据库操作路由到指定的文件；path 为 None 时使用默认的 DATABASE_NAME。
+    如果当前线程还持有其它数据库的连接，会先归还。
+    """
+    if getattr(_local, 'depth', 0) > 0:
+        raise RuntimeError("Cannot switch databases inside a transaction")
+    if getattr(_local, 'db_path', None) != path:
+        release_db_connection()
+    _local.db_path = path
+
+
+def use_user_database(user_id: str):
+    """把当前线程的数据库操作路由到某个用户自己的数据库文件。"""
+    path = get_user_database_path(user_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    use_database(path)
+
+
+def current_database_path() -> str:
+    """返回当前线程正在使用的数据库文件路径。"""
+    return getattr(_local, 'db_path', None) or DATABASE_NAME
+
+
+def _evict_pools_locked() -> list:
+    """淘汰超出上限或长时间空闲的连接池（调用方需持有 _pool_lock），返回被淘汰的池。"""
+    global _last_idle_check
+    evicted = []
+    while len(_pools) > USER_DB_MAX_OPEN:
+        _, pool = _pools.popitem(last=False)
+        evicted.append(pool)
+
+    now = time.monotonic()
+    if now - _last_idle_check >= min(60, USER_DB_IDLE_SECONDS):
+        _last_idle_check = now
+        for path, pool in list(_pools.items()):
+            # 默认数据库常驻，不因空闲被关闭
+            if path != DATABASE_NAME and now - pool.last_used > USER_DB_IDLE_SECONDS:
+                evicted.append(_pools.pop(path))
+    return evicted
+
+
+def _get_pool() -> _ConnectionPool:
+    global _pools_pid
+    path = current_database_path()
+    with _pool_lock:
+        # gunicorn fork 出的 worker 不能复用父进程的连接，按进程号重建连接池
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(path)
+        if pool is None:
+            size = DB_POOL_SIZE if path == DATABASE_NAME else USER_DB_POOL_SIZE
+            pool = _pools[path] = _ConnectionPool(path, size)
+        else:
+            _pools.move_to_end(path)
+        pool.last_used = time.monotonic()
+        evicted = _evict_pools_locked()
+
+    for old_pool in evicted:
+        print(f"Closing idle database: {old_pool.path}")
+        old_pool.close_all()
+    _ensure_migrated(pool)
+    return pool
+
+
+def _ensure_migrated(pool: _ConnectionPool):
+    """数据库文件在本进程中第一次被访问时，把它升级到最新结构（已是最新时只读取一次版本号）。"""
+    if pool.migrated or getattr(_local, 'migrating', None) == pool.path:
+        return
+    with pool.migrate_lock:
+        if pool.migrated:
+            return
+        _local.migrating = pool.path
+        try:
+            migrate_db()
+        finally:
+            _local.migrating = None
+        pool.migrated = True
+
+
+def close_all_databases():
+    """关闭本进程打开的所有数据库连接（进程退出或测试结束时调用）。"""
+    release_db_connection()
+    with _pool_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+class _GroupCommitWriter:
+    """
+    某个数据库文件的写入线程。
+    调用方把写操作放进队列并拿到一个 Future；写入线程把短时间内到达的多个写操作
+    合并到同一个事务中提交（组提交）。每个写操作在自己的 SAVEPOINT 中执行，
+    失败时只回滚它自己，异常通过 Future 交还给调用方。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.pid = os.getpid()
+        self.alive = True
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name=f"db-writer:{path}", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        use_database(self.path)
+        _local.is_writer = True
+        try:
+            while True:
+                try:
+                    first = self.queue.get(timeout=DB_WRITER_IDLE_SECONDS)
+                except queue.Empty:
+                    # 与 submit_write 持有同一把锁，保证不会有写操作在线程退出后才入队
+                    with _writers_lock:
+                        if self.queue.empty():
+                            self.alive = False
+                            if _writers.get(self.path) is self:
+                                del _writers[self.path]
+                            return
+                    continue
+
+                batch = [first]
+                deadline = time.monotonic() + DB_GROUP_COMMIT_MAX_DELAY_MS / 1000
+                while len(batch) < DB_GROUP_COMMIT_MAX_BATCH:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                self._commit(batch)
+        finally:
+            release_db_connection()
+
+    def _commit(self, batch: list):
+        outcomes = []
+        try:
+            with transaction() as conn:
+                for future, op, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with transaction():
+                            outcomes.append((future, op(conn, *args), None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+        except Exception as e:
+            # 提交本身失败（例如磁盘已满），这一批的写操作全部失败
+            print(f"Group commit of {len(batch)} writes to {self.path} failed: {e}")
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def submit_write(op, *args) -> Future:
+    """
+    把写操作 op(conn, *args) 交给当前数据库文件的写入线程，立即返回 Future。
+    Future 的结果是 op 的返回值；op 抛出的异常（或提交失败）会通过 Future 抛给调用方。
+    """
+    path = current_database_path()
+    future = Future()
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None or not writer.alive or writer.pid != os.getpid():
+            writer = _writers[path] = _GroupCommitWriter(path)
+        writer.queue.put((future, op, args))
+    return future
+
+
+def _write(op, *args):
+    """
+    执行一个写操作并返回 op 的结果。
+    开启 DB_WRITE_QUEUE 时交给写入线程组提交；已经处在事务中（或本身就是写入线程）时直接执行，
+    否则在当前线程开启一个事务执行。
+    """
+    if DB_WRITE_QUEUE and getattr(_local, 'depth', 0) == 0 and not getattr(_local, 'is_writer', False):
+        return submit_write(op, *args).result()
+    with transaction() as conn:
+        return op(conn, *args)
+
+
+def flush_writes():
+    """等待所有写入线程中已排队的写操作完成。"""
+    with _writers_lock:
+        paths = [path for path, writer in _writers.items() if writer.alive and writer.pid == os.getpid()]
+    for path in paths:
+        previous = getattr(_local, 'db_path', None)
+        _local.db_path = path
+        try:
+            submit_write(lambda conn: None).result()
+        finally:
+            _local.db_path = previous
+
+
+atexit.register(flush_writes)
+
+
 def get_db_connection():
     """
-    创建一个数据库连接。
-    使用 sqlite3.Row 作为 row_factory，这样查询结果可以像字典一样通过列名访问。
+    获取当前线程的数据库连接（连接的是 use_database 选定的数据库文件）。
+    同一线程（即同一个请求）内的多次调用返回同一个连接，直到 release_db_connection 被调用。
+    连接仍然可以用作 `with get_db_connection() as conn:`，退出时提交或回滚，但不会关闭。
     """
-    conn = sqlite3.connect(DATABASE_NAME)
-    conn.row_factory = sqlite3.Row
+    pool = _get_pool()
+    conn = getattr(_local, 'conn', None)
+    if conn is not None and getattr(_local, 'pool', None) is pool:
+        return conn
+    if conn is not None:
+        release_db_connection()
+    conn = pool.acquire()
+    _local.conn, _local.pool, _local.depth = conn, pool, 0
     return conn
 
+
+def release_db_connection():
+    """把当前线程租用的连接还给连接池（在每个请求结束时调用）。"""
+    conn = getattr(_local, 'conn', None)
+    pool = getattr(_local, 'pool', None)
+    _local.conn = _local.pool = None
+    if conn is not None and pool is not None and pool.pid == os.getpid():
+        pool.release(conn)
+
+
+@contextmanager
+def transaction():
+    """
+    在当前线程的连接上开启一个写事务。
+    使用 BEGIN IMMEDIATE 在事务开始时就拿到写锁，避免读事务中途升级为写事务时
+    因锁冲突直接失败；嵌套调用时使用 SAVEPOINT。
+    """
+    conn = get_db_connection()
+    depth = getattr(_local, 'depth', 0)
+    savepoint = f"sp_{depth}"
+    if depth == 0:
+        if conn.in_transaction:
+            conn.commit()
+        conn.execute("BEGIN IMMEDIATE")
+    else:
+        conn.execute(f"SAVEPOINT {savepoint}")
+    _local.depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        if depth == 0:
+            conn.rollback()
+        else:
+            conn.execute(f"ROLLBACK TO {savepoint}")
+            conn.execute(f"RELEASE {savepoint}")
+        raise
+    else:
+        if depth == 0:
+            conn.commit()
+        else:
+            conn.execute(f"RELEASE {savepoint}")
+    finally:
+        _local.depth = depth
+
+# 最初版本的基础表，由第 1 个迁移步骤创建
+BASE_TABLE_DEFINITIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS questions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        subject TEXT NOT NULL,
+        upload_date TEXT NOT NULL,
+        original_image_b64 TEXT NOT NULL, -- 旧版内联图片，新记录留空，图片存于 image_store
+        image_hash TEXT, -- 图片在 image_store 中的 SHA-256
+        user_question TEXT, -- 新增：存储用户的原始疑问，用于重新生成
+        problem_analysis TEXT,
+        knowledge_points TEXT,
+        ai_analysis TEXT, -- 存储“可能的错误”
+        similar_examples TEXT -- 存储“相似例题”
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS daily_summaries (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        summary_date TEXT NOT NULL UNIQUE,
+        general_summary TEXT,
+        knowledge_points_summary TEXT,
+        question_count INTEGER,
+        subject_chart_data TEXT,
+        created_at TEXT NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS careless_mistakes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        upload_date TEXT NOT NULL,
+        original_image_b64 TEXT NOT NULL,
+        image_hash TEXT,
+        user_reflection TEXT NOT NULL
+    )
+    """,
+]
+
+
 def init_db():
     """
-    初始化数据库，创建错题表 (questions)。
-    这个函数应该在应用启动时被调用一次。
+    初始化数据库：创建所有表并把结构升级到最新版本。
+    这个函数应该在应用启动时被调用一次；数据库已是最新版本时几乎没有开销。
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS questions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                subject TEXT NOT NULL,
-                upload_date TEXT NOT NULL,
-                original_image_b64 TEXT NOT NULL,
-                user_question TEXT, -- 新增：存储用户的原始疑问，用于重新生成
-                problem_analysis TEXT,
-                knowledge_points TEXT,
-                ai_analysis TEXT, -- 存储“可能的错误”
-                similar_examples TEXT -- 存储“相似例题”
-            );
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS daily_summaries (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                summary_date TEXT NOT NULL UNIQUE,
-                general_summary TEXT,
-                knowledge_points_summary TEXT,
-                question_count INTEGER,
-                subject_chart_data TEXT,
-                created_at TEXT NOT NULL
-            );
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS careless_mistakes (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                upload_date TEXT NOT NULL,
-                original_image_b64 TEXT NOT NULL,
-                user_reflection TEXT NOT NULL
-            );
-        """)
-        conn.commit()
-        print("Database initialized and 'questions' table is ready.")
+    migrate_db()
+    print("Database initialized and 'questions' table is ready.")
 
 # --- 数据写入/修改操作 ---
 
 # --- 【新增】为 careless_mistakes 表添加写入函数 ---
-def add_careless_mistake(mistake_data: dict):
-    """将一条粗心错误记录添加到数据库中。"""
+def add_careless_mistake(mistake_data: dict) -> int:
+    """将一条粗心错误记录添加到数据库中，返回新记录的 ID。写入失败时抛出 sqlite3.Error。"""
     sql = """
         INSERT INTO careless_mistakes (
-            upload_date, original_image_b64, user_reflection
-        ) VALUES (?, ?, ?);
+            upload_date, original_image_b64, image_hash, user_reflection
+        ) VALUES (?, ?, ?, ?);
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(sql, (
-                mistake_data.get('upload_date'),
-                mistake_data.get('original_image_b64'),
-                mistake_data.get('user_reflection')
-            ))
-            conn.commit()
-            print("Successfully added a new careless mistake.")
-        except sqlite3.Error as e:
-            print(f"Failed to add careless mistake to database. Error: {e}")
+    def op(conn):
+        return conn.execute(sql, (
+            mistake_data.get('upload_date'),
+            mistake_data.get('original_image_b64') or '',
+            mistake_data.get('image_hash'),
+            mistake_data.get('user_reflection')
+        )).lastrowid
 
-# --- 【新增】为 careless_mistakes 表添加查询函数 (支持分页) ---
-def get_careless_mistakes(limit: int, offset: int) -> list:
-    """分页获取所有粗心错误记录。"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        query = "SELECT * FROM careless_mistakes ORDER BY upload_date DESC LIMIT ? OFFSET ?"
-        cursor.execute(query, (limit, offset))
-        return cursor.fetchall()
+    mistake_id = _write(op)
+    print("Successfully added a new careless mistake.")
+    return mistake_id
 
-def add_question(question_data: dict):
+# --- 【新增】为 careless_mistakes 表添加查询函数 (支持分页) ---
+def get_careless_mistakes(limit: int, cursor: str = None, columns=CARELESS_LIST_COLUMNS) -> tuple:
     """
-    【已更新】将一个处理好的错题数据字典（包含关键词）添加到数据库中。
+    按游标分页获取粗心错误记录（按 (upload_date, id) 倒序）。
+    返回 (记录列表, 下一页游标)；columns 中必须包含 upload_date 和 id。
     """
+    with get_db_connection() as conn:
+        query = f"SELECT {_column_list(columns)} FROM careless_mistakes"
+        params = []
+        if cursor:
+            query += " WHERE (upload_date, id) < (?, ?)"
+            params.extend(decode_cursor(cursor))
+        query += " ORDER BY upload_date DESC, id DESC LIMIT ?"
+        return _fetch_page(conn.cursor(), query, params, limit)
+
+def _insert_question(conn, question_data: dict) -> int:
+    """在给定的连接（事务）中插入一条错题并建立关键词索引，返回新错题的 ID。"""
     sql = """
         INSERT INTO questions (
-            subject, upload_date, original_image_b64, user_question, problem_analysis, 
-            knowledge_points, ai_analysis, similar_examples, keywords
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+            subject, upload_date, original_image_b64, image_hash, user_question, problem_analysis, 
+            knowledge_points, ai_analysis, similar_examples, keywords, problem_analysis_html, digest
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(sql, (
-                question_data.get('subject'),
-                question_data.get('upload_date'),
-                question_data.get('original_image_b64'),
-                question_data.get('user_question'),
-                question_data.get('problem_analysis'),
-                question_data.get('knowledge_points'),
-                question_data.get('ai_analysis'),
-                question_data.get('similar_examples'),
-                question_data.get('keywords') # 【新增】添加 keywords 参数
-            ))
-            conn.commit()
-            print(f"Successfully added a new question for subject: {question_data.get('subject')}")
-        except sqlite3.Error as e:
-            print(f"Failed to add question to database. Error: {e}")
+    cursor = conn.execute(sql, (
+        question_data.get('subject'),
+        question_data.get('upload_date'),
+        question_data.get('original_image_b64') or '',
+        question_data.get('image_hash'),
+        question_data.get('user_question'),
+        encode_text(question_data.get('problem_analysis')),
+        normalize_json_text(question_data.get('knowledge_points')),
+        encode_text(normalize_json_text(question_data.get('ai_analysis'))),
+        encode_text(normalize_json_text(question_data.get('similar_examples'))),
+        question_data.get('keywords'), # 【新增】添加 keywords 参数
+        render_analysis_html(question_data.get('problem_analysis')),
+        build_question_digest(question_data)
+    ))
+    index_question_keywords(conn, cursor.lastrowid, question_data.get('keywords'))
+    return cursor.lastrowid
+
+
+def add_question(question_data: dict) -> int:
+    """
+    【已更新】将一个处理好的错题数据字典（包含关键词）添加到数据库中，返回新错题的 ID。
+    写入失败时抛出 sqlite3.Error。
+    """
+    question_id = _write(_insert_question, question_data)
+    print(f"Successfully added a new question for subject: {question_data.get('subject')}")
+    return question_id
 
 def update_question_analysis(question_id: int, new_data: dict):
-    """根据ID更新一条错题的AI分析相关字段"""
-    with get_db_connection() as conn:
+    """根据ID更新一条错题的AI分析相关字段（预渲染的 HTML 和摘要随解析一起刷新）"""
+    def op(conn):
         conn.execute('''
             UPDATE questions
             SET problem_analysis = ?,
                 knowledge_points = ?,
                 ai_analysis = ?,
-                similar_examples = ?
+                similar_examples = ?,
+                problem_analysis_html = ?,
+                digest = ?
             WHERE id = ?
         ''', (
-            new_data.get('problem_analysis'),
-            new_data.get('knowledge_points'),
-            new_data.get('ai_analysis'),
-            new_data.get('similar_examples'),
+            encode_text(new_data.get('problem_analysis')),
+            normalize_json_text(new_data.get('knowledge_points')),
+            encode_text(normalize_json_text(new_data.get('ai_analysis'))),
+            encode_text(normalize_json_text(new_data.get('similar_examples'))),
+            render_analysis_html(new_data.get('problem_analysis')),
+            build_question_digest(new_data),
             question_id
         ))
-        conn.commit()
+
+    _write(op)
 
 def delete_question(question_id: int):
     """根据ID删除一条错题记录"""
-    with get_db_connection() as conn:
-        conn.execute('DELETE FROM questions WHERE id = ?', (question_id,))
-        conn.commit()
+    _write(lambda conn: conn.execute('DELETE FROM questions WHERE id = ?', (question_id,)))
 
 # --- 数据查询操作 ---
 
-def get_question_by_id(question_id: int):
-    """根据ID获取一条错题记录的完整信息"""
+def get_question_by_id(question_id: int, columns=None):
+    """
+    根据ID获取一条错题记录。
+    默认返回完整信息（详情视图）；只需要部分字段时传入 columns 按需读取。
+    """
     with get_db_connection() as conn:
-        question = conn.execute('SELECT * FROM questions WHERE id = ?', (question_id,)).fetchone()
+        question = conn.execute(
+            f'SELECT {_column_list(columns)} FROM questions WHERE id = ?', (question_id,)
+        ).fetchone()
         return question
 
-def get_questions_by_subject(subject: str, limit: int, offset: int, start_date: str = None) -> list:
+def get_questions_by_subject(subject: str, limit: int, cursor: str = None, start_date: str = None,
+                             columns=QUESTION_LIST_COLUMNS) -> tuple:
     """
-    根据科目名称查询错题，支持分页和起始日期。
+    根据科目名称查询错题，支持游标分页和起始日期。
+    使用 (upload_date, id) 作为游标而不是 OFFSET，翻到多深每页的代价都一样，
+    中途有新增或删除时也不会出现重复或遗漏。
+    返回 (记录列表, 下一页游标)；columns 中必须包含 upload_date 和 id。
     """
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        query = "SELECT * FROM questions WHERE subject = ?"
+        query = f"SELECT {_column_list(columns)} FROM questions WHERE subject = ?"
         params = [subject]
         
         if start_date:
-            query += " AND date(upload_date) <= ?"
+            # 用范围比较代替 date(upload_date) <= ?，这样可以直接走 (subject, upload_date) 索引
+            query += " AND upload_date < date(?, '+1 day')"
             params.append(start_date)
-            
-        query += " ORDER BY upload_date DESC LIMIT ? OFFSET ?"
-        params.extend([limit, offset])
-        
-        cursor.execute(query, tuple(params))
-        return cursor.fetchall()
 
-def get_questions_by_date(date_str: str) -> list:
-    """获取指定日期的所有错题记录"""
+        if cursor:
+            query += " AND (upload_date, id) < (?, ?)"
+            params.extend(decode_cursor(cursor))
+
+        query += " ORDER BY upload_date DESC, id DESC LIMIT ?"
+        return _fetch_page(conn.cursor(), query, params, limit)
+
+def get_questions_by_date(date_str: str, columns=QUESTION_LIST_COLUMNS) -> list:
+    """获取指定日期的所有错题记录（生成总结时传入 QUESTION_SUMMARY_COLUMNS）"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM questions WHERE date(upload_date) = ?", (date_str,))
+        cursor.execute(f"SELECT {_column_list(columns)} FROM questions WHERE date(upload_date) = ?", (date_str,))
         return cursor.fetchall()
 
 def get_all_subjects() -> list:
-    """从数据库中查询出所有不重复的科目列表"""
+    """从科目汇总表中查询出所有不重复的科目列表"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT subject FROM questions ORDER BY subject ASC")
+        cursor.execute("SELECT subject FROM question_subject_counts ORDER BY subject ASC")
         return [row['subject'] for row in cursor.fetchall()]
 
 def get_all_question_dates() -> list:
     """获取所有不重复的错题日期列表，用于生成时间线"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT date(upload_date) as entry_date FROM questions ORDER BY entry_date DESC")
+        cursor.execute("SELECT DISTINCT day AS entry_date FROM question_daily_counts ORDER BY entry_date DESC")
         return [row['entry_date'] for row in cursor.fetchall()]
 
 # --- 统计与总结查询 ---
+# 首页的统计都读取由触发器维护的汇总表（见 ROLLUP_DEFINITIONS），
+# 开销只与天数、科目数有关，与累计的错题数量无关。
 
 def get_latest_question_date() -> str:
     """获取数据库中最新一条记录的日期 (YYYY-MM-DD)"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT MAX(date(upload_date)) FROM questions")
+        cursor.execute("SELECT MAX(day) FROM question_daily_counts")
         result = cursor.fetchone()
         return result[0] if result else None
 
@@ -207,72 +861,148 @@ def get_weekly_summary_stats() -> list:
     with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT date(upload_date) as entry_date, COUNT(id) as count
-            FROM questions
-            WHERE date(upload_date) >= date('now', '-6 days')
-            GROUP BY entry_date
-            ORDER BY entry_date ASC;
+            SELECT day as entry_date, SUM(count) as count
+            FROM question_daily_counts
+            WHERE day >= date('now', '-6 days')
+            GROUP BY day
+            ORDER BY day ASC;
         """)
         return cursor.fetchall()
 
+def get_subject_counts_by_date(date_str: str) -> list:
+    """返回指定日期（YYYY-MM-DD）中每个科目的错题数 [(subject, count), ...]。"""
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT subject, count FROM question_daily_counts WHERE day = ? AND count > 0 ORDER BY subject", (date_str,)
+        ).fetchall()
+
 def get_careless_count_by_date(date_str: str) -> int:
     """返回指定日期（YYYY-MM-DD）中粗心错误记录的数量。"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(id) as cnt FROM careless_mistakes WHERE date(upload_date) = ?", (date_str,))
+        cursor.execute("SELECT count AS cnt FROM careless_daily_counts WHERE day = ?", (date_str,))
         row = cursor.fetchone()
         return int(row['cnt']) if row else 0
 
-# 在 database.py 文件末尾添加这个新函数
+# 日期/科目查询所依赖的索引。
+# 按天过滤的查询统一写成 date(upload_date)，由表达式索引支持；
+# 按科目分页的查询由 (subject, upload_date) 复合索引支持。
+# 索引按升序建立：倒序扫描时 (upload_date, rowid) 正好是游标分页需要的
+# ORDER BY upload_date DESC, id DESC，无需额外排序。
+INDEX_DEFINITIONS = [
+    "CREATE INDEX IF NOT EXISTS idx_questions_day ON questions (date(upload_date))",
+    "CREATE INDEX IF NOT EXISTS idx_questions_upload ON questions (upload_date)",
+    "CREATE INDEX IF NOT EXISTS idx_questions_subject_upload ON questions (subject, upload_date)",
+    "CREATE INDEX IF NOT EXISTS idx_careless_day ON careless_mistakes (date(upload_date))",
+    "CREATE INDEX IF NOT EXISTS idx_careless_upload ON careless_mistakes (upload_date)",
+]
+
 
-def migrate_db():
+# 首页统计使用的汇总表，由插入/删除/更新触发器增量维护：
+# - question_daily_counts：每天、每个科目的错题数（时间线、每周统计、最新日期）
+# - question_subject_counts：每个科目的错题数（科目列表）
+# - careless_daily_counts：每天的粗心错误数
+# 计数减到 0 的行会被删除，这样"存在某一天/某个科目"等价于汇总表中有这一行。
+ROLLUP_DEFINITIONS = [
     """
-    检查并更新数据库表结构，以实现平滑升级。
+    CREATE TABLE IF NOT EXISTS question_daily_counts (
+        day TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (day, subject)
+    ) WITHOUT ROWID
+    """,
     """
-    print("Checking database schema...")
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        
-        # 1. 获取 'questions' 表的所有列信息
-        cursor.execute("PRAGMA table_info(questions)")
-        columns = [row['name'] for row in cursor.fetchall()]
-        
-        # 2. 检查 'user_question' 列是否存在
-        if 'user_question' not in columns:
-            try:
-                print("Column 'user_question' not found. Adding it now...")
-                # 使用 ALTER TABLE 添加新列，并设置一个默认值
-                cursor.execute("ALTER TABLE questions ADD COLUMN user_question TEXT DEFAULT ''")
-                conn.commit()
-                print("Successfully added 'user_question' column to the database.")
-            except sqlite3.Error as e:
-                print(f"Failed to add 'user_question' column. Error: {e}")
-        else:
-            print("Column 'user_question' already exists. No migration needed.")
+    CREATE TABLE IF NOT EXISTS question_subject_counts (
+        subject TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS careless_daily_counts (
+        day TEXT PRIMARY KEY,
+        count INTEGER NOT NULL
+    ) WITHOUT ROWID
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_rollup_insert AFTER INSERT ON questions BEGIN
+        INSERT INTO question_daily_counts (day, subject, count) VALUES (date(new.upload_date), new.subject, 1)
+            ON CONFLICT (day, subject) DO UPDATE SET count = count + 1;
+        INSERT INTO question_subject_counts (subject, count) VALUES (new.subject, 1)
+            ON CONFLICT (subject) DO UPDATE SET count = count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_rollup_delete AFTER DELETE ON questions BEGIN
+        UPDATE question_daily_counts SET count = count - 1
+            WHERE day = date(old.upload_date) AND subject = old.subject;
+        DELETE FROM question_daily_counts
+            WHERE day = date(old.upload_date) AND subject = old.subject AND count <= 0;
+        UPDATE question_subject_counts SET count = count - 1 WHERE subject = old.subject;
+        DELETE FROM question_subject_counts WHERE subject = old.subject AND count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_rollup_update AFTER UPDATE OF subject, upload_date ON questions BEGIN
+        UPDATE question_daily_counts SET count = count - 1
+            WHERE day = date(old.upload_date) AND subject = old.subject;
+        DELETE FROM question_daily_counts
+            WHERE day = date(old.upload_date) AND subject = old.subject AND count <= 0;
+        UPDATE question_subject_counts SET count = count - 1 WHERE subject = old.subject;
+        DELETE FROM question_subject_counts WHERE subject = old.subject AND count <= 0;
+        INSERT INTO question_daily_counts (day, subject, count) VALUES (date(new.upload_date), new.subject, 1)
+            ON CONFLICT (day, subject) DO UPDATE SET count = count + 1;
+        INSERT INTO question_subject_counts (subject, count) VALUES (new.subject, 1)
+            ON CONFLICT (subject) DO UPDATE SET count = count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS careless_rollup_insert AFTER INSERT ON careless_mistakes BEGIN
+        INSERT INTO careless_daily_counts (day, count) VALUES (date(new.upload_date), 1)
+            ON CONFLICT (day) DO UPDATE SET count = count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS careless_rollup_delete AFTER DELETE ON careless_mistakes BEGIN
+        UPDATE careless_daily_counts SET count = count - 1 WHERE day = date(old.upload_date);
+        DELETE FROM careless_daily_counts WHERE day = date(old.upload_date) AND count <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS careless_rollup_update AFTER UPDATE OF upload_date ON careless_mistakes BEGIN
+        UPDATE careless_daily_counts SET count = count - 1 WHERE day = date(old.upload_date);
+        DELETE FROM careless_daily_counts WHERE day = date(old.upload_date) AND count <= 0;
+        INSERT INTO careless_daily_counts (day, count) VALUES (date(new.upload_date), 1)
+            ON CONFLICT (day) DO UPDATE SET count = count + 1;
+    END
+    """,
+]
 
-        # 3. 检查 'my_insight' 列是否存在（用于存储用户的短注释 "我的灵光一闪"）
-        if 'my_insight' not in columns:
-            try:
-                print("Column 'my_insight' not found. Adding it now...")
-                cursor.execute("ALTER TABLE questions ADD COLUMN my_insight TEXT DEFAULT ''")
-                conn.commit()
-                print("Successfully added 'my_insight' column to the database.")
-            except sqlite3.Error as e:
-                print(f"Failed to add 'my_insight' column. Error: {e}")
-        else:
-            print("Column 'my_insight' already exists. No migration needed.")
+# 根据明细表重新计算汇总表。与建触发器放在同一个事务中执行，保证两者一致。
+ROLLUP_REBUILD_STATEMENTS = [
+    "DELETE FROM question_daily_counts",
+    "DELETE FROM question_subject_counts",
+    "DELETE FROM careless_daily_counts",
+    """
+    INSERT INTO question_daily_counts (day, subject, count)
+    SELECT date(upload_date), subject, COUNT(*) FROM questions GROUP BY date(upload_date), subject
+    """,
+    """
+    INSERT INTO question_subject_counts (subject, count)
+    SELECT subject, COUNT(*) FROM questions GROUP BY subject
+    """,
+    """
+    INSERT INTO careless_daily_counts (day, count)
+    SELECT date(upload_date), COUNT(*) FROM careless_mistakes GROUP BY date(upload_date)
+    """,
+]
 
-        # 【新增】检查 'keywords' 列是否存在
-        if 'keywords' not in columns:
-            try:
-                print("Column 'keywords' not found. Adding it now...")
-                cursor.execute("ALTER TABLE questions ADD COLUMN keywords TEXT") # 默认是 NULL
-                conn.commit()
-                print("Successfully added 'keywords' column to the database.")
-            except sqlite3.Error as e:
-                print(f"Failed to add 'keywords' column. Error: {e}")
-        else:
-            print("Column 'keywords' already exists. No migration needed.")
+
+def rebuild_rollups():
+    """从明细表重新计算所有汇总表（正常情况下触发器会保持一致，仅用于修复）。"""
+    with transaction() as conn:
+        for statement in ROLLUP_REBUILD_STATEMENTS:
+            conn.execute(statement)
 
 
 def add_daily_summary(summary_data: dict):
@@ -283,18 +1013,16 @@ def add_daily_summary(summary_data: dict):
             question_count, subject_chart_data, created_at
         ) VALUES (?, ?, ?, ?, ?, ?);
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(sql, (
-            summary_data['date'],
-            summary_data['ai_summary']['general_summary'],
-            json.dumps(summary_data['ai_summary']['knowledge_points_summary'], ensure_ascii=False),
-            summary_data['question_count'],
-            json.dumps(summary_data['subject_chart_data'], ensure_ascii=False),
-            datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        ))
-        conn.commit()
-        print(f"Saved daily summary for date: {summary_data['date']}")
+    params = (
+        summary_data['date'],
+        encode_text(summary_data['ai_summary']['general_summary']),
+        encode_text(json.dumps(summary_data['ai_summary']['knowledge_points_summary'], ensure_ascii=False)),
+        summary_data['question_count'],
+        json.dumps(summary_data['subject_chart_data'], ensure_ascii=False),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    )
+    _write(lambda conn: conn.execute(sql, params))
+    print(f"Saved daily summary for date: {summary_data['date']}")
 
 def get_summary_by_date(date_str: str):
     """根据日期从数据库获取已保存的总结"""
@@ -304,28 +1032,26 @@ def get_summary_by_date(date_str: str):
         summary = cursor.fetchone()
         return summary
 
-def get_careless_mistake_by_id(mistake_id: int):
-    """根据ID获取一条粗心错误记录。"""
+def get_careless_mistake_by_id(mistake_id: int, columns=None):
+    """根据ID获取一条粗心错误记录（默认返回全部字段）。"""
     with get_db_connection() as conn:
-        mistake = conn.execute('SELECT * FROM careless_mistakes WHERE id = ?', (mistake_id,)).fetchone()
+        mistake = conn.execute(
+            f'SELECT {_column_list(columns)} FROM careless_mistakes WHERE id = ?', (mistake_id,)
+        ).fetchone()
         return mistake
 
 def update_careless_mistake(mistake_id: int, new_reflection: str):
     """根据ID更新一条粗心错误记录的反思内容。"""
-    with get_db_connection() as conn:
-        conn.execute(
-            'UPDATE careless_mistakes SET user_reflection = ? WHERE id = ?',
-            (new_reflection, mistake_id)
-        )
-        conn.commit()
-        print(f"Updated careless mistake with ID: {mistake_id}")
+    _write(lambda conn: conn.execute(
+        'UPDATE careless_mistakes SET user_reflection = ? WHERE id = ?',
+        (new_reflection, mistake_id)
+    ))
+    print(f"Updated careless mistake with ID: {mistake_id}")
 
 def delete_careless_mistake(mistake_id: int):
     """根据ID删除一条粗心错误记录。"""
-    with get_db_connection() as conn:
-        conn.execute('DELETE FROM careless_mistakes WHERE id = ?', (mistake_id,))
-        conn.commit()
-        print(f"Deleted careless mistake with ID: {mistake_id}")
+    _write(lambda conn: conn.execute('DELETE FROM careless_mistakes WHERE id = ?', (mistake_id,)))
+    print(f"Deleted careless mistake with ID: {mistake_id}")
 
 
 def update_or_add_summary(summary_data: dict):
@@ -334,6 +1060,11 @@ def update_or_add_summary(summary_data: dict):
     如果指定日期的总结已存在，则更新它；否则，插入新记录。
     【已修复】增加了 created_at 字段以满足 NOT NULL 约束。
     """
+    _write(_upsert_summary, summary_data)
+    print(f"Successfully saved or updated summary for date: {summary_data['date']}")
+
+
+def _upsert_summary(conn, summary_data: dict):
     sql = """
         INSERT OR REPLACE INTO daily_summaries (
             id, summary_date, general_summary, knowledge_points_summary,
@@ -343,169 +1074,1106 @@ def update_or_add_summary(summary_data: dict):
             ?, ?, ?, ?, ?, ?
         );
     """
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute(sql, (
-                summary_data['date'], # For the SELECT subquery
-                summary_data['date'], # For the VALUES clause
-                summary_data['ai_summary']['general_summary'],
-                json.dumps(summary_data['ai_summary']['knowledge_points_summary'], ensure_ascii=False),
-                summary_data['question_count'],
-                json.dumps(summary_data['subject_chart_data'], ensure_ascii=False),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S") # <-- 【关键修复】添加当前时间
-            ))
-            conn.commit()
-            print(f"Successfully saved or updated summary for date: {summary_data['date']}")
-        except sqlite3.Error as e:
-            print(f"Error in update_or_add_summary: {e}")
+    params = (
+        summary_data['date'], # For the SELECT subquery
+        summary_data['date'], # For the VALUES clause
+        encode_text(summary_data['ai_summary']['general_summary']),
+        encode_text(json.dumps(summary_data['ai_summary']['knowledge_points_summary'], ensure_ascii=False)),
+        summary_data['question_count'],
+        json.dumps(summary_data['subject_chart_data'], ensure_ascii=False),
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S") # <-- 【关键修复】添加当前时间
+    )
+    conn.execute(sql, params)
 
 
 def update_question_insight(question_id: int, insight: str):
     """更新一条错题的用户短注释（我的灵光一闪）。"""
-    with get_db_connection() as conn:
-        conn.execute('UPDATE questions SET my_insight = ? WHERE id = ?', (insight, question_id))
-        conn.commit()
-        print(f"Updated my_insight for question ID: {question_id}")
+    _write(lambda conn: conn.execute('UPDATE questions SET my_insight = ? WHERE id = ?', (insight, question_id)))
+    print(f"Updated my_insight for question ID: {question_id}")
 
-# 【新增】获取所有需要生成关键词的错题
-def get_all_questions_for_keyword_generation():
-    """获取所有尚未生成关键词的错题的 ID 和 problem_analysis。"""
+# 【新增】获取需要生成关键词的错题
+def get_questions_missing_keywords(after_id: int, limit: int) -> list:
+    """按 id 顺序分页读取尚未生成关键词的错题（id, problem_analysis），用于分批回填。"""
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        # 我们只选择 keywords 字段为 NULL 的记录
-        cursor.execute("SELECT id, problem_analysis FROM questions WHERE keywords IS NULL")
-        return cursor.fetchall()
+        return conn.execute(
+            "SELECT id, problem_analysis FROM questions WHERE keywords IS NULL AND id > ? ORDER BY id LIMIT ?",
+            (after_id, limit)
+        ).fetchall()
 
 # 【新增】根据 ID 更新错题的关键词
 def update_question_keywords(question_id: int, keywords: str):
     """为指定的错题 ID 更新 keywords 字段。"""
-    with get_db_connection() as conn:
+    def op(conn):
         conn.execute('UPDATE questions SET keywords = ? WHERE id = ?', (keywords, question_id))
-        conn.commit()
-        print(f"Updated keywords for question ID: {question_id}")
+        index_question_keywords(conn, question_id, keywords)
+
+    _write(op)
+    print(f"Updated keywords for question ID: {question_id}")
+
+
+def update_questions_keywords(items: list):
+    """在一个事务中批量更新多条错题的关键词，items 为 [(question_id, keywords), ...]。"""
+    def op(conn):
+        for question_id, keywords in items:
+            conn.execute('UPDATE questions SET keywords = ? WHERE id = ?', (keywords, question_id))
+            index_question_keywords(conn, question_id, keywords)
+
+    _write(op)
+
+# --- 错题分析任务 ---
+# 上传时只保存图片并创建一条任务，AI 分析由 jobs 模块的后台线程完成。
+# 任务状态保存在数据库里（而不是进程内存中），所以重启后可以继续，多个 gunicorn worker 也能看到同一份状态。
+# 状态：queued（等待执行，包括等待重试）-> running -> succeeded / failed
+
+ANALYSIS_JOB_DEFINITIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS analysis_jobs (
+        id TEXT PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'queued',
+        subject TEXT NOT NULL,
+        user_question TEXT DEFAULT '',
+        image_hash TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL,
+        next_attempt_at TEXT,
+        question_id INTEGER,
+        error TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs(status, updated_at)",
+]
+
+ANALYSIS_JOB_COLUMNS = (
+    "id", "status", "subject", "attempts", "max_attempts", "next_attempt_at",
+    "question_id", "error", "created_at", "updated_at",
+)
+
+
+def _now() -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def create_analysis_job(job_id: str, subject: str, user_question: str, image_hash: str, max_attempts: int):
+    """创建一条等待执行的分析任务（图片需要已经写入 image_store）。"""
+    now = _now()
+    _write(lambda conn: conn.execute(
+        "INSERT INTO analysis_jobs (id, status, subject, user_question, image_hash, max_attempts, created_at, updated_at) "
+        "VALUES (?, 'queued', ?, ?, ?, ?, ?, ?)",
+        (job_id, subject, user_question or '', image_hash, max_attempts, now, now)
+    ))
+
+
+def get_analysis_job(job_id: str, columns=ANALYSIS_JOB_COLUMNS):
+    """根据 ID 读取一条分析任务，不存在时返回 None。"""
+    with get_db_connection() as conn:
+        return conn.execute(f"SELECT {_column_list(columns)} FROM analysis_jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def claim_analysis_job(job_id: str) -> bool:
+    """
+    把一条 queued 状态的任务改为 running 并增加尝试次数。
+    多个进程可能同时恢复同一条任务，只有第一个抢到的返回 True。
+    """
+    return _write(lambda conn: conn.execute(
+        "UPDATE analysis_jobs SET status = 'running', attempts = attempts + 1, partial_result = NULL, updated_at = ? "
+        "WHERE id = ? AND status = 'queued'",
+        (_now(), job_id)
+    ).rowcount == 1)
+
+
+def complete_analysis_job(job_id: str, question_data: dict) -> int:
+    """在同一个事务中写入分析结果并把任务标记为成功，返回新错题的 ID。"""
+    def op(conn):
+        question_id = _insert_question(conn, question_data)
+        conn.execute(
+            "UPDATE analysis_jobs SET status = 'succeeded', question_id = ?, error = NULL, partial_result = NULL, "
+            "updated_at = ? WHERE id = ?",
+            (question_id, _now(), job_id)
+        )
+        return question_id
+
+    return _write(op)
+
+
+def update_analysis_job_partial(job_id: str, partial_result: dict):
+    """
+    保存流式分析过程中已经到达的结果（JSON），供 /jobs/<id>/events 推送给前端。
+    只更新仍在 running 状态的任务；同时刷新 updated_at，长时间生成的任务不会被当作已失联。
+    """
+    _write(lambda conn: conn.execute(
+        "UPDATE analysis_jobs SET partial_result = ?, updated_at = ? WHERE id = ? AND status = 'running'",
+        (json.dumps(partial_result, ensure_ascii=False), _now(), job_id)
+    ))
+
+
+def fail_analysis_job(job_id: str, error: str, retry_at: str = None):
+    """记录一次失败：给出 retry_at 时回到 queued 等待重试，否则标记为 failed。"""
+    status = 'queued' if retry_at else 'failed'
+    _write(lambda conn: conn.execute(
+        "UPDATE analysis_jobs SET status = ?, error = ?, next_attempt_at = ?, updated_at = ? WHERE id = ?",
+        (status, error, retry_at, _now(), job_id)
+    ))
+
+
+def reset_analysis_job(job_id: str) -> bool:
+    """把一条失败的任务重置为 queued（尝试次数清零），用于手动重试。任务不是 failed 状态时返回 False。"""
+    return _write(lambda conn: conn.execute(
+        "UPDATE analysis_jobs SET status = 'queued', attempts = 0, next_attempt_at = NULL, updated_at = ? "
+        "WHERE id = ? AND status = 'failed'",
+        (_now(), job_id)
+    ).rowcount == 1)
+
+
+def get_unfinished_analysis_jobs(stale_before: str) -> list:
+    """
+    返回需要（重新）执行的任务：所有 queued 的任务，以及 updated_at 早于 stale_before 的 running 任务
+    （执行它的进程已经退出）。后者会被改回 queued。
+    """
+    def op(conn):
+        conn.execute(
+            "UPDATE analysis_jobs SET status = 'queued', updated_at = ? WHERE status = 'running' AND updated_at < ?",
+            (_now(), stale_before)
+        )
+        return conn.execute(
+            "SELECT id, next_attempt_at FROM analysis_jobs WHERE status = 'queued' ORDER BY created_at"
+        ).fetchall()
+
+    return _write(op)
+
+
+def list_database_files() -> list:
+    """列出磁盘上所有的数据库文件：默认数据库，以及多用户部署下每个用户的数据库。"""
+    paths = []
+    if os.path.exists(DATABASE_NAME):
+        paths.append(DATABASE_NAME)
+    paths.extend(sorted(glob.glob(os.path.join(USER_DB_DIR, "user_*.db"))))
+    return paths
+
+# --- 每日总结任务 ---
+# 每日总结由 summary_scheduler 在后台生成，请求路径上只读取已经保存的总结。
+# summary_jobs 记录还没有（最新的）总结的日期：pending 等待生成（包括还没结束的当天），
+# running 正在生成，failed 生成失败（在下一次定时运行时重试）。生成成功后删除对应的行。
+
+SUMMARY_JOB_DEFINITIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS summary_jobs (
+        summary_date TEXT PRIMARY KEY,
+        status TEXT NOT NULL DEFAULT 'pending',
+        error TEXT,
+        updated_at TEXT NOT NULL
+    ) WITHOUT ROWID
+    """,
+]
+
+
+def get_summary_job(date_str: str):
+    """读取某一天的总结任务状态，没有任务时返回 None。"""
+    with get_db_connection() as conn:
+        return conn.execute(
+            "SELECT summary_date, status, error, updated_at FROM summary_jobs WHERE summary_date = ?", (date_str,)
+        ).fetchone()
+
+
+def mark_summary_pending(date_str: str):
+    """把某一天标记为等待生成总结（已经在生成或已标记时不做改动）。"""
+    _write(lambda conn: conn.execute(
+        "INSERT OR IGNORE INTO summary_jobs (summary_date, status, updated_at) VALUES (?, 'pending', ?)",
+        (date_str, _now())
+    ))
+
+
+def claim_summary_job(date_str: str, stale_before: str) -> bool:
+    """
+    把某一天的总结任务标记为 running，抢到时返回 True。
+    pending / failed 的任务，以及 updated_at 早于 stale_before 的 running 任务（执行它的进程已经退出）可以被抢到。
+    """
+    def op(conn):
+        now = _now()
+        conn.execute(
+            "INSERT OR IGNORE INTO summary_jobs (summary_date, status, updated_at) VALUES (?, 'pending', ?)",
+            (date_str, now)
+        )
+        return conn.execute(
+            "UPDATE summary_jobs SET status = 'running', error = NULL, updated_at = ? "
+            "WHERE summary_date = ? AND (status IN ('pending', 'failed') OR (status = 'running' AND updated_at < ?))",
+            (now, date_str, stale_before)
+        ).rowcount == 1
+
+    return _write(op)
+
+
+def fail_summary_job(date_str: str, error: str):
+    _write(lambda conn: conn.execute(
+        "UPDATE summary_jobs SET status = 'failed', error = ?, updated_at = ? WHERE summary_date = ?",
+        (error, _now(), date_str)
+    ))
+
+
+def finish_summary_job(date_str: str):
+    """删除某一天的总结任务（总结已经是最新的）。"""
+    _write(lambda conn: conn.execute("DELETE FROM summary_jobs WHERE summary_date = ?", (date_str,)))
+
+
+def save_summary_and_finish_job(summary_data: dict):
+    """保存生成好的总结，并在同一个事务中删除该日期的总结任务。"""
+    def op(conn):
+        _upsert_summary(conn, summary_data)
+        conn.execute("DELETE FROM summary_jobs WHERE summary_date = ?", (summary_data['date'],))
+
+    _write(op)
+    print(f"Successfully saved summary for date: {summary_data['date']}")
+
+
+def get_dates_needing_summary(before_date: str, include_failed: bool, stale_before: str, limit: int) -> list:
+    """
+    返回 before_date 之前（已经结束的日子）需要生成总结的日期，从近到远排列：
+    当天有记录，但还没有总结，或总结中的题目数与现在的记录数不一致（总结之后又有新的记录）。
+    正在生成的日期不返回；失败的日期只在 include_failed 时返回。只读取汇总表，不扫描错题。
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute("""
+            SELECT q.day
+            FROM (SELECT day, SUM(count) AS n FROM question_daily_counts WHERE day < ? GROUP BY day) q
+            LEFT JOIN careless_daily_counts c ON c.day = q.day
+            LEFT JOIN daily_summaries s ON s.summary_date = q.day
+            LEFT JOIN summary_jobs j ON j.summary_date = q.day
+            WHERE (s.id IS NULL OR s.question_count != q.n + COALESCE(c.count, 0))
+              AND (j.summary_date IS NULL
+                   OR j.status = 'pending'
+                   OR (j.status = 'failed' AND ?)
+                   OR (j.status = 'running' AND j.updated_at < ?))
+            ORDER BY q.day DESC
+            LIMIT ?
+        """, (before_date, 1 if include_failed else 0, stale_before, limit)).fetchall()
+        return [row['day'] for row in rows]
+
+# --- 关键词倒排索引 ---
+# keywords 字段是形如 "[科目]-[知识面]-[关键词1, 关键词2]" 的字符串。
+# 写入时解析一次，拆到 keyword_subjects / keyword_areas / keywords 三张字典表，
+# 并通过 question_areas、question_keywords 两张关联表（倒排索引）指向错题，
+# 这样筛选器和图片关键词匹配都可以直接在 SQL 中完成。原始字符串仍保留在 questions.keywords 中。
+
+# 模型输出常在三段式前后带有说明文字或标点（例如 "关键词: [...]-[...]-[...]。"），在整段文本中查找
+_KEYWORDS_PATTERN = re.compile(r"\[([^\]]+)\]-\[([^\]]+)\]-\[([^\]]*)\]")
+
+
+def parse_keywords(keywords_str: str):
+    """
+    解析关键词字符串，返回 (科目, 知识面, [关键词...])；格式不符时返回 None。
+    例如 "[物理化学]-[电化学]-[能斯特方程, 平均离子活度]"
+    -> ('物理化学', '电化学', ['能斯特方程', '平均离子活度'])
+    """
+    if not keywords_str:
+        return None
+    match = _KEYWORDS_PATTERN.search(keywords_str)
+    if not match:
+        return None
+    subject, area, keyword_list = match.groups()
+    keywords = []
+    for keyword in re.split(r"[,，]", keyword_list):
+        keyword = keyword.strip()
+        if keyword and keyword not in keywords:
+            keywords.append(keyword)
+    return subject.strip(), area.strip(), keywords
+
+
+# 关键词索引相关的表和触发器，由迁移步骤创建
+KEYWORD_INDEX_DEFINITIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS keyword_subjects (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS keyword_areas (
+        id INTEGER PRIMARY KEY,
+        subject_id INTEGER NOT NULL REFERENCES keyword_subjects (id),
+        name TEXT NOT NULL,
+        UNIQUE (subject_id, name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS keywords (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """,
+    # 每道错题所属的知识面（每题一个）
+    """
+    CREATE TABLE IF NOT EXISTS question_areas (
+        question_id INTEGER PRIMARY KEY,
+        area_id INTEGER NOT NULL REFERENCES keyword_areas (id)
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_question_areas_area ON question_areas (area_id)",
+    # 倒排索引：关键词 -> 错题
+    """
+    CREATE TABLE IF NOT EXISTS question_keywords (
+        keyword_id INTEGER NOT NULL REFERENCES keywords (id),
+        question_id INTEGER NOT NULL,
+        PRIMARY KEY (keyword_id, question_id)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_question_keywords_question ON question_keywords (question_id)",
+    # 删除错题时同步清理索引
+    """
+    CREATE TRIGGER IF NOT EXISTS questions_keyword_index_delete AFTER DELETE ON questions BEGIN
+        DELETE FROM question_areas WHERE question_id = old.id;
+        DELETE FROM question_keywords WHERE question_id = old.id;
+    END
+    """,
+]
+
+
+def _get_or_create_id(conn, sql_select: str, sql_insert: str, params: tuple) -> int:
+    row = conn.execute(sql_select, params).fetchone()
+    if row:
+        return row[0]
+    return conn.execute(sql_insert, params).lastrowid
+
+
+def index_question_keywords(conn, question_id: int, keywords_str: str):
+    """
+    解析一道错题的关键词字符串并写入倒排索引（覆盖该题原有的索引）。
+    需要在调用方的事务中执行，与 questions 表的写入一起提交。
+    """
+    conn.execute("DELETE FROM question_areas WHERE question_id = ?", (question_id,))
+    conn.execute("DELETE FROM question_keywords WHERE question_id = ?", (question_id,))
+    parsed = parse_keywords(keywords_str)
+    if not parsed:
+        return
+    subject, area, keywords = parsed
+
+    subject_id = _get_or_create_id(
+        conn,
+        "SELECT id FROM keyword_subjects WHERE name = ?",
+        "INSERT INTO keyword_subjects (name) VALUES (?)",
+        (subject,)
+    )
+    area_id = _get_or_create_id(
+        conn,
+        "SELECT id FROM keyword_areas WHERE subject_id = ? AND name = ?",
+        "INSERT INTO keyword_areas (subject_id, name) VALUES (?, ?)",
+        (subject_id, area)
+    )
+    conn.execute("INSERT INTO question_areas (question_id, area_id) VALUES (?, ?)", (question_id, area_id))
+    for keyword in keywords:
+        keyword_id = _get_or_create_id(
+            conn,
+            "SELECT id FROM keywords WHERE name = ?",
+            "INSERT INTO keywords (name) VALUES (?)",
+            (keyword,)
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO question_keywords (keyword_id, question_id) VALUES (?, ?)",
+            (keyword_id, question_id)
+        )
+
+
+_UNINDEXED_KEYWORDS_CONDITION = """
+    keywords IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM question_areas qa WHERE qa.question_id = questions.id)
+"""
+
+
+def _count_unindexed_keywords() -> int:
+    with get_db_connection() as conn:
+        return conn.execute(f"SELECT COUNT(*) FROM questions WHERE {_UNINDEXED_KEYWORDS_CONDITION}").fetchone()[0]
+
+
+def _backfill_keyword_index_batch(after_id: int, batch_size: int) -> tuple:
+    """为已有 keywords 但尚未进入倒排索引的错题补建一批索引，返回 (处理行数, 最后一行的 id)。"""
+    with transaction() as conn:
+        rows = conn.execute(
+            f"SELECT id, keywords FROM questions WHERE id > ? AND {_UNINDEXED_KEYWORDS_CONDITION} "
+            "ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+        for row in rows:
+            index_question_keywords(conn, row['id'], row['keywords'])
+    return len(rows), (rows[-1]['id'] if rows else after_id)
+
+
+def index_pending_keywords(batch_size: int = DB_MIGRATION_BATCH_SIZE) -> int:
+    """为所有尚未进入倒排索引的错题建立索引（例如批量导入之后），返回处理的行数。"""
+    indexed, after_id = 0, 0
+    while True:
+        processed, after_id = _backfill_keyword_index_batch(after_id, batch_size)
+        if not processed:
+            return indexed
+        indexed += processed
+
 
 # 【新增】获取所有关键词，用于生成搜索筛选器
 def get_search_filters():
     """
-    从数据库中提取所有关键词，并构建一个层级结构的字典用于前端筛选。
-    返回格式: {'物理化学': {'电化学', '热力学'}, '高等数学': {'微积分'}}
+    从关键词索引中读取科目与知识面，构建一个层级结构的字典用于前端筛选。
+    只返回至少还有一道错题的知识面。
+    返回格式: {'物理化学': ['热力学', '电化学'], '高等数学': ['微积分']}
     """
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT keywords FROM questions WHERE keywords IS NOT NULL")
-        rows = cursor.fetchall()
-        
-        filters = defaultdict(set)
-        # 正则表达式用于解析格式：[科目]-[知识面]-[...]
-        pattern = re.compile(r"\[([^\]]+)\]-\[([^\]]+)\]-.*")
-        
-        for row in rows:
-            match = pattern.match(row['keywords'])
-            if match:
-                subject, knowledge_area = match.groups()
-                filters[subject].add(knowledge_area)
-        
-        # 将 set 转换为 list 以便 JSON 序列化
-        return {subject: sorted(list(areas)) for subject, areas in filters.items()}
+        rows = conn.execute("""
+            SELECT s.name AS subject, a.name AS area
+            FROM keyword_areas a
+            JOIN keyword_subjects s ON s.id = a.subject_id
+            WHERE EXISTS (SELECT 1 FROM question_areas qa WHERE qa.area_id = a.id)
+            ORDER BY s.name, a.name
+        """).fetchall()
+
+    filters = defaultdict(list)
+    for row in rows:
+        filters[row['subject']].append(row['area'])
+    return dict(filters)
 
 # 【核心修改】核心搜索函数
-def search_questions(query_text: str = "", filters: dict = None, image_keywords_str: str = ""):
+# --- 全文检索 (FTS5) ---
+
+# 参与全文检索的错题字段，顺序与 questions_fts 的列一致
+QUESTION_FTS_COLUMNS = (
+    "keywords",           # 关键词
+    "problem_analysis",   # AI解析
+    "knowledge_points",   # 核心知识点
+    "ai_analysis",        # 可能的错误
+    "similar_examples",   # 相似例题
+    "user_question",      # 自己的疑问
+    "my_insight",         # 我的灵光一闪
+)
+# bm25 各列权重：关键词和用户自己写的内容命中时排名更靠前
+_QUESTION_FTS_WEIGHTS = (5.0, 1.0, 2.0, 1.0, 1.0, 2.0, 2.0)
+# trigram 分词器无法匹配少于 3 个字符的词，这类词退回到 LIKE 匹配
+_TRIGRAM_MIN_LENGTH = 3
+_SNIPPET_TOKENS = 24
+
+
+def _search_index_definitions() -> list:
+    """
+    全文检索表和同步触发器。
+    FTS 表自带一份文本副本（而不是 external content），这样即使主表字段以后改为压缩存储，
+    索引和摘要高亮仍然基于原始文本。trigram 分词器让中文无需分词器即可检索。
+    """
+    fts_columns = ", ".join(QUESTION_FTS_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in QUESTION_FTS_COLUMNS)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5({fts_columns}, tokenize = 'trigram')",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS questions_fts_insert AFTER INSERT ON questions BEGIN
+            INSERT INTO questions_fts (rowid, {fts_columns}) VALUES (new.id, {new_values});
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS questions_fts_delete AFTER DELETE ON questions BEGIN
+            DELETE FROM questions_fts WHERE rowid = old.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS questions_fts_update AFTER UPDATE OF {fts_columns} ON questions BEGIN
+            DELETE FROM questions_fts WHERE rowid = old.id;
+            INSERT INTO questions_fts (rowid, {fts_columns}) VALUES (new.id, {new_values});
+        END
+        """,
+        "CREATE VIRTUAL TABLE IF NOT EXISTS careless_fts USING fts5(user_reflection, tokenize = 'trigram')",
+        """
+        CREATE TRIGGER IF NOT EXISTS careless_fts_insert AFTER INSERT ON careless_mistakes BEGIN
+            INSERT INTO careless_fts (rowid, user_reflection) VALUES (new.id, new.user_reflection);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS careless_fts_delete AFTER DELETE ON careless_mistakes BEGIN
+            DELETE FROM careless_fts WHERE rowid = old.id;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS careless_fts_update AFTER UPDATE OF user_reflection ON careless_mistakes BEGIN
+            DELETE FROM careless_fts WHERE rowid = old.id;
+            INSERT INTO careless_fts (rowid, user_reflection) VALUES (new.id, new.user_reflection);
+        END
+        """,
+    ]
+
+
+def _search_trigger_text_value_definitions() -> list:
+    """重建错题全文索引的写入触发器，用 text_value() 把压缩存储的字段还原为原文后再写入索引。"""
+    fts_columns = ", ".join(QUESTION_FTS_COLUMNS)
+    new_values = ", ".join(f"text_value(new.{column})" for column in QUESTION_FTS_COLUMNS)
+    return [
+        "DROP TRIGGER IF EXISTS questions_fts_insert",
+        "DROP TRIGGER IF EXISTS questions_fts_update",
+        f"""
+        CREATE TRIGGER questions_fts_insert AFTER INSERT ON questions BEGIN
+            INSERT INTO questions_fts (rowid, {fts_columns}) VALUES (new.id, {new_values});
+        END
+        """,
+        f"""
+        CREATE TRIGGER questions_fts_update AFTER UPDATE OF {fts_columns} ON questions BEGIN
+            DELETE FROM questions_fts WHERE rowid = old.id;
+            INSERT INTO questions_fts (rowid, {fts_columns}) VALUES (new.id, {new_values});
+        END
+        """,
+    ]
+
+
+# 为全文检索表补建索引时使用：(数据表, FTS 表, 需要索引的列)
+_SEARCH_INDEX_SOURCES = {
+    "questions": ("questions_fts", QUESTION_FTS_COLUMNS),
+    "careless_mistakes": ("careless_fts", ("user_reflection",)),
+}
+
+
+def _count_unindexed_text(table: str) -> int:
+    fts_table, _ = _SEARCH_INDEX_SOURCES[table]
+    with get_db_connection() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE id NOT IN (SELECT rowid FROM {fts_table})"
+        ).fetchone()[0]
+
+
+def _backfill_search_index_batch(table: str, after_id: int, batch_size: int) -> tuple:
+    """把一批尚未进入全文索引的旧记录写入 FTS 表，返回 (处理行数, 最后一行的 id)。"""
+    fts_table, columns = _SEARCH_INDEX_SOURCES[table]
+    column_list = ", ".join(columns)
+    source_columns = ", ".join(f"text_value({column})" for column in columns)
+    with transaction() as conn:
+        rows = conn.execute(
+            f"SELECT id FROM {table} WHERE id > ? AND id NOT IN (SELECT rowid FROM {fts_table}) "
+            "ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+        if rows:
+            conn.execute(
+                f"INSERT INTO {fts_table} (rowid, {column_list}) "
+                f"SELECT id, {source_columns} FROM {table} WHERE id BETWEEN ? AND ? "
+                f"AND id NOT IN (SELECT rowid FROM {fts_table})",
+                (rows[0]['id'], rows[-1]['id'])
+            )
+    return len(rows), (rows[-1]['id'] if rows else after_id)
+
+
+def parse_search_terms(query_text: str) -> list:
+    """
+    把搜索框内容拆成检索词：双引号括起来的部分作为一个短语，其余按空白拆分。
+    例如 '能斯特 "平均离子 活度"' -> ['能斯特', '平均离子 活度']
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]+)"|(\S+)', query_text or ""):
+        term = (phrase or word).strip()
+        if term:
+            terms.append(term)
+    return terms
+
+
+def _build_text_search(terms: list, fts_table: str, columns: tuple) -> tuple:
+    """
+    为检索词生成 FTS 条件。所有词之间是 AND 关系。
+    返回 (MATCH 表达式或 None, 额外的 LIKE 条件列表, LIKE 参数列表)。
+    """
+    match_terms, like_clauses, like_params = [], [], []
+    for term in terms:
+        if len(term) >= _TRIGRAM_MIN_LENGTH:
+            # 用双引号包裹成短语，避免用户输入被当作 FTS 语法解析
+            match_terms.append('"' + term.replace('"', '""') + '"')
+        else:
+            like_clauses.append("(" + " OR ".join(f"{fts_table}.{column} LIKE ?" for column in columns) + ")")
+            like_params.extend([f"%{term}%"] * len(columns))
+    match_expression = " AND ".join(match_terms) if match_terms else None
+    return match_expression, like_clauses, like_params
+
+
+def search_questions(query_text: str = "", filters: dict = None, image_keywords_str: str = "",
+                     columns=QUESTION_LIST_COLUMNS, limit: int = 200):
     """
     【最终版】在数据库中搜索错题。
-    支持在所有主要文本字段中进行匹配：
-    'keywords', 'problem_analysis', 'knowledge_points', 'ai_analysis', 'similar_examples', 'user_question'
-    同时支持筛选条件和图片关键词匹配。
+    文本查询走 FTS5 全文索引，覆盖 QUESTION_FTS_COLUMNS 中的所有字段，
+    支持多个词（AND）和双引号短语，结果按 bm25 相关度排序并附带高亮摘要 (snippet)。
+    筛选条件和图片关键词匹配走关键词倒排索引，三者取交集。
+    图片搜索的结果带有 match_score（与图片关键词重合的个数），并优先按它排序。
     """
     if filters is None:
         filters = {}
+
+    image_keywords = []
+    if image_keywords_str:
+        parsed = parse_keywords(image_keywords_str)
+        if not parsed or not parsed[2]:
+            return []
+        image_keywords = parsed[2]
     
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        
-        # 基础查询
-        sql_query = "SELECT * FROM questions WHERE keywords IS NOT NULL"
+
+        terms = parse_search_terms(query_text)
+        match_expression, like_clauses, like_params = _build_text_search(
+            terms, "questions_fts", QUESTION_FTS_COLUMNS
+        )
+
+        # 基础查询：有文本查询时与 FTS 表连接，以便过滤、排序和生成摘要
+        select_columns = _column_list(columns, "q.")
+        from_clause = "questions q"
         params = []
+        if terms:
+            if match_expression:
+                weights = ", ".join(str(w) for w in _QUESTION_FTS_WEIGHTS)
+                select_columns += (
+                    f", bm25(questions_fts, {weights}) AS relevance"
+                    f", snippet(questions_fts, -1, '<mark>', '</mark>', '…', {_SNIPPET_TOKENS}) AS snippet"
+                )
+            from_clause = "questions_fts JOIN questions q ON q.id = questions_fts.rowid"
+
+        # 图片搜索：在倒排索引中统计每道题与图片关键词的重合个数
+        if image_keywords:
+            placeholders = ", ".join("?" * len(image_keywords))
+            select_columns += ", m.match_score"
+            from_clause += f"""
+                JOIN (
+                    SELECT qk.question_id, COUNT(*) AS match_score
+                    FROM keywords k
+                    JOIN question_keywords qk ON qk.keyword_id = k.id
+                    WHERE k.name IN ({placeholders})
+                    GROUP BY qk.question_id
+                ) m ON m.question_id = q.id"""
+            params.extend(image_keywords)
 
-        # 1. 根据筛选器缩小范围 (这部分逻辑不变)
+        sql_query = f"SELECT {select_columns} FROM {from_clause} WHERE q.keywords IS NOT NULL"
+
+        # 1. 根据筛选器缩小范围（科目之间、知识面之间为 OR，两类条件之间为 AND）
         selected_subjects = filters.get('subjects', [])
         selected_areas = filters.get('areas', [])
         
         if selected_subjects:
-            subject_clauses = " OR ".join(["keywords LIKE ?"] * len(selected_subjects))
-            sql_query += f" AND ({subject_clauses})"
-            params.extend([f"[{subject}]-%" for subject in selected_subjects])
+            placeholders = ", ".join("?" * len(selected_subjects))
+            sql_query += f"""
+                AND q.id IN (
+                    SELECT qa.question_id FROM question_areas qa
+                    JOIN keyword_areas a ON a.id = qa.area_id
+                    JOIN keyword_subjects s ON s.id = a.subject_id
+                    WHERE s.name IN ({placeholders})
+                )"""
+            params.extend(selected_subjects)
         
         if selected_areas:
-            area_clauses = " OR ".join(["keywords LIKE ?"] * len(selected_areas))
-            sql_query += f" AND ({area_clauses})"
-            params.extend([f"%- [{area}]-%" for area in selected_areas])
-
-        # 2. 【核心修改】根据文本查询进一步筛选，扩展搜索范围
-        if query_text:
-            # 构建一个包含所有要搜索的字段的 OR 条件
-            search_fields = [
-                "keywords",           # 关键词
-                "problem_analysis",   # AI解析
-                "knowledge_points",   # 核心知识点
-                "ai_analysis",        # 可能的错误
-                "similar_examples",   # 相似例题
-                "user_question"       # 自己的疑问
-            ]
-            
-            # 生成 SQL 子句，例如: (keywords LIKE ? OR problem_analysis LIKE ? OR ...)
-            text_search_clause = " OR ".join([f"{field} LIKE ?" for field in search_fields])
-            sql_query += f" AND ({text_search_clause})"
-            
-            # 为每个 '?' 占位符添加参数
-            search_term = f"%{query_text}%"
-            params.extend([search_term] * len(search_fields))
+            placeholders = ", ".join("?" * len(selected_areas))
+            sql_query += f"""
+                AND q.id IN (
+                    SELECT qa.question_id FROM question_areas qa
+                    JOIN keyword_areas a ON a.id = qa.area_id
+                    WHERE a.name IN ({placeholders})
+                )"""
+            params.extend(selected_areas)
+
+        # 2. 根据文本查询进一步筛选
+        if match_expression:
+            sql_query += " AND questions_fts MATCH ?"
+            params.append(match_expression)
+        for clause in like_clauses:
+            sql_query += f" AND {clause}"
+        params.extend(like_params)
+
+        # 3. 排序：图片关键词重合度 > 文本相关度 > 时间倒序
+        order_by = []
+        if image_keywords:
+            order_by.append("m.match_score DESC")
+        if match_expression:
+            order_by.append("relevance")
+        order_by.append("q.upload_date DESC, q.id DESC")
+        sql_query += " ORDER BY " + ", ".join(order_by) + " LIMIT ?"
+        params.append(limit)
 
         cursor.execute(sql_query, params)
-        candidate_questions = cursor.fetchall()
-
-        # 3. 如果是图片搜索，则进行相似度排序 (这部分逻辑不变)
-        if image_keywords_str:
-            # ... (这部分代码完全不变) ...
-            search_kws_match = re.search(r"\[.*\]-\[.*\]-\[(.*)\]", image_keywords_str)
-            if not search_kws_match:
-                return []
-            search_kws_set = set(kw.strip() for kw in search_kws_match.group(1).split(','))
-
-            scored_questions = []
-            for q in candidate_questions:
-                q_dict = dict(q)
-                q_kws_match = re.search(r"\[.*\]-\[.*\]-\[(.*)\]", q_dict['keywords'])
-                if not q_kws_match:
-                    continue
-                
-                q_kws_set = set(kw.strip() for kw in q_kws_match.group(1).split(','))
-                
-                score = len(search_kws_set.intersection(q_kws_set))
-                if score > 0:
-                    q_dict['match_score'] = score
-                    scored_questions.append(q_dict)
-            
-            return sorted(scored_questions, key=lambda x: x['match_score'], reverse=True)
-        else:
-            return [dict(q) for q in candidate_questions]
+        return [dict(q) for q in cursor.fetchall()]
+
+
+def search_careless_mistakes(query_text: str, columns=CARELESS_LIST_COLUMNS, limit: int = 50) -> list:
+    """在粗心错误的反思内容中全文检索，规则与 search_questions 的文本查询相同。"""
+    terms = parse_search_terms(query_text)
+    if not terms:
+        return []
+    match_expression, like_clauses, like_params = _build_text_search(
+        terms, "careless_fts", ("user_reflection",)
+    )
+
+    select_columns = _column_list(columns, "c.")
+    if match_expression:
+        select_columns += (
+            f", snippet(careless_fts, 0, '<mark>', '</mark>', '…', {_SNIPPET_TOKENS}) AS snippet"
+        )
+    sql_query = (
+        f"SELECT {select_columns} FROM careless_fts "
+        "JOIN careless_mistakes c ON c.id = careless_fts.rowid WHERE 1 = 1"
+    )
+    params = []
+    if match_expression:
+        sql_query += " AND careless_fts MATCH ?"
+        params.append(match_expression)
+    for clause in like_clauses:
+        sql_query += f" AND {clause}"
+    params.extend(like_params)
+    sql_query += " ORDER BY bm25(careless_fts)" if match_expression else " ORDER BY c.upload_date DESC, c.id DESC"
+    sql_query += " LIMIT ?"
+    params.append(limit)
+
+    with get_db_connection() as conn:
+        return [dict(row) for row in conn.execute(sql_query, params).fetchall()]
+
+# --- 数据库版本迁移 ---
+# 数据库结构的版本号记录在 PRAGMA user_version 中，每个迁移步骤只会执行一次，
+# 启动时如果版本已是最新，就不再做任何表结构检查。
+# - 结构变更 (apply)：在一个写事务中执行，并在同一事务中提升版本号。
+# - 数据迁移 (batch)：按 id 分批处理，每批单独提交，不会长时间占用写锁；
+#   每批只挑选尚未处理的行，所以中断后重新启动会从剩余的行继续。
+# 新的迁移只能追加到 MIGRATIONS 末尾，已发布的步骤不要修改。
+
+Migration = namedtuple("Migration", ["version", "description", "apply", "batch", "remaining"],
+                       defaults=(None, None, None))
+
+
+def _add_missing_columns(conn, table: str, column_definitions: dict):
+    """为旧数据库补齐缺少的列（在引入版本号之前，这些列可能已经被手动迁移加上了）。"""
+    existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for column, definition in column_definitions.items():
+        if column not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            print(f"Added column '{column}' to '{table}'.")
+
+
+def _add_question_columns(conn):
+    _add_missing_columns(conn, "questions", {
+        "user_question": "TEXT DEFAULT ''",  # 用户的原始疑问，用于重新生成
+        "my_insight": "TEXT DEFAULT ''",     # 用户的短注释 "我的灵光一闪"
+        "keywords": "TEXT",                  # 默认是 NULL，由关键词生成脚本补全
+    })
+
+
+def _add_image_hash_columns(conn):
+    # 图片改为存放在 image_store 中，表里只保存哈希
+    for table in ("questions", "careless_mistakes"):
+        _add_missing_columns(conn, table, {"image_hash": "TEXT"})
+
+
+def _add_rendered_html_column(conn):
+    _add_missing_columns(conn, "questions", {"problem_analysis_html": "TEXT"})
+
+
+def _add_job_partial_result_column(conn):
+    _add_missing_columns(conn, "analysis_jobs", {"partial_result": "TEXT"})
+
+
+def _add_digest_column(conn):
+    _add_missing_columns(conn, "questions", {"digest": "TEXT"})
+
+
+def _count_unrendered_html() -> int:
+    if not DB_STORE_RENDERED_HTML:
+        return 0
+    with get_db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM questions WHERE problem_analysis_html IS NULL").fetchone()[0]
+
+
+def _render_html_batch(after_id: int, batch_size: int) -> tuple:
+    """
+    为一批还没有预渲染 HTML 的错题渲染解析。渲染在事务之外进行，写事务只包含 UPDATE，
+    返回 (处理行数, 最后一行的 id)。未开启 DB_STORE_RENDERED_HTML 时不做任何事。
+    """
+    if not DB_STORE_RENDERED_HTML:
+        return 0, after_id
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, problem_analysis FROM questions "
+            "WHERE id > ? AND problem_analysis_html IS NULL ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+    if not rows:
+        return 0, after_id
+
+    updates = [(render_analysis_html(row['problem_analysis']), row['id']) for row in rows]
+    with transaction() as conn:
+        # 渲染期间解析可能被重新生成，只填写仍然为空的行
+        conn.executemany(
+            "UPDATE questions SET problem_analysis_html = ? WHERE id = ? AND problem_analysis_html IS NULL", updates
+        )
+    return len(rows), rows[-1]['id']
+
+
+def render_pending_html(batch_size: int = DB_MIGRATION_BATCH_SIZE) -> int:
+    """为所有还没有预渲染 HTML 的错题渲染解析（例如批量导入或开启 DB_STORE_RENDERED_HTML 之后），返回处理的行数。"""
+    rendered, after_id = 0, 0
+    while True:
+        processed, after_id = _render_html_batch(after_id, batch_size)
+        if not processed:
+            return rendered
+        rendered += processed
+
+
+def _count_questions() -> int:
+    with get_db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM questions").fetchone()[0]
+
+
+def _json_fields_batch(after_id: int, batch_size: int) -> tuple:
+    """检查一批错题的 JSON 字段，把空值或不是合法 JSON 的内容改为 "[]"，返回 (处理行数, 最后一行的 id)。"""
+    columns = ", ".join(QUESTION_JSON_COLUMNS)
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, {columns} FROM questions WHERE id > ? ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+    if not rows:
+        return 0, after_id
+
+    updates = []
+    for row in rows:
+        fixed = {column: normalize_json_text(row[column]) for column in QUESTION_JSON_COLUMNS}
+        if any(fixed[column] != row[column] for column in QUESTION_JSON_COLUMNS):
+            updates.append((
+                fixed['knowledge_points'],
+                encode_text(fixed['ai_analysis']),
+                encode_text(fixed['similar_examples']),
+                row['id'],
+            ))
+    if updates:
+        with transaction() as conn:
+            conn.executemany(
+                "UPDATE questions SET knowledge_points = ?, ai_analysis = ?, similar_examples = ? WHERE id = ?",
+                updates
+            )
+        print(f"Replaced invalid JSON fields in {len(updates)} questions.")
+    return len(rows), rows[-1]['id']
+
+
+def _count_missing_digests() -> int:
+    with get_db_connection() as conn:
+        return conn.execute("SELECT COUNT(*) FROM questions WHERE digest IS NULL").fetchone()[0]
+
+
+def _digest_batch(after_id: int, batch_size: int) -> tuple:
+    """为一批还没有摘要的错题生成摘要，返回 (处理行数, 最后一行的 id)。"""
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            "SELECT id, subject, keywords, knowledge_points, ai_analysis, problem_analysis FROM questions "
+            "WHERE id > ? AND digest IS NULL ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+    if not rows:
+        return 0, after_id
+
+    updates = [(build_question_digest(row), row['id']) for row in rows]
+    with transaction() as conn:
+        conn.executemany("UPDATE questions SET digest = ? WHERE id = ? AND digest IS NULL", updates)
+    return len(rows), rows[-1]['id']
+
+
+def fill_pending_digests(batch_size: int = DB_MIGRATION_BATCH_SIZE) -> int:
+    """为所有还没有摘要的错题生成摘要（例如批量导入之后），返回处理的行数。"""
+    filled, after_id = 0, 0
+    while True:
+        processed, after_id = _digest_batch(after_id, batch_size)
+        if not processed:
+            return filled
+        filled += processed
+
+
+def _run_statements(statements: list):
+    def apply(conn):
+        for statement in statements:
+            conn.execute(statement)
+    return apply
+
+
+def _migrate_inline_images_batch(table: str, after_id: int, batch_size: int) -> tuple:
+    """
+    将一批仍以 base64 文本内联存储的图片写入 image_store，并把该行改为只保存图片哈希。
+    图片文件在事务之外写入，写事务只包含 UPDATE，返回 (处理行数, 最后一行的 id)。
+    """
+    with get_db_connection() as conn:
+        rows = conn.execute(
+            f"SELECT id, original_image_b64 FROM {table} "
+            "WHERE id > ? AND image_hash IS NULL AND original_image_b64 != '' ORDER BY id LIMIT ?",
+            (after_id, batch_size)
+        ).fetchall()
+    if not rows:
+        return 0, after_id
+
+    updates = []
+    for row in rows:
+        try:
+            image_bytes = base64.b64decode(row['original_image_b64'])
+        except (binascii.Error, ValueError) as e:
+            # 无法解码的脏数据保留原样，只标记一个空哈希，避免下次重复处理
+            print(f"Skipping undecodable image in {table} ID {row['id']}: {e}")
+            updates.append((f"UPDATE {table} SET image_hash = '' WHERE id = ?", (row['id'],)))
+            continue
+        image_hash = image_store.save_image(image_bytes)
+        updates.append((
+            f"UPDATE {table} SET image_hash = ?, original_image_b64 = '' WHERE id = ? AND image_hash IS NULL",
+            (image_hash, row['id'])
+        ))
+
+    with transaction() as conn:
+        for sql, params in updates:
+            conn.execute(sql, params)
+    return len(rows), rows[-1]['id']
+
+
+def compress_existing_text(batch_size: int = DB_MIGRATION_BATCH_SIZE, compress: bool = True) -> int:
+    """
+    把已有记录中的长文本字段改为压缩存储（compress=False 时反过来全部解压）。
+    开启或关闭 DB_COMPRESS_TEXT 之后手动执行一次；按 id 分批处理，每批单独提交，可以随时中断重跑。
+    返回改写的行数。
+    """
+    rewritten = 0
+    for table, columns in COMPRESSED_COLUMNS.items():
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        after_id = 0
+        while True:
+            with transaction() as conn:
+                rows = conn.execute(
+                    f"SELECT id, {', '.join(columns)} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_id, batch_size)
+                ).fetchall()
+                for row in rows:
+                    # 绕过 _LazyRow 读取存储的原始值，再按目标格式重新编码
+                    stored = [sqlite3.Row.__getitem__(row, column) for column in columns]
+                    values = [encode_text(decode_text(value), compress) for value in stored]
+                    # 只改写存储格式确实发生变化的行，避免无谓地触发全文索引更新
+                    if all(type(old) is type(new) for old, new in zip(stored, values)):
+                        continue
+                    conn.execute(f"UPDATE {table} SET {assignments} WHERE id = ?", (*values, row['id']))
+                    rewritten += 1
+            if not rows:
+                break
+            after_id = rows[-1]['id']
+            print(f"Re-encoded '{table}' up to ID {after_id} ({rewritten} rows rewritten)...")
+    return rewritten
+
+
+def _count_inline_images(table: str) -> int:
+    with get_db_connection() as conn:
+        return conn.execute(
+            f"SELECT COUNT(*) FROM {table} WHERE image_hash IS NULL AND original_image_b64 != ''"
+        ).fetchone()[0]
+
+
+MIGRATIONS = [
+    Migration(1, "create base tables", apply=_run_statements(BASE_TABLE_DEFINITIONS)),
+    Migration(2, "add user_question/my_insight/keywords columns", apply=_add_question_columns),
+    Migration(3, "add image_hash columns", apply=_add_image_hash_columns),
+    Migration(4, "move inline question images into image store",
+              batch=lambda after_id, size: _migrate_inline_images_batch("questions", after_id, size),
+              remaining=lambda: _count_inline_images("questions")),
+    Migration(5, "move inline careless-mistake images into image store",
+              batch=lambda after_id, size: _migrate_inline_images_batch("careless_mistakes", after_id, size),
+              remaining=lambda: _count_inline_images("careless_mistakes")),
+    Migration(6, "create date/subject indexes", apply=_run_statements(INDEX_DEFINITIONS)),
+    Migration(7, "create full-text search tables", apply=_run_statements(_search_index_definitions())),
+    Migration(8, "build full-text index for questions",
+              batch=lambda after_id, size: _backfill_search_index_batch("questions", after_id, size),
+              remaining=lambda: _count_unindexed_text("questions")),
+    Migration(9, "build full-text index for careless mistakes",
+              batch=lambda after_id, size: _backfill_search_index_batch("careless_mistakes", after_id, size),
+              remaining=lambda: _count_unindexed_text("careless_mistakes")),
+    Migration(10, "create keyword index tables", apply=_run_statements(KEYWORD_INDEX_DEFINITIONS)),
+    Migration(11, "build keyword index", batch=_backfill_keyword_index_batch, remaining=_count_unindexed_keywords),
+    Migration(12, "create dashboard rollup tables", apply=_run_statements(ROLLUP_DEFINITIONS + ROLLUP_REBUILD_STATEMENTS)),
+    Migration(13, "index decompressed text in full-text triggers",
+              apply=_run_statements(_search_trigger_text_value_definitions())),
+    Migration(14, "add problem_analysis_html column", apply=_add_rendered_html_column),
+    Migration(15, "pre-render problem analysis HTML", batch=_render_html_batch, remaining=_count_unrendered_html),
+    Migration(16, "create analysis job table", apply=_run_statements(ANALYSIS_JOB_DEFINITIONS)),
+    Migration(17, "add partial_result column to analysis jobs", apply=_add_job_partial_result_column),
+    Migration(18, "create summary job table", apply=_run_statements(SUMMARY_JOB_DEFINITIONS)),
+    Migration(19, "add question digest column", apply=_add_digest_column),
+    Migration(20, "build question digests", batch=_digest_batch, remaining=_count_missing_digests),
+    Migration(21, "replace invalid JSON fields", batch=_json_fields_batch, remaining=_count_questions),
+    # 之前的解析只接受恰好是三段式的字符串，前后带文字的关键词没有进入索引，按新的解析重新补建
+    Migration(22, "index keywords with surrounding text",
+              batch=_backfill_keyword_index_batch, remaining=_count_unindexed_keywords),
+]
+LATEST_SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version() -> int:
+    """返回数据库当前的结构版本号（PRAGMA user_version）。"""
+    with get_db_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _print_progress(migration: Migration, done: int, total: int):
+    print(f"Migration {migration.version}/{LATEST_SCHEMA_VERSION} ({migration.description}): {done}/{total} rows")
+
+
+def _run_migration(migration: Migration, batch_size: int, progress):
+    if migration.batch:
+        total = migration.remaining()
+        done, after_id = 0, 0
+        if total:
+            progress(migration, done, total)
+        while True:
+            processed, after_id = migration.batch(after_id, batch_size)
+            if not processed:
+                break
+            done += processed
+            # 迁移期间新写入的行也可能被处理到，总数以较大者为准
+            total = max(total, done)
+            progress(migration, done, total)
+
+    with transaction() as conn:
+        # 多个进程同时启动时，只有第一个拿到写锁的进程会真正执行结构变更
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= migration.version:
+            return
+        if migration.apply:
+            migration.apply(conn)
+        conn.execute(f"PRAGMA user_version = {migration.version}")
+    print(f"Migration {migration.version}/{LATEST_SCHEMA_VERSION} ({migration.description}) done.")
+
+
+def migrate_db(batch_size: int = DB_MIGRATION_BATCH_SIZE, progress=_print_progress) -> int:
+    """
+    把数据库升级到最新的结构版本，返回升级后的版本号。
+    progress(migration, done, total) 用于报告数据迁移的进度，默认打印到控制台。
+    """
+    version = get_schema_version()
+    if version >= LATEST_SCHEMA_VERSION:
+        return version
+
+    print(f"Database schema is at version {version}, migrating to {LATEST_SCHEMA_VERSION}...")
+    for migration in MIGRATIONS:
+        if migration.version > version:
+            _run_migration(migration, batch_size, progress)
+
+    with get_db_connection() as conn:
+        # 刷新查询规划器的统计信息
+        conn.execute("PRAGMA optimize")
+    print("Database schema is up to date.")
+    return LATEST_SCHEMA_VERSION
+
+
 # --- 用于独立测试本模块功能的示例 ---
 if __name__ == '__main__':
     print("--- Running database module tests ---")
     init_db()
+    assert get_schema_version() == LATEST_SCHEMA_VERSION
     
     # 构造测试数据
     test_question = {
         "subject": "物理化学",
         "upload_date": "2025-10-10 10:00:00",
-        "original_image_b64": "test_base64_string",
+        "image_hash": image_store.save_image(b"test image bytes"),
         "user_question": "为什么是这个公式？",
         "problem_analysis": "这是关于克拉伯龙方程的解析...",
         "knowledge_points": json.dumps(["理想气体", "状态方程"], ensure_ascii=False),
         "ai_analysis": json.dumps(["单位错误"], ensure_ascii=False),
-        "similar_examples": json.dumps([{"question": "例题？", "answer": "答案。"}], ensure_ascii=False)
+        "similar_examples": json.dumps([{"question": "例题？", "answer": "答案。"}], ensure_ascii=False),
+        "keywords": "[物理化学]-[热力学]-[克拉伯龙方程, 理想气体]"
     }
     add_question(test_question)
+
+    print("\n--- Testing keyword index ---")
+    filters = get_search_filters()
+    print(f"Filters: {filters}")
+    assert "热力学" in filters["物理化学"]
+    matches = search_questions(image_keywords_str="[物理化学]-[热力学]-[理想气体, 相变]")
+    assert matches and matches[0]['match_score'] >= 1
     
     print("\n--- Testing get_all_subjects ---")
     subjects = get_all_subjects()
@@ -513,8 +2181,8 @@ if __name__ == '__main__':
     assert "物理化学" in subjects
 
     print("\n--- Testing paginated get_questions_by_subject ---")
-    questions_page1 = get_questions_by_subject("物理化学", limit=1, offset=0)
-    print(f"Page 1 has {len(questions_page1)} item(s).")
+    questions_page1, next_cursor = get_questions_by_subject("物理化学", limit=1)
+    print(f"Page 1 has {len(questions_page1)} item(s), next cursor: {next_cursor}")
     assert len(questions_page1) == 1
     print(f"Item ID: {questions_page1[0]['id']}, User Question: {questions_page1[0]['user_question']}")
 
@@ -523,5 +2191,25 @@ if __name__ == '__main__':
     print(f"Latest date: {latest_date}")
     assert latest_date == "2025-10-10"
 
+    print("\n--- Testing rollup triggers ---")
+    add_careless_mistake({"upload_date": "2025-10-10 11:00:00", "image_hash": "", "user_reflection": "看错符号"})
+    assert get_careless_count_by_date("2025-10-10") >= 1
+    extra = dict(test_question, subject="高等数学", upload_date="2025-10-11 09:00:00")
+    add_question(extra)
+    assert "高等数学" in get_all_subjects() and get_latest_question_date() == "2025-10-11"
+    delete_question(get_questions_by_subject("高等数学", limit=1)[0][0]['id'])
+    with get_db_connection() as conn:
+        rollup_before = [tuple(row) for row in conn.execute("SELECT * FROM question_daily_counts ORDER BY 1, 2")]
+    rebuild_rollups()
+    with get_db_connection() as conn:
+        rollup_after = [tuple(row) for row in conn.execute("SELECT * FROM question_daily_counts ORDER BY 1, 2")]
+    assert rollup_before == rollup_after, (rollup_before, rollup_after)
+
+    print("\n--- Testing pre-rendered analysis HTML ---")
+    question_id = get_questions_by_subject("物理化学", limit=1)[0][0]['id']
+    assert "<p>" in get_question_by_id(question_id)['problem_analysis_html']
+    update_question_analysis(question_id, dict(test_question, problem_analysis="## 新的解析"))
+    assert get_question_by_id(question_id)['problem_analysis_html'].startswith("<h2>")
+
     print("\n--- Database module tests completed successfully! ---")
 
@@ -0,0 +1,108 @@
+"""
+接口响应的 JSON 序列化。
+
+- FastJSONProvider：Flask 的 JSON provider，安装了 orjson 时用它序列化 jsonify 的响应，
+  没有安装时回退到标准库 json，行为与 Flask 默认的 provider 相同。
+- JSONFragment：已经是合法 JSON 的文本片段（例如数据库中保存的 knowledge_points），
+  放进响应对象后会原样拼接到输出中，不需要先 json.loads 再重新编码一遍。
+"""
+import re
+import json
+import secrets
+
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:  # orjson 是可选依赖
+    orjson = None
+
+# orjson 3.9 起原生支持拼接预先编码好的片段
+_HAS_ORJSON_FRAGMENT = orjson is not None and hasattr(orjson, "Fragment")
+if orjson is not None:
+    # 日期交给 Flask 的 _default 处理（HTTP 日期格式），与默认 provider 的输出保持一致
+    _ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+# 占位符以 NUL 加进程内随机数开头，正常数据不会与之冲突；编码后的样子是 "\u0000<token>:<序号>"
+_FRAGMENT_MARKER = f"\x00{secrets.token_hex(8)}:"
+_FRAGMENT_PATTERN = re.compile('"' + re.escape(json.dumps(_FRAGMENT_MARKER)[1:-1]) + r'(\d+)"')
+
+
+class JSONFragment:
+    """一段已经编码好的 JSON 文本，序列化时原样输出。调用方需要保证内容是合法的 JSON。"""
+    __slots__ = ("text",)
+
+    def __init__(self, text: str):
+        self.text = text
+
+
+def loads(text):
+    """解析 JSON 文本，有 orjson 时使用 orjson。解析失败时抛出 ValueError。"""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """支持 JSONFragment 的 JSON provider，优先使用 orjson。"""
+
+    def dumps(self, obj, **kwargs) -> str:
+        # 调试模式下需要缩进等标准库参数，交给父类处理
+        if orjson is not None and not kwargs.keys() - {"separators"}:
+            return self._dumps_bytes(obj).decode("utf-8")
+        return self._dumps_stdlib(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self._dumps_bytes(obj) + b"\n", mimetype=self.mimetype)
+
+    # --- 内部实现 ---
+
+    def _dumps_bytes(self, obj) -> bytes:
+        if _HAS_ORJSON_FRAGMENT:
+            return orjson.dumps(obj, default=_orjson_default, option=_ORJSON_OPTIONS)
+        fragments = _FragmentCollector()
+        data = orjson.dumps(obj, default=fragments.default, option=_ORJSON_OPTIONS)
+        return fragments.splice(data.decode("utf-8")).encode("utf-8") if fragments else data
+
+    def _dumps_stdlib(self, obj, **kwargs) -> str:
+        fragments = _FragmentCollector()
+        kwargs.setdefault("ensure_ascii", self.ensure_ascii)
+        kwargs.setdefault("sort_keys", self.sort_keys)
+        text = json.dumps(obj, default=fragments.default, **kwargs)
+        return fragments.splice(text) if fragments else text
+
+
+def _orjson_default(obj):
+    if isinstance(obj, JSONFragment):
+        return orjson.Fragment(obj.text)
+    return _default(obj)
+
+
+class _FragmentCollector:
+    """
+    没有原生片段支持时的拼接方式：先把每个片段序列化为带标记的占位字符串，
+    编码完成后用一次正则替换把占位符换回原始 JSON 文本。
+    """
+
+    def __init__(self):
+        self.fragments = []
+
+    def __bool__(self):
+        return bool(self.fragments)
+
+    def default(self, obj):
+        if isinstance(obj, JSONFragment):
+            self.fragments.append(obj.text)
+            return f"{_FRAGMENT_MARKER}{len(self.fragments) - 1}"
+        return _default(obj)
+
+    def splice(self, text: str) -> str:
+        return _FRAGMENT_PATTERN.sub(lambda m: self.fragments[int(m.group(1))], text)
@@ -1,127 +1,233 @@
-import time
+"""
+为还没有关键词的旧错题批量补全 keywords。
+
+- 使用 core 中的 AI 客户端和 .env 配置；
+- 多个线程并发请求 AI，用令牌桶把请求速率限制在服务商的 RPM / TPM 额度以内；
+- 每批结果在一个事务中写入数据库；每写完一批就记录检查点，中断后重新运行会从检查点继续；
+- --dry-run 只统计需要处理的行数并估算耗时，不调用 AI。
+
+用法:
+    python generate_keywords.py [--workers 8] [--rpm 60] [--tpm 100000] [--batch-size 100]
+                                [--dry-run] [--restart] [--user ID]
+"""
 import os
-from openai import OpenAI
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import core
 import database # 导入我们自己的数据库模块
 
-# --- AI 配置 ---
-# 强烈建议：未来将这些值放入 .env 文件中，并使用 load_dotenv() 加载
-# 这里为了方便根据你的要求直接写出
-API_KEY = "sk-7e7d8308bc9a4a2780242426b859e68d" 
-API_URL = "https://api.deepseek.com/v1"
-AI_MODEL = 'deepseek-chat'
-
-# --- 初始化 AI 客户端 ---
-try:
-    client = OpenAI(api_key=API_KEY, base_url=API_URL)
-    print("DeepSeek AI client initialized successfully.")
-except Exception as e:
-    print(f"Error initializing AI client: {e}")
-    client = None
-
-def generate_keywords_for_text(analysis_text: str) -> str | None:
-    """
-    调用 AI 模型为给定的文本生成结构化的关键词。
+# 并发请求数
+KEYWORD_BACKFILL_WORKERS = int(os.getenv("KEYWORD_BACKFILL_WORKERS", "8"))
+# 服务商的速率限制：每分钟请求数 (RPM) 与每分钟 token 数 (TPM)
+AI_RPM_LIMIT = int(os.getenv("AI_RPM_LIMIT", "60"))
+AI_TPM_LIMIT = int(os.getenv("AI_TPM_LIMIT", "100000"))
+# 每批写入数据库（并记录检查点）的行数
+KEYWORD_BACKFILL_BATCH_SIZE = int(os.getenv("KEYWORD_BACKFILL_BATCH_SIZE", "100"))
+# 提取关键词只需要解析的开头部分，过长的文本截断以节省 token
+KEYWORD_TEXT_MAX_CHARS = int(os.getenv("KEYWORD_TEXT_MAX_CHARS", "4000"))
+CHECKPOINT_FILE = "keyword_backfill.checkpoint.json"
+
+# 每次请求除解析文本外的固定开销（提示词 + 输出上限），用于预估 token
+_PROMPT_OVERHEAD_TOKENS = 350
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算一次关键词请求消耗的 token：解析文本的 token 加上固定开销。"""
+    return core.estimate_tokens(text) + _PROMPT_OVERHEAD_TOKENS
+
+
+class TokenBucket:
+    """令牌桶：容量为每分钟的额度，按速率连续补充，允许短时间的突发。线程安全。"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount: float = 1):
+        """取走 amount 个令牌，不够时阻塞等待（超过容量的请求按容量计算）。"""
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
 
-    Args:
-        analysis_text: 错题的 AI 解析文本。
+    def adjust(self, amount: float):
+        """按实际用量修正预估（amount 为正表示多扣，可以让余额暂时为负）。"""
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
 
-    Returns:
-        一个结构化的关键词字符串，或者在失败时返回 None。
+
+class RateLimiter:
+    """同时遵守 RPM 与 TPM 两个限制。"""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def acquire(self, estimated_tokens: int):
+        self.requests.acquire(1)
+        self.tokens.acquire(estimated_tokens)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens):
+        if actual_tokens:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+
+# --- 检查点 ---
+
+def load_checkpoint(path: str, db_path: str) -> int:
+    """读取检查点中记录的最后处理的错题 ID；检查点不存在或属于其它数据库时返回 0。"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return 0
+    return checkpoint.get("last_id", 0) if checkpoint.get("database") == db_path else 0
+
+
+def save_checkpoint(path: str, db_path: str, last_id: int):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"database": db_path, "last_id": last_id}, f)
+    os.replace(tmp_path, path)
+
+
+# --- 回填 ---
+
+def iter_batches(after_id: int, batch_size: int):
+    """按 id 顺序分批读取需要生成关键词的错题。"""
+    while True:
+        rows = database.get_questions_missing_keywords(after_id, batch_size)
+        # 读完一批立即归还连接，避免在等待 AI 期间占用连接池
+        database.release_db_connection()
+        if not rows:
+            return
+        yield [(row['id'], row['problem_analysis'] or "") for row in rows]
+        after_id = rows[-1]['id']
+
+
+def _generate(limiter: RateLimiter, question_id: int, text: str):
+    text = text[:KEYWORD_TEXT_MAX_CHARS]
+    if not text.strip():
+        return question_id, None, 0, "empty analysis"
+    estimated = estimate_tokens(text)
+    limiter.acquire(estimated)
+    result = core.generate_keywords_for_text(text)
+    limiter.record_usage(estimated, result.get("tokens"))
+    return question_id, result.get("keywords"), result.get("tokens") or estimated, result.get("error")
+
+
+def dry_run(after_id: int, batch_size: int, rpm: int, tpm: int, workers: int) -> dict:
+    """统计需要处理的行数和预估 token，按速率限制估算耗时，不调用 AI。"""
+    rows = tokens = 0
+    for batch in iter_batches(after_id, batch_size):
+        rows += len(batch)
+        tokens += sum(estimate_tokens(text[:KEYWORD_TEXT_MAX_CHARS]) for _, text in batch if text.strip())
+    minutes = max(rows / rpm, tokens / tpm) if rows else 0
+    report = {
+        "rows": rows,
+        "estimated_tokens": tokens,
+        "estimated_minutes": round(minutes, 1),
+        "limits": {"rpm": rpm, "tpm": tpm, "workers": workers},
+    }
+    print(f"[dry-run] {rows} questions need keywords, about {tokens} tokens; "
+          f"estimated {report['estimated_minutes']} minutes at {rpm} RPM / {tpm} TPM.")
+    return report
+
+
+def backfill(after_id: int = 0, workers: int = KEYWORD_BACKFILL_WORKERS, rpm: int = AI_RPM_LIMIT,
+             tpm: int = AI_TPM_LIMIT, batch_size: int = KEYWORD_BACKFILL_BATCH_SIZE,
+             checkpoint_path: str = CHECKPOINT_FILE) -> dict:
     """
-    if not client:
-        print("AI client is not available.")
-        return None
-    
-    if not analysis_text or not analysis_text.strip():
-        print("Input text is empty, skipping AI call.")
-        return None
-
-    prompt = f"""
-    你是一个信息检索专家。你的任务是根据下面提供的错题解析文本，提取出最核心的关键词。
-    请严格按照以下格式输出，不要有任何多余的解释、前言或结尾。
-
-    格式要求: [主要科目]-[知识面]-[关键词1, 关键词2, 关键词3]
-
-    例如，如果文本是关于电化学的，你的输出应该是：[物理化学]-[电化学]-[能斯特方程的应用, 平均离子活度, 吉布斯自由能]
-    又例如，如果文本是关于微积分的，你的输出应该是：[高等数学]-[微积分]-[洛必达法则, 极限求解, 导数应用]
-
-    现在，请为以下文本生成关键词：
-    ---
-    {analysis_text}
-    ---
+    从 after_id 之后开始为缺少关键词的错题生成关键词，返回吞吐量报告。
+    每批的结果一次性写入数据库，然后把检查点推进到这一批的最后一个 ID。
     """
+    db_path = database.current_database_path()
+    limiter = RateLimiter(rpm, tpm)
+    stats = {"processed": 0, "updated": 0, "failed": 0, "tokens": 0}
+    started = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="keywords") as executor:
+        for batch in iter_batches(after_id, batch_size):
+            results = list(executor.map(lambda item: _generate(limiter, *item), batch))
+            updates = [(question_id, keywords) for question_id, keywords, _, error in results if keywords and not error]
+            for question_id, _, _, error in results:
+                if error:
+                    print(f"Failed to generate keywords for question ID {question_id}: {error}")
+            if updates:
+                database.update_questions_keywords(updates)
+                database.release_db_connection()
+
+            stats["processed"] += len(batch)
+            stats["updated"] += len(updates)
+            stats["failed"] += len(batch) - len(updates)
+            stats["tokens"] += sum(tokens for _, _, tokens, _ in results)
+            save_checkpoint(checkpoint_path, db_path, batch[-1][0])
+
+            elapsed = time.perf_counter() - started
+            print(f"Processed {stats['processed']} questions up to ID {batch[-1][0]} "
+                  f"({stats['updated']} updated, {stats['failed']} failed, "
+                  f"{stats['processed'] / elapsed * 60:.0f} rows/min)")
+
+    elapsed = time.perf_counter() - started
+    stats["seconds"] = round(elapsed, 1)
+    stats["rows_per_minute"] = round(stats["processed"] / elapsed * 60, 1) if elapsed else 0
+    stats["tokens_per_minute"] = round(stats["tokens"] / elapsed * 60, 1) if elapsed else 0
+    # 全部完成后删除检查点；失败的行保持 keywords 为空，再次运行时会重新尝试
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return stats
 
-    try:
-        print("Sending request to AI for keyword generation...")
-        response = client.chat.completions.create(
-            model=AI_MODEL,
-            messages=[
-                {"role": "system", "content": "你是一个信息检索专家，严格按照指定格式输出。"},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=100,
-            temperature=0.1, # 使用较低的温度以获得更稳定、格式更一致的输出
-        )
-        
-        keywords = response.choices[0].message.content.strip()
-        
-        # 简单的格式验证
-        if keywords.startswith('[') and ']-[' in keywords and keywords.endswith(']'):
-            return keywords
-        else:
-            print(f"Warning: AI returned keywords in an unexpected format: {keywords}")
-            # 即使格式不对，也可能有用，我们先返回它
-            return keywords
-
-    except Exception as e:
-        print(f"An error occurred during AI keyword generation: {e}")
-        return None
 
 def main():
     """
     主执行函数。
     """
+    parser = argparse.ArgumentParser(description="为缺少关键词的错题批量生成关键词")
+    parser.add_argument("--workers", type=int, default=KEYWORD_BACKFILL_WORKERS, help="并发请求数")
+    parser.add_argument("--rpm", type=int, default=AI_RPM_LIMIT, help="每分钟最多请求数")
+    parser.add_argument("--tpm", type=int, default=AI_TPM_LIMIT, help="每分钟最多 token 数")
+    parser.add_argument("--batch-size", type=int, default=KEYWORD_BACKFILL_BATCH_SIZE, help="每批写入的行数")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_FILE, help="检查点文件路径")
+    parser.add_argument("--restart", action="store_true", help="忽略检查点，从头开始")
+    parser.add_argument("--dry-run", action="store_true", help="只统计并估算耗时，不调用 AI")
+    parser.add_argument("--user", help="多用户部署时要处理的用户 ID（默认使用 database.db）")
+    args = parser.parse_args()
+
     print("--- Starting Keyword Generation Script ---")
-    
+    if args.user:
+        database.use_user_database(args.user)
     # 确保数据库表结构是最新的
     database.init_db()
-    database.migrate_db()
 
-    # 1. 从数据库获取所有需要处理的错题
-    questions_to_process = database.get_all_questions_for_keyword_generation()
-    
-    if not questions_to_process:
-        print("All questions already have keywords. No work to do. Exiting.")
+    db_path = database.current_database_path()
+    after_id = 0 if args.restart else load_checkpoint(args.checkpoint, db_path)
+    if after_id:
+        print(f"Resuming from checkpoint: questions after ID {after_id}.")
+
+    if args.dry_run:
+        dry_run(after_id, args.batch_size, args.rpm, args.tpm, args.workers)
         return
 
-    total_questions = len(questions_to_process)
-    print(f"Found {total_questions} questions that need keywords.")
-
-    # 2. 遍历每条错题并处理
-    for i, question in enumerate(questions_to_process):
-        question_id = question['id']
-        analysis_text = question['problem_analysis']
-
-        
-        print(f"\n--- Processing question {i+1}/{total_questions} (ID: {question_id}) ---")
-        
-        # 3. 为解析文本生成关键词
-        generated_keywords = generate_keywords_for_text(analysis_text)
-        
-        # 4. 如果成功生成，则更新数据库
-        if generated_keywords:
-            print(f"Successfully generated keywords: {generated_keywords}")
-            try:
-                database.update_question_keywords(question_id, generated_keywords)
-            except Exception as e:
-                print(f"Error updating database for question ID {question_id}: {e}")
-        else:
-            print(f"Failed to generate keywords for question ID {question_id}. Skipping.")
-            
-        # 5. 礼貌地等待一下，避免触发 API 的速率限制
-        time.sleep(1) 
-
-    print("\n--- Keyword Generation Script Finished ---")
+    report = backfill(after_id, args.workers, args.rpm, args.tpm, args.batch_size, args.checkpoint)
+    print(f"\n--- Keyword Generation Script Finished: {report} ---")
 
 
 if __name__ == '__main__':
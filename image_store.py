@@ -0,0 +1,201 @@
+import os
+import re
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# 图片仓库目录：原始图片按内容的 SHA-256 命名存放，数据库中只保存哈希
+IMAGE_STORE_DIR = os.path.abspath(os.getenv("IMAGE_STORE_DIR", "image_store"))
+
+_HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# 列表视图使用的缩略图/预览图尺寸（最长边像素）
+VARIANTS = {
+    "thumb": 320,
+    "medium": 1024,
+}
+VARIANT_QUALITY = int(os.getenv("IMAGE_VARIANT_QUALITY", "80"))
+# 生成缩略图的进程数，放在独立进程中避免占用请求线程和 GIL
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+# 本进程中正在生成、以及生成失败（格式不支持或文件损坏）的图片，不再重复提交
+_pending_variants = set()
+_failed_variants = set()
+_variants_pid = None
+_variants_lock = threading.Lock()
+
+# 常见图片格式的文件头签名
+_SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+
+def detect_image_mime(image_bytes: bytes, default: str = "image/jpeg") -> str:
+    """根据文件头判断图片的真实格式，无法识别时返回 default。"""
+    head = image_bytes[:16]
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, mime in _SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    return default
+
+
+def compute_image_hash(image_bytes: bytes) -> str:
+    """计算图片内容的 SHA-256 十六进制摘要。"""
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def is_valid_hash(image_hash: str) -> bool:
+    """检查字符串是否是合法的 SHA-256 十六进制摘要（防止路径穿越）。"""
+    return bool(image_hash) and bool(_HASH_PATTERN.match(image_hash))
+
+
+def get_image_path(image_hash: str) -> str:
+    """返回某个哈希对应的图片文件路径（按前两位分目录，避免单目录文件过多）。"""
+    return os.path.join(IMAGE_STORE_DIR, image_hash[:2], image_hash)
+
+
+def image_exists(image_hash: str) -> bool:
+    return is_valid_hash(image_hash) and os.path.exists(get_image_path(image_hash))
+
+
+def save_image(image_bytes: bytes) -> str:
+    """
+    将图片写入仓库并返回其哈希。
+    相同内容只会保存一份：如果文件已存在则直接返回哈希。
+    """
+    image_hash = compute_image_hash(image_bytes)
+    path = get_image_path(image_hash)
+    if os.path.exists(path):
+        return image_hash
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 先写临时文件再原子替换，避免并发上传或进程中断时留下半个文件
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(image_bytes)
+    os.replace(tmp_path, path)
+    return image_hash
+
+
+def load_image(image_hash: str) -> bytes:
+    """读取某个哈希对应的原始图片字节。"""
+    if not is_valid_hash(image_hash):
+        raise ValueError(f"Invalid image hash: {image_hash!r}")
+    with open(get_image_path(image_hash), "rb") as f:
+        return f.read()
+
+
+def get_image_mime(image_hash: str) -> str:
+    """读取文件头判断已存储图片的 MIME 类型。"""
+    with open(get_image_path(image_hash), "rb") as f:
+        return detect_image_mime(f.read(16))
+
+
+# --- 缩略图与预览图 ---
+
+def _variant_format() -> tuple:
+    """优先输出 WebP，Pillow 不支持时回退到 JPEG。返回 (PIL 格式名, 扩展名)。"""
+    from PIL import features
+    if features.check("webp"):
+        return "WEBP", "webp"
+    return "JPEG", "jpg"
+
+
+def get_variant_path(image_hash: str, variant: str):
+    """返回已生成的某个尺寸变体的路径，尚未生成时返回 None。"""
+    base = get_image_path(image_hash)
+    for ext in ("webp", "jpg"):
+        path = f"{base}.{variant}.{ext}"
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def generate_variants(image_hash: str) -> list:
+    """
+    为一张已存储的图片生成所有尺寸变体（在进程池中执行）。
+    已存在的变体会被跳过，返回本次新生成的变体名列表。
+    """
+    from PIL import Image, ImageOps
+
+    pil_format, ext = _variant_format()
+    base = get_image_path(image_hash)
+    created = []
+    with Image.open(base) as original:
+        # 手机照片常带 EXIF 旋转信息，先摆正再缩放
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+
+        for variant, max_edge in VARIANTS.items():
+            if get_variant_path(image_hash, variant):
+                continue
+            resized = image.copy()
+            resized.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            path = f"{base}.{variant}.{ext}"
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            resized.save(tmp_path, format=pil_format, quality=VARIANT_QUALITY, optimize=True)
+            os.replace(tmp_path, path)
+            created.append(variant)
+    return created
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    """
+    按进程懒加载进程池（gunicorn fork 出的 worker 各自持有自己的进程池）。
+    调用方是多线程的（请求线程、分析任务线程池），在这样的进程中 fork 可能继承别的线程持有的锁，
+    因此用 spawn 方式启动子进程。
+    """
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ProcessPoolExecutor(
+                max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn")
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _log_variant_result(image_hash: str, future):
+    error = future.exception()
+    with _variants_lock:
+        _pending_variants.discard(image_hash)
+        if error:
+            _failed_variants.add(image_hash)
+    if error:
+        print(f"Failed to generate image variants for {image_hash}: {error}")
+    elif future.result():
+        print(f"Generated image variants {future.result()} for {image_hash}")
+
+
+def enqueue_variants(image_hash: str):
+    """
+    把缩略图生成任务提交到后台进程池，立即返回，不阻塞请求。
+    同一张图片正在生成或在本进程中已经生成失败时直接跳过。
+    """
+    global _variants_pid
+    with _variants_lock:
+        if _variants_pid != os.getpid():
+            # fork 出的子进程看不到父进程提交的任务完成，重新开始记录
+            _pending_variants.clear()
+            _variants_pid = os.getpid()
+        if image_hash in _pending_variants or image_hash in _failed_variants:
+            return
+        _pending_variants.add(image_hash)
+    try:
+        future = _get_executor().submit(generate_variants, image_hash)
+        future.add_done_callback(lambda f: _log_variant_result(image_hash, f))
+    except Exception as e:
+        with _variants_lock:
+            _pending_variants.discard(image_hash)
+        print(f"Failed to enqueue image variants for {image_hash}: {e}")
@@ -0,0 +1,189 @@
+"""
+错题分析的后台任务。
+
+/upload 只保存图片并创建任务，立即返回任务 ID；AI 分析在后台线程池中执行，
+完成后写入错题并把任务标记为成功。分析以流式方式请求，已经生成的字段会随时写入任务的
+partial_result，前端通过 /jobs/<id>/events 边生成边显示。失败的任务按指数退避自动重试，超过次数后标记为 failed，
+可以通过 /jobs/<id>/retry 手动重试（图片已经保存，不需要重新上传）。
+
+任务状态保存在各自的数据库中（见 database.create_analysis_job），进程重启后会自动恢复未完成的任务。
+"""
+import os
+import json
+import uuid
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import core
+import database
+import image_store
+
+# 同时执行的分析任务数（每个进程）
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# 每个任务最多自动尝试的次数
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# 第一次重试前等待的秒数，之后每次翻倍
+JOB_RETRY_DELAY_SECONDS = float(os.getenv("JOB_RETRY_DELAY_SECONDS", "10"))
+# running 状态超过这么久没有更新，认为执行它的进程已经退出，启动时重新排队
+JOB_STALE_SECONDS = int(os.getenv("JOB_STALE_SECONDS", "900"))
+# 流式分析时，正在生成的文本最多每隔这么多秒写入一次数据库（完整的字段到达时立即写入）
+JOB_PARTIAL_FLUSH_SECONDS = float(os.getenv("JOB_PARTIAL_FLUSH_SECONDS", "1"))
+
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+_JOB_DETAIL_COLUMNS = database.ANALYSIS_JOB_COLUMNS + ("user_question", "image_hash")
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """按进程懒加载线程池（gunicorn fork 出的 worker 各自持有自己的线程池）。"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="analysis-job")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _schedule(db_path: str, job_id: str, run_at: str = None):
+    """把任务交给线程池；run_at 在将来时先等待到那个时间。"""
+    delay = 0.0
+    if run_at:
+        delay = (datetime.strptime(run_at, _TIME_FORMAT) - datetime.now()).total_seconds()
+    if delay > 0:
+        timer = threading.Timer(delay, _schedule, args=(db_path, job_id))
+        timer.daemon = True
+        timer.start()
+        return
+    _get_executor().submit(_run_job, db_path, job_id)
+
+
+def submit_analysis_job(subject: str, user_question: str, image_hash: str) -> str:
+    """在当前数据库中创建一个分析任务并提交执行，返回任务 ID。"""
+    job_id = uuid.uuid4().hex
+    database.create_analysis_job(job_id, subject, user_question, image_hash, JOB_MAX_ATTEMPTS)
+    _schedule(database.current_database_path(), job_id)
+    print(f"Queued analysis job {job_id} for subject: {subject}")
+    return job_id
+
+
+def retry_analysis_job(job_id: str) -> bool:
+    """手动重试一个失败的任务；任务不存在或不是 failed 状态时返回 False。"""
+    if not database.reset_analysis_job(job_id):
+        return False
+    _schedule(database.current_database_path(), job_id)
+    print(f"Re-queued analysis job {job_id}")
+    return True
+
+
+def get_job_status(job_id: str, include_partial: bool = False):
+    """
+    返回任务的状态字典，任务不存在时返回 None。
+    include_partial=True 时附带 partial：{"fields": 已完整到达的字段, "streaming": [字段名, 正在生成的文本] 或 None}。
+    """
+    columns = database.ANALYSIS_JOB_COLUMNS + (("partial_result",) if include_partial else ())
+    job = database.get_analysis_job(job_id, columns=columns)
+    if not job:
+        return None
+    job = dict(job)
+    if include_partial:
+        partial_result = job.pop('partial_result')
+        job['partial'] = json.loads(partial_result) if partial_result else None
+    return job
+
+
+class _PartialResultWriter:
+    """收集流式分析中到达的结果，写入任务的 partial_result。"""
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.fields = {}
+        self.streaming = None
+
+    def on_field(self, field, value):
+        self.fields[field] = value
+        self.streaming = None
+        self._flush()
+
+    def on_partial(self, field, text):
+        self.streaming = [field, text]
+        self._flush()
+
+    def _flush(self):
+        try:
+            database.update_analysis_job_partial(self.job_id, {"fields": self.fields, "streaming": self.streaming})
+        except Exception as e:
+            # 中间结果只用于显示进度，写入失败不影响分析本身
+            print(f"Failed to save partial result for analysis job {self.job_id}: {e}")
+
+
+def _run_job(db_path: str, job_id: str):
+    """在线程池中执行一个任务。数据库路由是按线程的，需要先切换到任务所在的数据库。"""
+    database.use_database(db_path)
+    try:
+        if not database.claim_analysis_job(job_id):
+            # 已经被其它进程执行，或已被删除
+            return
+        job = database.get_analysis_job(job_id, columns=_JOB_DETAIL_COLUMNS)
+        try:
+            writer = _PartialResultWriter(job_id)
+            result = core.stream_question_analysis(
+                image_store.load_image(job['image_hash']), job['user_question'],
+                on_field=writer.on_field, on_partial=writer.on_partial, partial_interval=JOB_PARTIAL_FLUSH_SECONDS,
+            )
+            if "error" in result:
+                raise RuntimeError(result["error"])
+            question_data = core.build_question_data(
+                result, job['image_hash'], job['subject'], job['user_question'], upload_date=job['created_at']
+            )
+            question_id = database.complete_analysis_job(job_id, question_data)
+            print(f"Analysis job {job_id} succeeded (question ID {question_id}, attempt {job['attempts']}).")
+        except Exception as e:
+            _handle_failure(db_path, job, e)
+    except Exception as e:
+        print(f"Analysis job {job_id} crashed: {e}")
+    finally:
+        database.release_db_connection()
+
+
+def _handle_failure(db_path: str, job, error: Exception):
+    job_id, attempts = job['id'], job['attempts']
+    if attempts < job['max_attempts']:
+        delay = JOB_RETRY_DELAY_SECONDS * 2 ** (attempts - 1)
+        retry_at = (datetime.now() + timedelta(seconds=delay)).strftime(_TIME_FORMAT)
+        database.fail_analysis_job(job_id, str(error), retry_at)
+        print(f"Analysis job {job_id} failed (attempt {attempts}/{job['max_attempts']}): {error}. Retrying at {retry_at}.")
+        _schedule(db_path, job_id, retry_at)
+    else:
+        database.fail_analysis_job(job_id, str(error))
+        print(f"Analysis job {job_id} failed permanently after {attempts} attempts: {error}")
+
+
+def recover_jobs() -> int:
+    """把所有数据库中未完成的任务重新提交执行（进程启动时调用），返回提交的任务数。"""
+    stale_before = (datetime.now() - timedelta(seconds=JOB_STALE_SECONDS)).strftime(_TIME_FORMAT)
+    recovered = 0
+    for db_path in database.list_database_files():
+        database.use_database(db_path)
+        try:
+            for job in database.get_unfinished_analysis_jobs(stale_before):
+                _schedule(db_path, job['id'], job['next_attempt_at'])
+                recovered += 1
+        except Exception as e:
+            print(f"Failed to recover analysis jobs from {db_path}: {e}")
+        finally:
+            database.release_db_connection()
+    database.use_database(None)
+    if recovered:
+        print(f"Recovered {recovered} unfinished analysis jobs.")
+    return recovered
+
+
+def start_job_recovery():
+    """在后台线程中恢复未完成的任务，不阻塞应用启动。"""
+    thread = threading.Thread(target=recover_jobs, name="analysis-job-recovery", daemon=True)
+    thread.start()
+    return thread
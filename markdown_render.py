@@ -0,0 +1,42 @@
+"""
+Markdown 渲染及其缓存。
+
+AI 生成的解析很长（公式多），每次渲染都要重新解析一遍。渲染结果按内容哈希缓存在进程内的 LRU 中，
+同一段文本只渲染一次；错题的 problem_analysis 另外在写入时预先渲染并保存到 problem_analysis_html 列
+（见 database.DB_STORE_RENDERED_HTML）。
+"""
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+from markdown_it import MarkdownIt
+
+# 进程内缓存的渲染结果条数
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", "512"))
+
+_md = MarkdownIt()
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def render_markdown(text) -> str:
+    """把 Markdown 文本渲染为 HTML，相同内容直接返回缓存的结果。"""
+    if not text:
+        return ""
+    key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+    with _cache_lock:
+        html = _cache.get(key)
+        if html is not None:
+            _cache.move_to_end(key)
+            return html
+
+    # 渲染在锁外进行，并发请求偶尔会重复渲染同一段文本，但不会互相阻塞
+    html = _md.render(text)
+    with _cache_lock:
+        _cache[key] = html
+        _cache.move_to_end(key)
+        while len(_cache) > MARKDOWN_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return html
+
@@ -0,0 +1,273 @@
+"""
+错题本的批量导出 / 导入。
+
+归档是一个 zip 文件：
+    manifest.json              格式版本、导出时间、各表行数
+    questions.ndjson           每行一条错题（JSON）
+    careless_mistakes.ndjson   每行一条粗心错误
+    daily_summaries.ndjson     每行一条每日总结
+    images/<sha256>            原始图片（与 image_store 中的文件相同）
+
+导出时逐行读取游标并直接写入 zip，内存占用与错题数量无关；
+导入时用 executemany 分大批写入，图片按哈希去重，不会调用 AI。
+
+用法:
+    python notebook_archive.py export notebook.zip [--user ID]
+    python notebook_archive.py import notebook.zip [--user ID]
+"""
+import os
+import io
+import json
+import hashlib
+import zipfile
+import argparse
+from datetime import datetime
+
+import database
+import image_store
+
+ARCHIVE_FORMAT = "errornotebook-archive"
+ARCHIVE_VERSION = 1
+# 导入时每个事务写入的行数
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+# 每张表导出的字段（不导出自增 id，导入时重新分配）
+ARCHIVE_TABLES = {
+    "questions": (
+        "subject", "upload_date", "image_hash", "user_question", "problem_analysis",
+        "knowledge_points", "ai_analysis", "similar_examples", "my_insight", "keywords",
+    ),
+    "careless_mistakes": ("upload_date", "image_hash", "user_reflection"),
+    "daily_summaries": (
+        "summary_date", "general_summary", "knowledge_points_summary",
+        "question_count", "subject_chart_data", "created_at",
+    ),
+}
+
+# 导入时跳过已存在的记录，重复导入同一个归档不会产生重复数据
+_DUPLICATE_CONDITIONS = {
+    "questions": "upload_date = :upload_date AND image_hash IS :image_hash AND subject = :subject",
+    "careless_mistakes": "upload_date = :upload_date AND image_hash IS :image_hash",
+    "daily_summaries": "summary_date = :summary_date",
+}
+
+# 导入时需要额外填写的列：旧表结构中 NOT NULL 的内联图片字段，新记录留空
+_IMPORT_EXTRA_VALUES = {
+    "questions": {"original_image_b64": "''"},
+    "careless_mistakes": {"original_image_b64": "''"},
+}
+
+
+# --- 导出 ---
+
+def _iter_rows(table: str):
+    """按 id 顺序逐行读取某张表，不把整张表读进内存。"""
+    columns = ", ".join(ARCHIVE_TABLES[table])
+    with database.get_db_connection() as conn:
+        for row in conn.execute(f"SELECT {columns} FROM {table} ORDER BY id"):
+            yield dict(row)
+
+
+def _iter_image_hashes():
+    """列出所有被引用的图片哈希（去重在 SQL 中完成）。"""
+    with database.get_db_connection() as conn:
+        for row in conn.execute("""
+            SELECT image_hash FROM questions WHERE image_hash != ''
+            UNION
+            SELECT image_hash FROM careless_mistakes WHERE image_hash != ''
+        """):
+            yield row['image_hash']
+
+
+def export_notebook(output) -> dict:
+    """
+    把当前数据库（见 database.use_database）中的错题本导出为 zip 归档。
+    output 可以是文件路径，也可以是可写的二进制文件对象。返回 manifest。
+    """
+    # 先把旧的内联图片等数据迁移到最新结构，保证每条记录都只引用 image_store 中的图片
+    database.migrate_db()
+
+    counts = {}
+    missing_images = 0
+    with zipfile.ZipFile(output, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for table in ARCHIVE_TABLES:
+            count = 0
+            with archive.open(f"{table}.ndjson", "w") as raw:
+                stream = io.TextIOWrapper(raw, encoding="utf-8", newline="\n")
+                for row in _iter_rows(table):
+                    stream.write(json.dumps(row, ensure_ascii=False))
+                    stream.write("\n")
+                    count += 1
+                stream.flush()
+                stream.detach()
+            counts[table] = count
+            print(f"Exported {count} rows from '{table}'.")
+
+        image_count = 0
+        for image_hash in _iter_image_hashes():
+            if not image_store.image_exists(image_hash):
+                missing_images += 1
+                print(f"Warning: image {image_hash} is referenced but missing from the image store.")
+                continue
+            # 图片本身已经是压缩格式，直接存储不再压缩
+            archive.write(image_store.get_image_path(image_hash), f"images/{image_hash}",
+                          compress_type=zipfile.ZIP_STORED)
+            image_count += 1
+        counts["images"] = image_count
+        print(f"Exported {image_count} images.")
+
+        manifest = {
+            "format": ARCHIVE_FORMAT,
+            "version": ARCHIVE_VERSION,
+            "schema_version": database.get_schema_version(),
+            "exported_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "counts": counts,
+            "missing_images": missing_images,
+        }
+        archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+    return manifest
+
+
+# --- 导入 ---
+
+def _read_manifest(archive: zipfile.ZipFile) -> dict:
+    try:
+        manifest = json.loads(archive.read("manifest.json"))
+    except KeyError:
+        raise ValueError("Not a notebook archive: manifest.json is missing")
+    if manifest.get("format") != ARCHIVE_FORMAT:
+        raise ValueError(f"Not a notebook archive: unexpected format {manifest.get('format')!r}")
+    if manifest.get("version", 0) > ARCHIVE_VERSION:
+        raise ValueError(f"Archive version {manifest['version']} is newer than supported ({ARCHIVE_VERSION})")
+    return manifest
+
+
+def _import_images(archive: zipfile.ZipFile) -> tuple:
+    """把归档中的图片写入 image_store，已存在的哈希直接跳过。返回 (新增数, 跳过数)。"""
+    added = skipped = 0
+    for info in archive.infolist():
+        if not info.filename.startswith("images/") or info.is_dir():
+            continue
+        image_hash = info.filename[len("images/"):]
+        if not image_store.is_valid_hash(image_hash):
+            print(f"Skipping unexpected archive entry: {info.filename}")
+            continue
+        if image_store.image_exists(image_hash):
+            skipped += 1
+            continue
+
+        path = image_store.get_image_path(image_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # 边复制边计算哈希，校验内容与文件名一致，避免损坏的归档污染图片仓库
+        digest = hashlib.sha256()
+        with archive.open(info) as source, open(tmp_path, "wb") as target:
+            for chunk in iter(lambda: source.read(_COPY_CHUNK_SIZE), b""):
+                digest.update(chunk)
+                target.write(chunk)
+        if digest.hexdigest() != image_hash:
+            os.remove(tmp_path)
+            print(f"Skipping corrupted image {image_hash} (content hash {digest.hexdigest()}).")
+            continue
+        os.replace(tmp_path, path)
+        added += 1
+    return added, skipped
+
+
+def _iter_archive_rows(archive: zipfile.ZipFile, table: str):
+    try:
+        raw = archive.open(f"{table}.ndjson")
+    except KeyError:
+        return
+    with raw, io.TextIOWrapper(raw, encoding="utf-8") as stream:
+        for line in stream:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _import_table(archive: zipfile.ZipFile, table: str, batch_size: int) -> tuple:
+    """分批把某张表的行写入数据库，每批一个事务。返回 (新增数, 总行数)。"""
+    columns = ARCHIVE_TABLES[table]
+    extra = _IMPORT_EXTRA_VALUES.get(table, {})
+    column_sql = ", ".join(list(columns) + list(extra))
+    value_sql = ", ".join([f":{column}" for column in columns] + list(extra.values()))
+    sql = (
+        f"INSERT INTO {table} ({column_sql}) SELECT {value_sql} "
+        f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {_DUPLICATE_CONDITIONS[table]})"
+    )
+
+    inserted = total = 0
+    batch = []
+    for row in _iter_archive_rows(archive, table):
+        values = {column: row.get(column) for column in columns}
+        # 接口响应会把 JSON 字段原样拼接输出，导入的内容必须是合法的 JSON
+        if table == "questions":
+            for column in database.QUESTION_JSON_COLUMNS:
+                values[column] = database.normalize_json_text(values[column])
+        # 长文本字段按当前的 DB_COMPRESS_TEXT 设置编码
+        for column in database.COMPRESSED_COLUMNS.get(table, ()):
+            if column in values:
+                values[column] = database.encode_text(values[column])
+        batch.append(values)
+        total += 1
+        if len(batch) >= batch_size:
+            with database.transaction() as conn:
+                inserted += conn.executemany(sql, batch).rowcount
+            batch.clear()
+            print(f"Imported {total} rows into '{table}'...")
+    if batch:
+        with database.transaction() as conn:
+            inserted += conn.executemany(sql, batch).rowcount
+    return inserted, total
+
+
+def import_notebook(source, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """
+    把 zip 归档导入当前数据库（见 database.use_database）。
+    source 可以是文件路径，也可以是可读的二进制文件对象。返回各表的导入统计。
+    """
+    database.migrate_db()
+    result = {}
+    with zipfile.ZipFile(source, "r") as archive:
+        manifest = _read_manifest(archive)
+        print(f"Importing archive exported at {manifest.get('exported_at')}: {manifest.get('counts')}")
+
+        # 先写图片，再写引用图片的记录
+        added, skipped = _import_images(archive)
+        result["images"] = {"added": added, "skipped": skipped}
+        print(f"Imported {added} images ({skipped} already present).")
+
+        for table in ARCHIVE_TABLES:
+            inserted, total = _import_table(archive, table, batch_size)
+            result[table] = {"added": inserted, "skipped": total - inserted}
+            print(f"Imported {inserted} of {total} rows into '{table}'.")
+
+    # 全文索引和首页统计由触发器维护；关键词倒排索引、预渲染的解析 HTML 和每题摘要需要在导入后补建
+    database.index_pending_keywords()
+    database.render_pending_html()
+    database.fill_pending_digests()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导出或导入错题本归档 (zip + NDJSON)")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="归档文件路径")
+    parser.add_argument("--user", help="多用户部署时要操作的用户 ID（默认使用 database.db）")
+    args = parser.parse_args()
+
+    if args.user:
+        database.use_user_database(args.user)
+    database.init_db()
+
+    if args.action == "export":
+        manifest = export_notebook(args.path)
+        print(f"Export finished: {manifest['counts']}")
+    else:
+        result = import_notebook(args.path)
+        print(f"Import finished: {result}")
+
+
+if __name__ == "__main__":
+    main()
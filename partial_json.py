@@ -0,0 +1,135 @@
+"""
+流式输出的 JSON 对象的增量解析。
+
+AI 以 stream=True 返回分析结果时，JSON 文本是一小段一小段到达的。StreamingObjectParser 逐段接收文本，
+每当顶层对象中的某个字段的值完整到达，就立即把它解析出来，不需要等整个对象结束；
+还没有结束的字符串字段也可以通过 partial_string() 取到已经到达的部分，用于边生成边显示。
+
+只处理顶层是一个对象的情况；对象之前的多余内容（例如 ```json 代码块标记）会被跳过。
+"""
+import json
+
+_WHITESPACE = " \t\r\n"
+
+
+class StreamingObjectParser:
+    """增量解析一个 JSON 对象的顶层字段。"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields = {}
+        self.done = False
+        self._pos = 0
+        self._state = "start"
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> list:
+        """接收一段文本，返回这段文本使之完整的字段列表 [(字段名, 值), ...]。"""
+        self.buffer += chunk
+        completed = []
+        buffer = self.buffer
+        while self._pos < len(buffer) and not self.done:
+            ch = buffer[self._pos]
+            state = self._state
+
+            if state == "start":
+                if ch == "{":
+                    self._state = "key"
+            elif state == "key":
+                if ch == '"':
+                    self._key_start = self._pos
+                    self._escape = False
+                    self._state = "in_key"
+                elif ch == "}":
+                    self.done = True
+            elif state == "in_key":
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._key = json.loads(buffer[self._key_start:self._pos + 1])
+                    self._state = "colon"
+            elif state == "colon":
+                if ch == ":":
+                    self._state = "value"
+            elif state == "value":
+                if ch not in _WHITESPACE:
+                    self._value_start = self._pos
+                    self._depth = 1 if ch in "[{" else 0
+                    self._in_string = ch == '"'
+                    self._escape = False
+                    self._state = "in_value"
+                    if ch not in '"[{':
+                        # 数字、true/false/null：读到分隔符为止
+                        self._state = "in_scalar"
+            elif state == "in_value":
+                if self._scan_value_char(ch):
+                    completed.append(self._finish_value(self._pos + 1))
+                    self._state = "after_value"
+            elif state == "in_scalar":
+                if ch in ",}" or ch in _WHITESPACE:
+                    completed.append(self._finish_value(self._pos))
+                    self._state = "after_value"
+                    continue  # 分隔符交给 after_value 处理
+            elif state == "after_value":
+                if ch == ",":
+                    self._state = "key"
+                elif ch == "}":
+                    self.done = True
+            self._pos += 1
+        return [item for item in completed if item is not None]
+
+    def partial_string(self):
+        """
+        正在到达的字符串字段：返回 (字段名, 已经到达的文本)；当前不在字符串字段中时返回 None。
+        末尾不完整的转义序列会被去掉。
+        """
+        if self._state != "in_value" or self.buffer[self._value_start] != '"':
+            return None
+        raw = self.buffer[self._value_start + 1:self._pos]
+        # 最长的转义序列是 \\uXXXX（6 个字符），从末尾逐个去掉字符直到能解析
+        for cut in range(0, min(len(raw), 6) + 1):
+            try:
+                return self._key, json.loads('"' + raw[:len(raw) - cut] + '"')
+            except ValueError:
+                continue
+        return None
+
+    # --- 内部实现 ---
+
+    def _scan_value_char(self, ch: str) -> bool:
+        """扫描字符串/数组/对象值中的一个字符，值结束时返回 True。"""
+        if self._in_string:
+            if self._escape:
+                self._escape = False
+            elif ch == "\\":
+                self._escape = True
+            elif ch == '"':
+                self._in_string = False
+                # 顶层字符串的结束引号（开头的引号在 value 状态已经处理过）
+                return self._depth == 0
+            return False
+        if ch == '"':
+            self._in_string = True
+        elif ch in "[{":
+            self._depth += 1
+        elif ch in "]}":
+            self._depth -= 1
+            return self._depth == 0
+        return False
+
+    def _finish_value(self, end: int):
+        text = self.buffer[self._value_start:end]
+        try:
+            value = json.loads(text)
+        except ValueError:
+            # 单个字段解析失败不影响其余字段，完整结果仍以整体解析为准
+            return None
+        self.fields[self._key] = value
+        return self._key, value
@@ -68,7 +68,7 @@
                 if (!activePane) { alert('请先选择一个科目！'); return; }
 
                 activePane.innerHTML = '<div class="loader">加载中...</div>';
-                activePane.dataset.page = '1';
+                activePane.dataset.cursor = '';
                 activePane.dataset.hasMore = 'true';
                 activePane.dataset.lastDate = '';
                 activePane.dataset.currentDate = date;
@@ -4,22 +4,28 @@
         const container = document.querySelector('#careless-mistake-tab');
         if (!container || container.dataset.isLoading === 'true' || container.dataset.hasMore === 'false') return;
 
-        let page = parseInt(container.dataset.page || '1', 10);
+        // 游标分页：cursor 为空表示第一页，之后使用服务器返回的 next_cursor
+        const cursor = container.dataset.cursor || '';
         container.dataset.isLoading = 'true';
         const loader = container.querySelector('.loader');
         if (loader) loader.style.display = 'block';
 
-        fetch(`/get-careless-mistakes?page=${page}`)
+        let apiUrl = '/get-careless-mistakes';
+        if (cursor) apiUrl += `?cursor=${encodeURIComponent(cursor)}`;
+
+        fetch(apiUrl)
             .then(response => response.json())
-            .then(mistakes => {
+            .then(data => {
+                const mistakes = data.items || [];
                 if (loader) loader.style.display = 'none';
                 if (mistakes.length > 0) {
                     const list = container.querySelector('.careless-mistake-list');
                     renderCarelessMistakes(mistakes, list);
-                    container.dataset.page = page + 1;
-                } else {
+                    container.dataset.cursor = data.next_cursor || '';
+                }
+                if (!data.next_cursor) {
                     container.dataset.hasMore = 'false';
-                    const message = page === 1 ? '这里还没有记录哦。' : '已经到底啦！';
+                    const message = (!cursor && mistakes.length === 0) ? '这里还没有记录哦。' : '已经到底啦！';
                     if (!container.querySelector('.end-message')) container.insertAdjacentHTML('beforeend', `<p class="end-message">${message}</p>`);
                 }
             })
@@ -42,7 +48,7 @@
                 </div>
                 <div class="date-header-inline">${m.upload_date.split(' ')[0]}</div>
                 <h3>原题图片</h3>
-                <img src="data:image/jpeg;base64,${m.original_image_b64}" alt="错题图片">
+                <a href="${m.image_url}" target="_blank" title="查看原图"><img src="${m.preview_url}" srcset="${m.thumb_url} 320w, ${m.preview_url} 1024w" sizes="(max-width: 600px) 100vw, 800px" loading="lazy" alt="错题图片"></a>
                 <h3>我的反思</h3>
                 <div class="user-reflection-content">${m.user_reflection}</div>
             </div>`;
@@ -61,7 +61,8 @@
          */
         function createQuestionCardHTML(q) {
             // 【修改】在插入HTML前，先用 marked.js 解析可能包含Markdown的字段
-            const problemAnalysisHtml = q.problem_analysis ? marked.parse(q.problem_analysis) : '<p>暂无解析。</p>';
+            // 解析由服务器预先渲染 (render=html)，不再在浏览器中重新解析
+            const problemAnalysisHtml = q.problem_analysis_html || (q.problem_analysis ? marked.parse(q.problem_analysis) : '<p>暂无解析。</p>');
 
             const knowledgePointsHtml = q.knowledge_points && q.knowledge_points.length > 0
                 // 使用 marked.parseInline() 来避免在 li 标签内产生多余的 <p> 标签
@@ -98,11 +99,12 @@
                 </div>
 
                 <div class="date-header">${new Date(q.upload_date).toLocaleDateString()} - ${q.subject}</div>
+                ${q.snippet ? `<p class="search-snippet">${q.snippet}</p>` : ''}
                 
                 <div class="question-content-wrapper">
                     <div class="question-image-wrapper">
                         <h3>原题图片</h3>
-                        <img src="data:image/jpeg;base64,${q.original_image_b64}" alt="错题图片">
+                        <a href="${q.image_url}" target="_blank" title="查看原图"><img src="${q.preview_url}" srcset="${q.thumb_url} 320w, ${q.preview_url} 1024w" sizes="(max-width: 600px) 100vw, 800px" loading="lazy" alt="错题图片"></a>
                     </div>
                     <div class="question-analysis-wrapper">
                         <h3>AI 解析</h3>
@@ -127,15 +129,35 @@
             `;
         }
 
+        // 粗心错误的搜索结果卡片（只读展示）
+        function createCarelessCardHTML(m) {
+            return `
+            <div class="question-block careless-mistake-block" data-mistake-id="${m.id}">
+                <div class="date-header">${new Date(m.upload_date).toLocaleDateString()} - 计算错误</div>
+                ${m.snippet ? `<p class="search-snippet">${m.snippet}</p>` : ''}
+                <a href="${m.image_url}" target="_blank" title="查看原图"><img src="${m.preview_url}" srcset="${m.thumb_url} 320w, ${m.preview_url} 1024w" sizes="(max-width: 600px) 100vw, 800px" loading="lazy" alt="错题图片"></a>
+                <h3>我的反思</h3>
+                <div class="user-reflection-content">${m.user_reflection}</div>
+            </div>
+            `;
+        }
+
         // 3. 渲染搜索结果 (使用新的卡片生成函数)
-        function renderResults(questions) {
+        function renderResults(results) {
+            const questions = (results && results.questions) || [];
+            const carelessMistakes = (results && results.careless_mistakes) || [];
             resultsContainer.innerHTML = '';
-            if (!questions || questions.length === 0) {
+            if (questions.length === 0 && carelessMistakes.length === 0) {
                 resultsContainer.innerHTML = '<div class="placeholder">未找到相关错题。</div>';
                 return;
             }
             // 使用 map 和 join 一次性更新 innerHTML，性能稍好
-            resultsContainer.innerHTML = questions.map(createQuestionCardHTML).join('');
+            let html = questions.map(createQuestionCardHTML).join('');
+            if (carelessMistakes.length > 0) {
+                html += '<h2 class="search-section-title">计算错误中的匹配</h2>';
+                html += carelessMistakes.map(createCarelessCardHTML).join('');
+            }
+            resultsContainer.innerHTML = html;
         }
 
         // ... (handleSearch 和 事件监听部分保持不变) ...
@@ -145,9 +167,13 @@
             resultsContainer.innerHTML = '';
 
             const formData = new FormData();
-            formData.append('query', searchQueryInput.value);
+            const hasImage = !!searchImageInput.files[0];
+            // 选择图片后输入框里的 "[图片: xxx]" 只是提示文字，不作为文本查询条件
+            const queryText = (hasImage && searchQueryInput.value.startsWith('[图片:')) ? '' : searchQueryInput.value;
+            formData.append('query', queryText);
+            formData.append('render', 'html');
 
-            if (searchImageInput.files[0]) {
+            if (hasImage) {
                 formData.append('image', searchImageInput.files[0]);
             }
 
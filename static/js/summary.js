@@ -81,16 +81,25 @@
             return;
         }
 
-        const knowledgePointsHTML = (data.ai_summary.knowledge_points_summary || []).map(point => `<li>${point}</li>`).join('');
+        let summaryBodyHTML;
+        if (data.pending) {
+            // 总结还在后台生成：显示提示，稍后自动重新获取
+            summaryBodyHTML = `<p class="summary-pending">⏳ ${data.message}</p>`;
+            schedulePendingRefresh(data);
+        } else {
+            const knowledgePointsHTML = (data.ai_summary.knowledge_points_summary || []).map(point => `<li>${point}</li>`).join('');
+            summaryBodyHTML = `
+            <p><strong>学习总纲：</strong>${data.ai_summary.general_summary}</p>
+            <p><strong>核心知识点：</strong></p>
+            <ul>${knowledgePointsHTML}</ul>`;
+        }
 
         summaryContainer.innerHTML = `
             <div class="summary-header">
                 <h2>学习总结 (${data.date})</h2>
                 <button id="regenerate-summary-btn" class="secondary-btn" title="使用最新的AI模型重新生成总结">🔄 重新生成</button>
             </div>
-            <p><strong>学习总纲：</strong>${data.ai_summary.general_summary}</p>
-            <p><strong>核心知识点：</strong></p>
-            <ul>${knowledgePointsHTML}</ul>
+            ${summaryBodyHTML}
             <div class="summary-stats">
                 <div class="stat-item"><strong>当日错题数：</strong> ${data.question_count} 道</div>
                 <div class="stat-item subject-chart-container"><strong>科目分布：</strong><canvas id="subject-bar-chart-dynamic"></canvas></div>
@@ -101,6 +110,22 @@
         attachRegenerateListener();
     }
 
+    // 【新增】总结正在后台生成时，retry_after 秒后重新获取（用户已切换到其它日期时不再刷新）
+    function schedulePendingRefresh(data) {
+        if (!data || !data.pending || !data.retry_after) return;
+        setTimeout(async () => {
+            const summaryTitle = document.querySelector('#daily-summary-container h2');
+            if (!summaryTitle || summaryTitle.innerText.indexOf(`(${data.date})`) === -1) return;
+            try {
+                const response = await fetch(`/get-summary/${data.date}`);
+                const result = await response.json();
+                if (response.ok) updateSummaryUI(result);
+            } catch (error) {
+                console.error('Error refreshing pending summary:', error);
+            }
+        }, data.retry_after * 1000);
+    }
+
     async function handleRegenerateSummary() {
         const regenerateBtn = document.getElementById('regenerate-summary-btn');
         const summaryTitle = document.querySelector('#daily-summary-container h2');
@@ -139,6 +164,11 @@
     window.attachRegenerateListener = attachRegenerateListener;
     window.ensureChartAvailable = ensureChartAvailable;
 
+    // 首页渲染时总结还在后台生成，稍后自动刷新
+    document.addEventListener('DOMContentLoaded', function() {
+        if (typeof initialSummaryData !== 'undefined') schedulePendingRefresh(initialSummaryData);
+    });
+
     // 页面加载时渲染近7日折线图（如果后端注入了 weeklyChartData） — 使用 ensureChartAvailable 做防护
     document.addEventListener('DOMContentLoaded', function() {
         try {
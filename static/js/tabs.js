@@ -78,33 +78,38 @@
         if (!activePane || activePane.dataset.isLoading === 'true') return;
 
         const subject = activePane.dataset.subjectName;
-        let page = parseInt(activePane.dataset.page || '1', 10);
+        // 游标分页：cursor 为空表示第一页，之后使用服务器返回的 next_cursor
+        const cursor = activePane.dataset.cursor || '';
+        const isFirstPage = !cursor;
         const startDate = activePane.dataset.currentDate || '';
 
         activePane.dataset.isLoading = 'true';
         const loader = activePane.querySelector('.loader');
         if (loader) loader.style.display = 'block';
 
-        let apiUrl = `/get-questions?subject=${encodeURIComponent(subject)}&page=${page}`;
+        let apiUrl = `/get-questions?subject=${encodeURIComponent(subject)}&render=html`;
+        if (cursor) apiUrl += `&cursor=${encodeURIComponent(cursor)}`;
         if (startDate) apiUrl += `&start_date=${startDate}`;
 
         fetch(apiUrl)
             .then(response => response.json())
-            .then(questions => {
+            .then(data => {
+                const questions = data.items || [];
                 if (loader) loader.style.display = 'none';
                 if (questions.length > 0) {
                     renderQuestions(questions, activePane);
-                    activePane.dataset.page = page + 1;
+                    activePane.dataset.cursor = data.next_cursor || '';
 
-                    if (page === 1 && startDate) {
+                    if (isFirstPage && startDate) {
                         setTimeout(() => {
                             const targetDateHeader = activePane.querySelector(`#date-${startDate}`);
                             if (targetDateHeader) targetDateHeader.scrollIntoView({ behavior: 'smooth', block: 'start' });
                         }, 100);
                     }
-                } else {
+                }
+                if (!data.next_cursor) {
                     activePane.dataset.hasMore = 'false';
-                    const message = (page === 1 && startDate) ? `日期 ${startDate} 下没有错题哦。` : '已经到底啦！';
+                    const message = (isFirstPage && startDate && questions.length === 0) ? `日期 ${startDate} 下没有错题哦。` : '已经到底啦！';
                     if (!activePane.querySelector('.end-message')) activePane.insertAdjacentHTML('beforeend', `<p class="end-message">${message}</p>`);
                 }
             })
@@ -134,9 +139,9 @@
                     <button class="action-btn" data-action="delete" title="删除本错题"><svg xmlns="http://www.w3.org/2000/svg" width="24" height="24" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><polyline points="3 6 5 6 21 6"></polyline><path d="M19 6v14a2 2 0 0 1-2 2H7a2 2 0 0 1-2-2V6m3 0V4a2 2 0 0 1 2-2h4a2 2 0 0 1 2 2v2"></path><line x1="10" y1="11" x2="10" y2="17"></line><line x1="14" y1="11" x2="14" y2="17"></line></svg></button>
                 </div>
                 <h3>原题图片</h3>
-                <img src="data:image/jpeg;base64,${q.original_image_b64}" alt="错题图片">
+                <a href="${q.image_url}" target="_blank" title="查看原图"><img src="${q.preview_url}" srcset="${q.thumb_url} 320w, ${q.preview_url} 1024w" sizes="(max-width: 600px) 100vw, 800px" loading="lazy" alt="错题图片"></a>
                 <div id="analysis-content-${q.id}">
-                    <h3>AI解析</h3><div class="ai-analysis-content">${window.markdownToHtml ? window.markdownToHtml(q.problem_analysis) : q.problem_analysis}</div>
+                    <h3>AI解析</h3><div class="ai-analysis-content">${q.problem_analysis_html || (window.markdownToHtml ? window.markdownToHtml(q.problem_analysis) : q.problem_analysis)}</div>
                     <h3>考点分析</h3><ul class="knowledge-points-content">${(q.knowledge_points||[]).map(p => `<li>${p}</li>`).join('')}</ul>
                     <h3>可能的错误</h3><ul class="ai-analysis-errors">${(q.ai_analysis||[]).map(e => `<li>${e}</li>`).join('')}</ul>
                     <h3>例题练手</h3><div class="similar-examples-content">${(q.similar_examples||[]).map(ex => `<div class="example"><strong>题目：</strong> ${ex.question}<br><strong>解答：</strong><br><div>${window.markdownToHtml ? window.markdownToHtml(ex.answer) : ex.answer}</div></div>`).join('')}</div>
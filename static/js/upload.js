@@ -25,7 +25,7 @@
                 if (btn.dataset.subTab === 'ai-upload') {
                     if (carelessForm) { carelessForm.reset(); carelessForm.querySelector('#careless-image-preview').innerHTML = ''; carelessForm.querySelector('#careless-upload-status').innerHTML = ''; }
                 } else {
-                    if (aiForm) { aiForm.reset(); aiForm.querySelector('#image-preview').innerHTML = ''; aiForm.querySelector('#upload-status').innerHTML = ''; }
+                    if (aiForm) { aiForm.reset(); aiForm.querySelector('#image-preview').innerHTML = ''; aiForm.querySelector('#upload-status').innerHTML = ''; aiForm.querySelector('#analysis-preview').innerHTML = ''; }
                 }
             });
         });
@@ -35,6 +35,7 @@
             const aiImagePreview = aiForm.querySelector('#image-preview');
             const aiSubmitBtn = aiForm.querySelector('#submit-btn');
             const aiUploadStatus = aiForm.querySelector('#upload-status');
+            const aiAnalysisPreview = aiForm.querySelector('#analysis-preview');
 
             aiImageInput.addEventListener('change', function() {
                 aiImagePreview.innerHTML = '';
@@ -46,22 +47,134 @@
                 }
             });
 
+            function resetAiSubmit() {
+                aiSubmitBtn.disabled = false;
+                aiSubmitBtn.textContent = '上传并分析';
+            }
+
+            const PREVIEW_TITLES = {
+                problem_analysis: '题目解析',
+                knowledge_points: '考察知识点',
+                possible_errors: '易错点',
+                similar_examples: '相似例题'
+            };
+
+            // 取得（或按字段顺序创建）某个字段的预览区域
+            function getPreviewSection(field) {
+                let section = aiAnalysisPreview.querySelector(`[data-field="${field}"]`);
+                if (!section) {
+                    section = document.createElement('div');
+                    section.dataset.field = field;
+                    const title = document.createElement('h4');
+                    title.textContent = PREVIEW_TITLES[field] || field;
+                    section.appendChild(title);
+                    section.appendChild(document.createElement('div'));
+                    aiAnalysisPreview.appendChild(section);
+                }
+                return section.lastChild;
+            }
+
+            function renderPreviewField(data) {
+                const body = getPreviewSection(data.field);
+                body.className = 'ai-analysis-content';
+                body.innerHTML = '';
+                if (data.field === 'problem_analysis') {
+                    body.innerHTML = data.html;
+                } else if (data.field === 'similar_examples') {
+                    (data.value || []).forEach((example, index) => {
+                        const item = document.createElement('p');
+                        item.textContent = `例题 ${index + 1}：${example.question || ''}`;
+                        body.appendChild(item);
+                    });
+                } else {
+                    const list = document.createElement('ul');
+                    (data.value || []).forEach(text => {
+                        const li = document.createElement('li');
+                        li.textContent = text;
+                        list.appendChild(li);
+                    });
+                    body.appendChild(list);
+                }
+            }
+
+            function renderPreviewPartial(data) {
+                const body = getPreviewSection(data.field);
+                body.className = 'streaming-text';
+                body.textContent = data.text;
+            }
+
+            // 【新增】通过 SSE 跟踪后台分析任务的状态
+            function followAnalysisJob(jobId, eventsUrl) {
+                const source = new EventSource(eventsUrl);
+                aiAnalysisPreview.innerHTML = '';
+                source.addEventListener('field', (event) => renderPreviewField(JSON.parse(event.data)));
+                source.addEventListener('partial', (event) => renderPreviewPartial(JSON.parse(event.data)));
+                source.addEventListener('status', (event) => {
+                    const job = JSON.parse(event.data);
+                    aiUploadStatus.className = '';
+                    if (job.status === 'queued') {
+                        // 等待重试：上一次尝试生成的内容作废
+                        aiAnalysisPreview.innerHTML = '';
+                        aiUploadStatus.textContent = job.attempts > 0
+                            ? `第 ${job.attempts} 次分析失败，稍后自动重试...（${job.error || ''}）`
+                            : '图片已上传，正在排队分析...';
+                    } else if (job.status === 'running') {
+                        aiSubmitBtn.textContent = '正在分析中...';
+                        aiUploadStatus.textContent = 'AI 正在分析这道题，可以先去做别的事情～';
+                    } else if (job.status === 'succeeded') {
+                        source.close();
+                        aiUploadStatus.textContent = '错题上传并分析成功！页面即将刷新...';
+                        aiUploadStatus.classList.add('success');
+                        setTimeout(() => window.location.reload(), 2000);
+                    } else if (job.status === 'failed') {
+                        source.close();
+                        aiUploadStatus.textContent = 'AI分析失败：' + (job.error || '未知错误') + ' ';
+                        aiUploadStatus.classList.add('error');
+                        const retryBtn = document.createElement('button');
+                        retryBtn.type = 'button';
+                        retryBtn.textContent = '重试';
+                        retryBtn.addEventListener('click', () => retryAnalysisJob(jobId));
+                        aiUploadStatus.appendChild(retryBtn);
+                        resetAiSubmit();
+                    }
+                });
+                source.addEventListener('timeout', () => {
+                    source.close();
+                    aiUploadStatus.textContent = '分析时间较长，结果会在完成后出现在错题列表中，请稍后刷新页面。';
+                    resetAiSubmit();
+                });
+            }
+
+            function retryAnalysisJob(jobId) {
+                aiUploadStatus.textContent = '正在重新提交...';
+                aiUploadStatus.className = '';
+                aiSubmitBtn.disabled = true;
+                fetch(`/jobs/${jobId}/retry`, { method: 'POST' })
+                .then(response => response.json().then(data => { if (!response.ok) throw new Error(data.message); return data; }))
+                .then(data => followAnalysisJob(data.job_id, data.events_url))
+                .catch(error => {
+                    aiUploadStatus.textContent = '重试失败：' + error.message;
+                    aiUploadStatus.classList.add('error');
+                    resetAiSubmit();
+                });
+            }
+
             aiForm.addEventListener('submit', function(event) {
                 event.preventDefault();
                 aiSubmitBtn.disabled = true;
-                aiSubmitBtn.textContent = '正在分析中...';
+                aiSubmitBtn.textContent = '正在上传...';
                 aiUploadStatus.innerHTML = '';
                 aiUploadStatus.className = '';
+                aiAnalysisPreview.innerHTML = '';
                 fetch('/upload', { method: 'POST', body: new FormData(aiForm) })
                 .then(response => { if (!response.ok) return response.json().then(err => { throw new Error(err.message) }); return response.json(); })
                 .then(data => {
-                    if (data.status === 'success') { aiUploadStatus.textContent = data.message + ' 页面即将刷新...'; aiUploadStatus.classList.add('success'); setTimeout(() => window.location.reload(), 2000); } else { throw new Error(data.message); }
+                    if (data.status === 'queued') { aiUploadStatus.textContent = data.message; followAnalysisJob(data.job_id, data.events_url); } else { throw new Error(data.message); }
                 })
                 .catch(error => {
                     aiUploadStatus.textContent = '上传失败：' + error.message;
                     aiUploadStatus.classList.add('error');
-                    aiSubmitBtn.disabled = false;
-                    aiSubmitBtn.textContent = '上传并分析';
+                    resetAiSubmit();
                 });
             });
         }
@@ -0,0 +1,215 @@
+"""
+每日总结的后台生成。
+
+首页和 /get-summary 只读取已经保存的总结，从不在请求中等待 AI：
+- 已经结束的日子还没有总结时，记为 pending 并立即交给后台线程生成，页面先显示"总结正在准备中"；
+- 当天还没有结束（还可能继续上传错题），只记为 pending，等这一天结束后再生成；
+- 调度线程每天在 SUMMARY_SCHEDULE_TIME 为所有已经结束、还没有（最新的）总结的日子生成总结，
+  应用空闲超过 SUMMARY_IDLE_SECONDS 时也会提前处理 pending 的日子。
+
+任务状态保存在各自数据库的 summary_jobs 表中（见 database.claim_summary_job），多个进程不会重复生成同一天。
+"""
+import os
+import time
+import threading
+from collections import Counter
+from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import core
+import database
+
+# 是否启动调度线程
+SUMMARY_SCHEDULER_ENABLED = os.getenv("SUMMARY_SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes")
+# 每天定时生成总结的时间 (HH:MM)
+SUMMARY_SCHEDULE_TIME = os.getenv("SUMMARY_SCHEDULE_TIME", "03:00")
+# 没有请求超过这么多秒视为空闲，提前生成 pending 的总结；0 表示只在定时时间生成
+SUMMARY_IDLE_SECONDS = int(os.getenv("SUMMARY_IDLE_SECONDS", "300"))
+# 调度线程检查的间隔秒数
+SUMMARY_CHECK_INTERVAL_SECONDS = int(os.getenv("SUMMARY_CHECK_INTERVAL_SECONDS", "60"))
+# 每个数据库每次运行最多生成的总结数，避免第一次运行时为所有历史日期集中调用 AI
+SUMMARY_MAX_PER_RUN = int(os.getenv("SUMMARY_MAX_PER_RUN", "20"))
+# running 状态超过这么久，认为生成它的进程已经退出
+SUMMARY_STALE_SECONDS = int(os.getenv("SUMMARY_STALE_SECONDS", "900"))
+
+_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_last_activity = time.monotonic()
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def note_activity():
+    """记录一次用户请求（用于判断应用是否空闲）。"""
+    global _last_activity
+    _last_activity = time.monotonic()
+
+
+def is_closed_day(date_str: str) -> bool:
+    """这一天是否已经结束（今天之前的日子）。"""
+    return date_str < date.today().strftime("%Y-%m-%d")
+
+
+def _stale_before() -> str:
+    return (datetime.now() - timedelta(seconds=SUMMARY_STALE_SECONDS)).strftime(_TIME_FORMAT)
+
+
+def get_summary_stats(date_str: str):
+    """
+    从汇总表统计某一天的题目数和科目分布（粗心错误作为单独一类，标签为"计算错误"），不调用 AI。
+    这一天没有错题时返回 None。
+    """
+    subject_rows = database.get_subject_counts_by_date(date_str)
+    if not subject_rows:
+        return None
+
+    subject_counts = Counter({row['subject']: row['count'] for row in subject_rows})
+    careless_count = 0
+    try:
+        careless_count = int(database.get_careless_count_by_date(date_str) or 0)
+    except Exception as e:
+        print(f"Failed to get careless count for {date_str}: {e}")
+
+    # 如果存在粗心错误，则把它作为单独一类加入科目分布（标签为“计算错误”），并计入总数
+    if careless_count > 0:
+        subject_counts['计算错误'] = subject_counts.get('计算错误', 0) + careless_count
+
+    return {
+        "date": date_str,
+        "question_count": sum(subject_counts.values()),
+        "subject_chart_data": {
+            "labels": list(subject_counts.keys()),
+            "data": list(subject_counts.values())
+        }
+    }
+
+
+def build_daily_summary(date_str: str, bypass_cache: bool = False):
+    """调用 AI 生成某一天的总结，返回总结数据；这一天没有错题时返回 None。"""
+    stats = get_summary_stats(date_str)
+    questions_for_date = database.get_questions_by_date(date_str, columns=database.QUESTION_SUMMARY_COLUMNS)
+    if stats is None or not questions_for_date:
+        return None
+
+    print(f"Found {len(questions_for_date)} questions for {date_str}. Generating summary...")
+    # 摘要在写入错题时生成；迁移完成前的旧记录临时生成
+    digests = [
+        q['digest'] or database.build_question_digest(database.get_question_by_id(q['id']))
+        for q in questions_for_date
+    ]
+    ai_summary_content = core.generate_daily_summary_from_digests(digests, bypass_cache=bypass_cache)
+    return dict(stats, ai_summary=ai_summary_content)
+
+
+def generate_summary_for_date(date_str: str) -> bool:
+    """在当前数据库中生成并保存某一天的总结；已经有其它线程/进程在生成，或总结已是最新时返回 False。"""
+    if not database.claim_summary_job(date_str, _stale_before()):
+        return False
+    try:
+        saved = database.get_summary_by_date(date_str)
+        stats = get_summary_stats(date_str)
+        if saved and stats and saved['question_count'] == stats['question_count']:
+            # 排队期间已经生成过（例如用户点击了"重新生成"）
+            database.finish_summary_job(date_str)
+            return False
+        summary = build_daily_summary(date_str)
+        if summary is None:
+            # 这一天的记录已经被删除
+            database.fail_summary_job(date_str, "no questions for this date")
+            return False
+        if 'error' in summary['ai_summary']:
+            database.fail_summary_job(date_str, summary['ai_summary']['error'])
+            print(f"Summary generation for {date_str} failed: {summary['ai_summary']['error']}")
+            return False
+        database.save_summary_and_finish_job(summary)
+        return True
+    except Exception as e:
+        database.fail_summary_job(date_str, str(e))
+        print(f"Summary generation for {date_str} crashed: {e}")
+        return False
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    """按进程懒加载的单线程执行器：总结一个一个生成，不与上传分析抢占 AI 配额。"""
+    global _executor, _executor_pid
+    with _executor_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="summary")
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run_in_database(db_path: str, date_str: str):
+    database.use_database(db_path)
+    try:
+        generate_summary_for_date(date_str)
+    finally:
+        database.release_db_connection()
+
+
+def request_summary(date_str: str):
+    """
+    页面需要某一天的总结但还没有保存时调用：标记为 pending；
+    这一天已经结束时立即在后台生成，否则等这一天结束后由调度线程生成。
+    """
+    database.mark_summary_pending(date_str)
+    if is_closed_day(date_str):
+        _get_executor().submit(_run_in_database, database.current_database_path(), date_str)
+
+
+def run_pending_summaries(include_failed: bool = False) -> int:
+    """为所有数据库中已经结束、需要总结的日子生成总结，返回生成成功的数量。"""
+    today = date.today().strftime("%Y-%m-%d")
+    generated = 0
+    for db_path in database.list_database_files():
+        database.use_database(db_path)
+        try:
+            for date_str in database.get_dates_needing_summary(
+                today, include_failed, _stale_before(), SUMMARY_MAX_PER_RUN
+            ):
+                if generate_summary_for_date(date_str):
+                    generated += 1
+        except Exception as e:
+            print(f"Failed to generate summaries for {db_path}: {e}")
+        finally:
+            database.release_db_connection()
+    database.use_database(None)
+    if generated:
+        print(f"Generated {generated} daily summaries in the background.")
+    return generated
+
+
+def _scheduled_time_reached(now: datetime, last_run_day) -> bool:
+    hour, minute = (int(part) for part in SUMMARY_SCHEDULE_TIME.split(":"))
+    return last_run_day != now.date() and (now.hour, now.minute) >= (hour, minute)
+
+
+def start_scheduler():
+    """启动调度线程（SUMMARY_SCHEDULER_ENABLED 关闭时不启动）。"""
+    if not SUMMARY_SCHEDULER_ENABLED:
+        return None
+
+    def loop():
+        last_run_day = None
+        last_idle_run = 0.0
+        while True:
+            time.sleep(SUMMARY_CHECK_INTERVAL_SECONDS)
+            try:
+                now = datetime.now()
+                if _scheduled_time_reached(now, last_run_day):
+                    last_run_day = now.date()
+                    # 定时运行时也重试之前失败的日子
+                    run_pending_summaries(include_failed=True)
+                elif (SUMMARY_IDLE_SECONDS and time.monotonic() - _last_activity >= SUMMARY_IDLE_SECONDS
+                      and last_idle_run < _last_activity):
+                    # 每段空闲期只运行一次，之后要等有新的请求（可能带来新数据）再运行
+                    last_idle_run = time.monotonic()
+                    run_pending_summaries()
+            except Exception as e:
+                print(f"Summary scheduler run failed: {e}")
+
+    thread = threading.Thread(target=loop, name="summary-scheduler", daemon=True)
+    thread.start()
+    print(f"Summary scheduler started (daily at {SUMMARY_SCHEDULE_TIME}, idle after {SUMMARY_IDLE_SECONDS}s).")
+    return thread
@@ -0,0 +1,57 @@
+"""AI 结果缓存：条目数和总大小由触发器维护，必须与表中的实际内容一致。"""
+import sqlite3
+
+import pytest
+
+import ai_cache
+
+
+@pytest.fixture()
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(ai_cache, "AI_CACHE_PATH", str(tmp_path / "cache.db"))
+    monkeypatch.setattr(ai_cache, "_last_sweep", 0.0)
+    yield
+    ai_cache.clear()
+
+
+def _actual_totals():
+    with ai_cache._lock:
+        return tuple(ai_cache._get_connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ai_cache"
+        ).fetchone())
+
+
+def _stats_totals():
+    stats = ai_cache.get_cache_stats()
+    return stats["entries"], stats["bytes"]
+
+
+def test_stats_follow_insert_replace_and_clear(cache):
+    ai_cache.put("test", "a", {"value": "x" * 100})
+    ai_cache.put("test", "b", {"value": "y"})
+    ai_cache.put("test", "a", {"value": "short"})
+    assert _stats_totals() == _actual_totals() and _actual_totals()[0] == 2
+    ai_cache.clear()
+    assert _stats_totals() == (0, 0)
+
+
+def test_eviction_uses_tracked_size(cache, monkeypatch):
+    monkeypatch.setattr(ai_cache, "AI_CACHE_MAX_MB", 1000 / (1024 * 1024))
+    for i in range(20):
+        ai_cache.put("test", f"key{i}", {"value": "z" * 100})
+    entries, size = _stats_totals()
+    assert (entries, size) == _actual_totals()
+    assert size <= 1000 and ai_cache.get("test", "key19") is not None
+
+
+def test_existing_cache_file_is_counted(tmp_path, monkeypatch):
+    path = tmp_path / "old.db"
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE ai_cache (key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, "
+                 "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL)")
+    conn.execute("INSERT INTO ai_cache VALUES ('k', 'test', '{}', 2, 0, 0)")
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(ai_cache, "AI_CACHE_PATH", str(path))
+    monkeypatch.setattr(ai_cache, "AI_CACHE_TTL_HOURS", 0)
+    assert _stats_totals() == (1, 2)
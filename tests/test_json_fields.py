@@ -0,0 +1,61 @@
+"""接口响应会把错题的 JSON 字段原样拼接输出，数据库中只能保存合法的 JSON 文本。"""
+import json
+
+import pytest
+
+import database
+
+
+@pytest.fixture()
+def db(tmp_path):
+    database.use_database(str(tmp_path / "test.db"))
+    database.init_db()
+    yield
+    database.release_db_connection()
+    database.use_database(None)
+
+
+@pytest.mark.parametrize("value, expected", [
+    ('["理想气体"]', '["理想气体"]'),
+    ('{"a": 1}', '{"a": 1}'),
+    ('[1, 2,]', '[]'),
+    ('{"a": }', '[]'),
+    ('["截断的输出', '[]'),
+    ('[NaN]', '[]'),
+    ('"text"', '[]'),
+    ('', '[]'),
+    (None, '[]'),
+])
+def test_normalize_json_text(value, expected):
+    assert database.normalize_json_text(value) == expected
+
+
+def test_add_question_stores_valid_json(db):
+    database.add_question({
+        "subject": "物理化学",
+        "upload_date": "2025-10-10 10:00:00",
+        "image_hash": "",
+        "problem_analysis": "解析",
+        "knowledge_points": '["理想气体"]',
+        "ai_analysis": '[1, 2,]',
+        "similar_examples": None,
+    })
+    row = database.get_question_by_id(1)
+    assert json.loads(row['knowledge_points']) == ["理想气体"]
+    assert row['ai_analysis'] == "[]" and row['similar_examples'] == "[]"
+
+
+def test_migration_replaces_invalid_json(db):
+    with database.transaction() as conn:
+        conn.execute(
+            "INSERT INTO questions (subject, upload_date, original_image_b64, problem_analysis, "
+            "knowledge_points, ai_analysis, similar_examples) "
+            "VALUES ('数学', '2025-10-10 10:00:00', '', '解析', ?, ?, ?)",
+            ('{"a": }', database.encode_text('["ok"]'), database.encode_text('[{"question": "截断'))
+        )
+    processed, _ = database._json_fields_batch(0, 100)
+    assert processed == 1
+    row = database.get_question_by_id(1)
+    for column in database.QUESTION_JSON_COLUMNS:
+        json.loads(row[column])
+    assert row['ai_analysis'] == '["ok"]'
@@ -0,0 +1,66 @@
+"""关键词字符串的解析和倒排索引：模型输出的三段式前后常带有说明文字或标点。"""
+import pytest
+
+import database
+
+
+@pytest.fixture()
+def db(tmp_path):
+    database.use_database(str(tmp_path / "test.db"))
+    database.init_db()
+    yield
+    database.release_db_connection()
+    database.use_database(None)
+
+
+@pytest.mark.parametrize("text", [
+    "[物理化学]-[电化学]-[能斯特方程, 活度]",
+    "关键词: [物理化学]-[电化学]-[能斯特方程, 活度]",
+    "[物理化学]-[电化学]-[能斯特方程, 活度]。",
+    "关键词：\n[物理化学]-[电化学]-[能斯特方程，活度]\n以上。",
+])
+def test_parse_keywords_with_surrounding_text(text):
+    assert database.parse_keywords(text) == ("物理化学", "电化学", ["能斯特方程", "活度"])
+
+
+@pytest.mark.parametrize("text", [None, "", "物理化学 电化学", "[物理化学]-[电化学]"])
+def test_parse_keywords_rejects_other_text(text):
+    assert database.parse_keywords(text) is None
+
+
+def _insert_unindexed_question(keywords):
+    """绕过 add_question 直接写入一道错题，模拟旧版本没有建立索引的数据。"""
+    with database.transaction() as conn:
+        return conn.execute(
+            "INSERT INTO questions (subject, upload_date, original_image_b64, problem_analysis, keywords) "
+            "VALUES ('物理化学', '2025-10-10 10:00:00', '', '解析', ?)",
+            (keywords,)
+        ).lastrowid
+
+
+def test_question_with_prefixed_keywords_is_searchable(db):
+    database.add_question({
+        "subject": "物理化学",
+        "upload_date": "2025-10-10 10:00:00",
+        "image_hash": "",
+        "problem_analysis": "解析",
+        "keywords": "关键词: [物理化学]-[电化学]-[能斯特方程, 活度]。",
+    })
+    assert "电化学" in database.get_search_filters()["物理化学"]
+    matches = database.search_questions(image_keywords_str="输出：[物理化学]-[电化学]-[能斯特方程]")
+    assert matches and matches[0]['match_score'] == 1
+
+
+def test_backfill_migration_indexes_keywords_with_surrounding_text(db):
+    question_id = _insert_unindexed_question("关键词: [物理化学]-[电化学]-[能斯特方程, 活度]。")
+    assert database._count_unindexed_keywords() == 1
+
+    # 回到重新补建索引之前的版本，再升级
+    with database.transaction() as conn:
+        conn.execute("PRAGMA user_version = 21")
+    database.migrate_db()
+
+    assert database._count_unindexed_keywords() == 0
+    assert "电化学" in database.get_search_filters()["物理化学"]
+    matches = database.search_questions(image_keywords_str="[物理化学]-[电化学]-[活度]")
+    assert [row['id'] for row in matches] == [question_id]
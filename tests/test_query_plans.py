@@ -0,0 +1,100 @@
+"""
+检查按日期/科目查询以及首页统计的执行计划：
+分页和按日期查询必须走索引（不能全表扫描，也不能为 ORDER BY 临时排序），首页统计只读汇总表。
+调用的是真实的查询函数，通过 set_trace_callback 记录它们实际执行的 SQL，再对每条语句 EXPLAIN QUERY PLAN。
+"""
+import json
+from contextlib import contextmanager
+
+import pytest
+
+import database
+
+
+@pytest.fixture()
+def db(tmp_path):
+    database.use_database(str(tmp_path / "test.db"))
+    database.init_db()
+    for day in ("2025-10-09", "2025-10-10"):
+        database.add_question({
+            "subject": "物理化学",
+            "upload_date": f"{day} 10:00:00",
+            "image_hash": "",
+            "problem_analysis": "这是关于克拉伯龙方程的解析...",
+            "knowledge_points": json.dumps(["理想气体"], ensure_ascii=False),
+            "ai_analysis": json.dumps(["单位错误"], ensure_ascii=False),
+            "similar_examples": "[]",
+        })
+        database.add_careless_mistake({"upload_date": f"{day} 11:00:00", "image_hash": "", "user_reflection": "看错符号"})
+    yield
+    database.release_db_connection()
+    database.use_database(None)
+
+
+@contextmanager
+def traced_selects():
+    """记录当前线程的连接在这段时间内执行的 SELECT 语句（参数已经代入）。"""
+    conn = database.get_db_connection()
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        conn.set_trace_callback(None)
+    statements[:] = [sql for sql in statements if sql.lstrip().upper().startswith("SELECT")]
+    assert statements, "no SELECT statement was executed"
+
+
+def query_plans(statements):
+    with database.get_db_connection() as conn:
+        return [
+            (sql, [row['detail'] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}")])
+            for sql in statements
+        ]
+
+
+def _page_cursor(fetch_page):
+    _, next_cursor = fetch_page(None)
+    assert next_cursor
+    return next_cursor
+
+
+INDEXED_QUERIES = {
+    "questions_by_date": lambda: database.get_questions_by_date("2025-10-10"),
+    "questions_by_subject": lambda: database.get_questions_by_subject("物理化学", limit=1),
+    "questions_by_subject_start_date": lambda: database.get_questions_by_subject(
+        "物理化学", limit=1, start_date="2025-10-10"),
+    "questions_by_subject_next_page": lambda: database.get_questions_by_subject(
+        "物理化学", limit=1, cursor=_page_cursor(lambda c: database.get_questions_by_subject("物理化学", limit=1))),
+    "careless_mistakes": lambda: database.get_careless_mistakes(limit=1),
+    "careless_mistakes_next_page": lambda: database.get_careless_mistakes(
+        limit=1, cursor=_page_cursor(lambda c: database.get_careless_mistakes(limit=1))),
+}
+
+
+@pytest.mark.parametrize("name", INDEXED_QUERIES)
+def test_date_and_subject_queries_use_indexes(db, name):
+    with traced_selects() as statements:
+        INDEXED_QUERIES[name]()
+    for sql, plan in query_plans(statements):
+        # 扫描索引本身是允许的，扫描数据表不允许
+        assert not [step for step in plan if step.startswith("SCAN") and "INDEX" not in step], (sql, plan)
+        assert not [step for step in plan if "TEMP B-TREE FOR" in step and "ORDER BY" in step], (sql, plan)
+
+
+DASHBOARD_QUERIES = {
+    "all_question_dates": database.get_all_question_dates,
+    "latest_question_date": database.get_latest_question_date,
+    "weekly_summary_stats": database.get_weekly_summary_stats,
+    "all_subjects": database.get_all_subjects,
+    "subject_counts_by_date": lambda: database.get_subject_counts_by_date("2025-10-10"),
+    "careless_count_by_date": lambda: database.get_careless_count_by_date("2025-10-10"),
+}
+
+
+@pytest.mark.parametrize("name", DASHBOARD_QUERIES)
+def test_dashboard_stats_only_read_rollups(db, name):
+    with traced_selects() as statements:
+        DASHBOARD_QUERIES[name]()
+    for sql, plan in query_plans(statements):
+        assert not any(step.split()[1] in ("questions", "careless_mistakes") for step in plan), (sql, plan)